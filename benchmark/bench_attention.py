@@ -0,0 +1,153 @@
+"""
+Speed, memory and accuracy cost of the approximate attentions against the pretrained exact model, per sequence
+length.
+
+Latency (median of ``--repeat`` forwards after ``--warmup`` untimed ones) and peak activation memory (peak RSS
+above the RSS after the model is built) of a forward are measured on random sequences, in a fresh process per
+measure. The accuracy is measured on real held-out sequences (``--fasta``) against their true residues and
+contacts: masked-LM accuracy and perplexity at the masked positions, and the precision of the top-L predicted
+contacts against ``--contacts``, an .npz file with the [L, L] true contact map of every record under its name.
+The exact model loads the original pretrained checkpoint (``--checkpoint_path``); an approximate model loads its
+fine-tuned checkpoint from ``--approximate_checkpoints``, or the pretrained one to show the cost out of the box.
+The agreement with the exact model (top-1 and KL divergence of the masked-LM predictions) is printed as well.
+
+    python benchmark/bench_attention.py --checkpoint_path esm1b.pt --approximate_checkpoints \\
+        performer=esm1b_performer.pt --fasta valid.fasta --contacts valid_contacts.npz --lengths 256 512 1022
+
+Random weights and sequences only show the mechanics.
+"""
+import copy
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from common import build_parser, build_model, masked_batch, random_sequences, rss_mb, peak_rss_mb, timeit
+from openprotein.data import MaskedConverter, read_fasta
+from openprotein.piplines import contact_precision
+
+ATTENTIONS = ["full", "performer", "local"]
+
+
+def with_attention(args, attention):
+    args = copy.copy(args)
+    args.attention = attention
+    if attention != "full" and attention in args.approximate_checkpoints:
+        args.checkpoint_path = args.approximate_checkpoints[attention]
+    return args
+
+
+def measure(args, length):
+    model, _ = build_model(args)
+    tokens, _, _ = masked_batch(args.batch_size, length)
+    before = rss_mb()
+
+    def forward():
+        with torch.inference_mode():
+            model(tokens, repr_layers=[args.num_layers], return_logits=False)
+
+    seconds = timeit(forward, args.repeat, warmup=args.warmup)
+    return seconds, peak_rss_mb() - before
+
+
+def held_out(args, alphabet):
+    """
+    Masked batches of the held-out sequences, and their true contacts or None
+    """
+    if args.fasta:
+        records = list(read_fasta(args.fasta))[:args.num_sequences]
+    else:
+        records = [(f"random{i}", s) for i, s in enumerate(random_sequences(args.num_sequences, args.lengths[0]))]
+    limit = args.max_positions - 2
+    records = [(name, sequence[:limit]) for name, sequence in records]
+    contacts = None
+    if args.contacts:
+        maps = np.load(args.contacts)
+        contacts = [maps[name][:len(sequence), :len(sequence)] for name, sequence in records]
+    converter = MaskedConverter(alphabet.standard_toks, alphabet.prepend_toks, alphabet.append_toks,
+                                alphabet.prepend_bos, alphabet.append_eos)
+    # the same masks for every model
+    state = np.random.get_state()
+    np.random.seed(0)
+    sequences = [sequence for _, sequence in records]
+    batches = [converter(sequences[start:start + args.batch_size])
+               for start in range(0, len(sequences), args.batch_size)]
+    np.random.set_state(state)
+    return batches, contacts
+
+
+def evaluate(model, batches, contacts, padding_idx):
+    """
+    Masked-LM logits at the masked positions, accuracy, perplexity and contact precision at L of a model
+    """
+    logits, targets, predicted = [], [], []
+    with torch.inference_mode():
+        for origin_tokens, masked_tokens, target_tokens in batches:
+            scored = target_tokens.ne(padding_idx)
+            logits.append(model(masked_tokens)["logits"][scored].float())
+            targets.append(target_tokens[scored])
+            batch_contacts = model.predict_contacts(origin_tokens).float()
+            for b in range(len(origin_tokens)):
+                length = int(origin_tokens[b].ne(padding_idx).sum()) - 2
+                predicted.append(batch_contacts[b, :length, :length].numpy())
+    logits, targets = torch.cat(logits), torch.cat(targets)
+    accuracy = (logits.argmax(-1) == targets).float().mean().item()
+    perplexity = math.exp(F.cross_entropy(logits, targets).item())
+    precision = float("nan")
+    if contacts is not None:
+        precision = float(np.mean([contact_precision(true, pred) for true, pred in zip(contacts, predicted)]))
+    return logits, accuracy, perplexity, precision
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--attentions", default=ATTENTIONS, choices=ATTENTIONS, nargs="+")
+    parser.add_argument("--approximate_checkpoints", default=[], nargs="*", metavar="ATTENTION=PATH",
+                        help="fine-tuned checkpoint of an approximate attention, e.g. performer=esm1b_performer.pt")
+    parser.add_argument("--fasta", default=None, help="held-out sequences of the accuracy")
+    parser.add_argument("--contacts", default=None, help=".npz of the true [L, L] contact maps by record name")
+    parser.add_argument("--num_sequences", default=32, type=int, help="held-out sequences used")
+    parser.add_argument("--warmup", default=3, type=int, help="untimed forwards before the timed ones")
+    args = parser.parse_args()
+    args.approximate_checkpoints = dict(item.split("=", 1) for item in args.approximate_checkpoints)
+    if args.contacts and not args.fasta:
+        parser.error("--contacts needs the --fasta of its records")
+
+    # the peak RSS of a child starts from the RSS of the parent at fork, measure before loading the models here
+    costs = {}
+    for length in args.lengths:
+        for attention in args.attentions:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                costs[attention, length] = pool.submit(measure, with_attention(args, attention), length).result()
+
+    print(f"{'attention':>9s} {'length':>6s} {'latency ms':>10s} {'peak MB':>8s}")
+    for length in args.lengths:
+        for attention in args.attentions:
+            seconds, memory = costs[attention, length]
+            print(f"{attention:>9s} {length:6d} {seconds * 1e3:10.1f} {memory:8.1f}", flush=True)
+
+    # the pretrained exact model is the reference of every approximation
+    exact, alphabet = build_model(with_attention(args, "full"))
+    batches, contacts = held_out(args, alphabet)
+    reference = evaluate(exact, batches, contacts, alphabet.padding_idx)
+    expected = reference[0]
+    print(f"\n{'attention':>9s} {'weights':>24s} {'mlm acc':>8s} {'mlm ppl':>8s} {'P@L':>6s} {'top1 agr':>8s} "
+          f"{'kl':>8s}")
+    for attention in args.attentions:
+        if attention == "full":
+            logits, accuracy, perplexity, precision = reference
+        else:
+            model, _ = build_model(with_attention(args, attention))
+            logits, accuracy, perplexity, precision = evaluate(model, batches, contacts, alphabet.padding_idx)
+        agreement = (expected.argmax(-1) == logits.argmax(-1)).float().mean().item()
+        kl = F.kl_div(logits.log_softmax(-1), expected.log_softmax(-1), log_target=True, reduction="batchmean").item()
+        weights = with_attention(args, attention).checkpoint_path or "random"
+        print(f"{attention:>9s} {weights[-24:]:>24s} {accuracy:8.3f} {perplexity:8.2f} {precision:6.3f} "
+              f"{agreement:8.3f} {kl:8.4f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
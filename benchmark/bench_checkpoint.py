@@ -0,0 +1,60 @@
+"""
+Memory and throughput of activation checkpointing in training: bytes of the tensors saved for
+backward and time of a forward + backward step, per checkpointing mode and sequence length.
+
+    python benchmark/bench_checkpoint.py --lengths 256 512 1024 --batch_size 2 --checkpoint_every 3
+"""
+import torch
+import torch.nn.functional as F
+
+from common import build_parser, build_model, masked_batch, timeit
+
+
+def saved_bytes(fn) -> int:
+    """
+    Total size of the tensors autograd saves for backward while running ``fn``, storage shared by
+    several saved tensors is counted once
+    """
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values())
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--modes", default=["none", "every", "all"], nargs="+",
+                        choices=["none", "every", "all", "budget"])
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+    model.train()
+
+    print(f"{'mode':>6s} {'length':>6s} {'layers':>6s} {'saved MB':>9s} {'step ms':>8s}")
+    for length in args.lengths:
+        _, masked_tokens, target_tokens = masked_batch(args.batch_size, length)
+
+        def forward():
+            logits = model(masked_tokens)["logits"]
+            return F.cross_entropy(logits.view(-1, logits.size(-1)), target_tokens.view(-1),
+                                   ignore_index=alphabet.padding_idx)
+
+        def step():
+            model.zero_grad()
+            forward().backward()
+
+        for mode in args.modes:
+            model.activation_checkpointing = mode
+            layers = len(model.checkpointed_layers(*masked_tokens.shape))
+            memory = saved_bytes(forward) / 2 ** 20
+            seconds = timeit(step, args.repeat)
+            print(f"{mode:>6s} {length:6d} {layers:6d} {memory:9.1f} {seconds * 1e3:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
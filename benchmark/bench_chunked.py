@@ -0,0 +1,43 @@
+"""
+Peak activation memory and latency of long-sequence inference with the chunked attention and FFN
+against the full forward. Every measure runs in a fresh process, the peak is its peak RSS above the RSS
+after the model is built.
+
+    python benchmark/bench_chunked.py --lengths 1022 2046 4094 --chunk_sizes 0 256 --max_positions 4096
+"""
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from common import build_parser, build_model, masked_batch, rss_mb, peak_rss_mb
+
+
+def measure(args, chunk_size, length):
+    model, _ = build_model(args)
+    for layer in model.layers:
+        layer.chunk_size = chunk_size or None
+    tokens, _, _ = masked_batch(args.batch_size, length)
+    before = rss_mb()
+    start = time.perf_counter()
+    with torch.inference_mode():
+        model(tokens, repr_layers=[args.num_layers], return_logits=False)
+    return time.perf_counter() - start, peak_rss_mb() - before
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--chunk_sizes", default=[0, 256], type=int, nargs="+", help="0 runs the full forward")
+    args = parser.parse_args()
+
+    print(f"{'chunk':>6s} {'length':>6s} {'latency ms':>10s} {'peak MB':>8s}")
+    for length in args.lengths:
+        for chunk_size in args.chunk_sizes:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                seconds, memory = pool.submit(measure, args, chunk_size, length).result()
+            print(f"{chunk_size:6d} {length:6d} {seconds * 1e3:10.1f} {memory:8.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
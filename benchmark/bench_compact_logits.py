@@ -0,0 +1,44 @@
+"""
+MLM training step with the LM head on every position against the LM head on the masked
+positions only (``logits_mask``): step time and size of the logits.
+
+    python benchmark/bench_compact_logits.py --lengths 256 512 1024 --batch_size 4
+"""
+import torch.nn.functional as F
+
+from common import build_parser, build_model, masked_batch, timeit
+
+
+def main():
+    parser = build_parser(__doc__)
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+    model.train()
+
+    print(f"{'length':>6s} {'full ms':>8s} {'compact ms':>11s} {'speedup':>8s} {'logits MB':>10s} {'compact MB':>11s}")
+    for length in args.lengths:
+        _, masked_tokens, target_tokens = masked_batch(args.batch_size, length)
+        scored = target_tokens.ne(alphabet.padding_idx)
+        sizes = {}
+
+        def full():
+            model.zero_grad()
+            logits = model(masked_tokens)["logits"]
+            sizes["full"] = logits.numel() * logits.element_size()
+            F.cross_entropy(logits.view(-1, logits.size(-1)), target_tokens.view(-1),
+                            ignore_index=alphabet.padding_idx).backward()
+
+        def compact():
+            model.zero_grad()
+            logits = model(masked_tokens, logits_mask=scored)["logits"]
+            sizes["compact"] = logits.numel() * logits.element_size()
+            F.cross_entropy(logits, target_tokens[scored]).backward()
+
+        t_full = timeit(full, args.repeat)
+        t_compact = timeit(compact, args.repeat)
+        print(f"{length:6d} {t_full * 1e3:8.1f} {t_compact * 1e3:11.1f} {t_full / t_compact:8.2f} "
+              f"{sizes['full'] / 2 ** 20:10.2f} {sizes['compact'] / 2 ** 20:11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Compiled inference with length buckets against eager mode: compile time per bucket and latency
+of variable-length batches.
+
+    python benchmark/bench_compile.py --backend inductor --lengths 100 200 300 500 --batch_size 4
+"""
+import time
+
+import torch
+
+from common import build_parser, build_model, masked_batch, timeit
+from openprotein.models.compile import CompiledEsm1b
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--backend", default="inductor", choices=CompiledEsm1b.BACKENDS)
+    args = parser.parse_args()
+    model, _ = build_model(args)
+    compiled = CompiledEsm1b(model, backend=args.backend)
+
+    start = time.perf_counter()
+    buckets = sorted({compiled.bucket(length + 2) for length in args.lengths})
+    compiled.warmup(batch_size=args.batch_size, repr_layers=[args.num_layers], buckets=buckets)
+    print(f"warm-up of buckets {buckets}: {time.perf_counter() - start:.1f}s")
+
+    print(f"{'length':>6s} {'bucket':>6s} {'eager ms':>9s} {'compiled ms':>12s} {'speedup':>8s}")
+    for length in args.lengths:
+        tokens, _, _ = masked_batch(args.batch_size, length)
+        with torch.no_grad():
+            t_eager = timeit(lambda: model(tokens, repr_layers=[args.num_layers]), args.repeat)
+        t_compiled = timeit(lambda: compiled(tokens, repr_layers=[args.num_layers]), args.repeat)
+        print(f"{length:6d} {compiled.bucket(tokens.size(1)):6d} {t_eager * 1e3:9.1f} {t_compiled * 1e3:12.1f} "
+              f"{t_eager / t_compiled:8.2f}")
+    for graph in compiled.cache_status()["graphs"]:
+        print(graph)
+
+
+if __name__ == "__main__":
+    main()
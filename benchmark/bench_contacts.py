@@ -0,0 +1,55 @@
+"""
+Contact prediction of a batch of sequences of mixed lengths: the dense [B, T, T] maps of ``predict_contacts``
+against the sparse top-L records of ``ContactPrediction``. Every measure runs in a fresh process, the peak is
+its peak RSS above the RSS after the model is built; output MB is the size of what would be written out.
+
+    python benchmark/bench_contacts.py --lengths 256 512 1022 --batch_size 4
+"""
+import time
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from common import build_parser, build_model, rss_mb, peak_rss_mb, AMINO_ACIDS
+from openprotein.data import BatchConverter
+from openprotein.piplines import ContactPrediction
+
+
+def mixed_sequences(num, length, seed=0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(length // 2, length))) for _ in range(num)]
+
+
+def measure(args, mode, length):
+    model, alphabet = build_model(args)
+    sequences = mixed_sequences(args.batch_size, length)
+    contacts = ContactPrediction(model, alphabet, top=args.top)
+    before = rss_mb()
+    start = time.perf_counter()
+    if mode == "dense":
+        tokens = BatchConverter(alphabet)(sequences)
+        with torch.inference_mode():
+            maps = model.predict_contacts(tokens)
+        output = maps.numel() * maps.element_size()
+    else:
+        output = sum(pairs.nbytes + probs.nbytes for pairs, probs in contacts.predict(sequences))
+    return time.perf_counter() - start, peak_rss_mb() - before, output / 2 ** 20
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--top", default=1.0, type=float, help="contacts kept per sequence relative to its length")
+    args = parser.parse_args()
+
+    print(f"{'mode':>6s} {'length':>6s} {'latency ms':>10s} {'peak MB':>8s} {'output MB':>10s}")
+    for length in args.lengths:
+        for mode in ["dense", "sparse"]:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                seconds, memory, output = pool.submit(measure, args, mode, length).result()
+            print(f"{mode:>6s} {length:6d} {seconds * 1e3:10.1f} {memory:8.1f} {output:10.3f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
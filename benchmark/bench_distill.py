@@ -0,0 +1,42 @@
+"""
+Distilled students against their teacher: inference speed-up, MLM accuracy and contact precision retention,
+after a short distillation on random sequences (the teacher is only worth distilling once trained, use
+``--checkpoint_path``).
+
+    python benchmark/bench_distill.py --checkpoint_path esm1b.pt --student_layers 6 12 --steps 100 --lengths 256
+"""
+import time
+
+from common import build_parser, build_model, random_sequences
+from openprotein.piplines import Distillation, build_student, distillation_report
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--student_layers", default=[6, 12], type=int, nargs="+")
+    parser.add_argument("--steps", default=20, type=int, help="distillation steps per student")
+    parser.add_argument("--num_sequences", default=32, type=int, help="held-out sequences of the report")
+    args = parser.parse_args()
+    teacher, alphabet = build_model(args)
+    length = args.lengths[0]
+    train = random_sequences(args.steps * args.batch_size, length, seed=1)
+    valid = random_sequences(args.num_sequences, length)
+
+    print(f"{'layers':>7s} {'distill s':>10s} {'speedup':>8s} {'mlm acc':>8s} {'mlm ret':>8s} {'P@L':>6s} "
+          f"{'P@L ret':>8s}")
+    for num_layers in args.student_layers:
+        student = build_student(teacher, alphabet, num_layers)
+        distillation = Distillation(teacher, student, alphabet)
+        start = time.perf_counter()
+        distillation.fit(train, epochs=1, batch_size=args.batch_size)
+        seconds = time.perf_counter() - start
+        report = distillation_report(teacher, student, alphabet, valid, batch_size=args.batch_size)
+        print(f"{num_layers:7d} {seconds:10.1f} {report['speedup']:7.2f}x {report['student_mlm_accuracy']:8.3f} "
+              f"{report['mlm_retention']:8.3f} {report['student_contact_precision']:6.3f} "
+              f"{report['contact_retention']:8.3f}")
+    print(f"teacher {args.num_layers} layers: mlm acc {report['teacher_mlm_accuracy']:.3f}, "
+          f"{report['teacher_sequences_per_second']:.1f} seq/s")
+
+
+if __name__ == "__main__":
+    main()
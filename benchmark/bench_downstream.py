@@ -0,0 +1,67 @@
+"""
+Head training on cached features against rerunning the frozen backbone every epoch: the one-time extraction
+into the feature store, then the seconds per epoch of a regression head both ways.
+
+    python benchmark/bench_downstream.py --num_sequences 512 --lengths 256 --epochs 5
+"""
+import os
+import tempfile
+
+import torch
+import torch.nn.functional as F
+
+from common import build_parser, build_model, random_sequences, timeit
+from openprotein.data import BatchConverter
+from openprotein.layers import RegressionHead
+from openprotein.piplines import Embedding, FeatureDataset, DownstreamTrain
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--num_sequences", default=512, type=int)
+    parser.add_argument("--epochs", default=5, type=int, help="epochs of the cached training")
+    parser.add_argument("--hidden_dim", default=0, type=int)
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+    converter = BatchConverter(alphabet)
+    length = args.lengths[0]
+    sequences = random_sequences(args.num_sequences, length)
+    records = [(str(i), sequence) for i, sequence in enumerate(sequences)]
+    labels = torch.randn(len(records)).tolist()
+    layer = args.num_layers
+
+    output = os.path.join(tempfile.mkdtemp(), "store")
+    embedding = Embedding(model, alphabet, repr_layers=[layer], max_tokens=args.batch_size * (length + 2))
+    store = embedding.run(records, output)
+    extract_seconds = embedding.stats["seconds"]
+
+    head = RegressionHead(args.embed_dim, hidden_dim=args.hidden_dim)
+    optimizer = torch.optim.AdamW(head.parameters(), lr=1e-3)
+    targets = torch.tensor(labels)
+
+    def backbone_epoch():
+        for start in range(0, len(sequences), args.batch_size):
+            tokens = converter(sequences[start:start + args.batch_size])
+            with torch.inference_mode():
+                representations = model(tokens, repr_layers=[layer], return_logits=False)["representations"][layer]
+            mask = tokens.ne(alphabet.padding_idx) & tokens.ne(alphabet.cls_idx) & tokens.ne(alphabet.eos_idx)
+            optimizer.zero_grad()
+            loss = F.mse_loss(head(representations.clone(), mask), targets[start:start + args.batch_size])
+            loss.backward()
+            optimizer.step()
+
+    backbone_seconds = timeit(backbone_epoch, 1, warmup=0)
+
+    train = DownstreamTrain(FeatureDataset(store, f"mean_{layer}", labels))
+    train.fit(RegressionHead(args.embed_dim, hidden_dim=args.hidden_dim), epochs=args.epochs,
+              batch_size=args.batch_size)
+    cached_seconds = train.stats["seconds"] / args.epochs
+
+    print(f"{'sequences':>10s} {'length':>7s} {'extract s':>10s} {'backbone s/epoch':>17s} "
+          f"{'cached s/epoch':>15s} {'speedup':>8s}")
+    print(f"{len(records):10d} {length:7d} {extract_seconds:10.2f} {backbone_seconds:17.3f} "
+          f"{cached_seconds:15.5f} {backbone_seconds / cached_seconds:7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
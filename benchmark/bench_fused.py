@@ -0,0 +1,44 @@
+"""
+Inference latency of the fused encoder layer kernel, with the q/k/v projections packed on every call (as for
+weights mapped from a file) and packed once, against the module-by-module forward of the transformer layers,
+and the largest difference of their final representations.
+
+    python benchmark/bench_fused.py --lengths 128 256 512 1022 --batch_size 4
+"""
+import torch
+
+from common import build_parser, build_model, masked_batch, timeit
+
+
+def set_fused(model, fused: bool, cache_packed_qkv: bool = True):
+    for layer in model.layers:
+        layer.fused = fused
+        layer.cache_packed_qkv = cache_packed_qkv
+
+
+def main():
+    parser = build_parser(__doc__)
+    args = parser.parse_args()
+    model, _ = build_model(args)
+
+    print(f"{'length':>6s} {'modules ms':>10s} {'per call ms':>11s} {'cached ms':>10s} {'speedup':>8s} "
+          f"{'max diff':>9s}")
+    for length in args.lengths:
+        tokens, _, _ = masked_batch(args.batch_size, length)
+        results, times = [], []
+        for fused, cache_packed_qkv in [(False, True), (True, False), (True, True)]:
+            set_fused(model, fused, cache_packed_qkv)
+
+            def forward():
+                with torch.inference_mode():
+                    return model(tokens, repr_layers=[args.num_layers], return_logits=False)
+
+            results.append(forward()["representations"][args.num_layers])
+            times.append(timeit(forward, args.repeat))
+        diff = (results[0] - results[2]).abs().max().item()
+        print(f"{length:6d} {times[0] * 1e3:10.1f} {times[1] * 1e3:11.1f} {times[2] * 1e3:10.1f} "
+              f"{times[0] / times[2]:8.2f} {diff:9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Model startup time: random initialization followed by ``load_state_dict`` of a checkpoint, against
+``checkpoint_path`` (meta device construction and weights mapped from a ``torch.save`` file or a
+flat weight file).
+
+    python benchmark/bench_load.py --checkpoint esm1b.pt
+"""
+import os
+import copy
+import time
+import tempfile
+
+import torch
+
+from common import build_parser, build_model, rss_mb
+from openprotein.models import Esm1b, save_flat_weights
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--checkpoint", default=None, help="torch.save checkpoint, default one of a random model")
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+    directory = tempfile.mkdtemp()
+    checkpoint = args.checkpoint or os.path.join(directory, "checkpoint.pt")
+    if args.checkpoint is None:
+        torch.save(model.state_dict(), checkpoint)
+    flat = os.path.join(directory, "weights.bin")
+    save_flat_weights(model, flat)
+    del model
+
+    def init_and_load():
+        model = Esm1b(args, alphabet)
+        model.load_state_dict(torch.load(checkpoint, map_location="cpu", weights_only=True))
+        return model
+
+    def from_checkpoint(path):
+        return lambda: Esm1b(argparse_with(args, checkpoint_path=path), alphabet)
+
+    print(f"{'startup':>22s} {'seconds':>8s} {'RSS MB':>8s}")
+    for name, fn in [("init + load_state_dict", init_and_load), ("checkpoint_path .pt", from_checkpoint(checkpoint)),
+                     ("checkpoint_path flat", from_checkpoint(flat))]:
+        before = rss_mb()
+        model, seconds = timed(fn)
+        print(f"{name:>22s} {seconds:8.2f} {rss_mb() - before:8.1f}")
+        del model
+
+
+def argparse_with(args, **kwargs):
+    args = copy.copy(args)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+LoRA fine-tuning against full fine-tuning: trainable parameters, AdamW state, checkpoint size and step time,
+and inference latency of the adapted model before and after merging the adapters.
+
+    python benchmark/bench_lora.py --ranks 4 8 16 --lengths 256 --batch_size 4
+"""
+import os
+import copy
+import tempfile
+
+import torch
+import torch.nn.functional as F
+
+from common import build_parser, build_model, masked_batch, timeit
+from openprotein.models import inject_lora, save_lora, merge_lora
+
+
+def optimizer_state_mb(optimizer) -> float:
+    return sum(tensor.numel() * tensor.element_size() for state in optimizer.state.values()
+               for tensor in state.values() if torch.is_tensor(tensor)) / 2 ** 20
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--ranks", default=[4, 8, 16], type=int, nargs="+")
+    args = parser.parse_args()
+    base, alphabet = build_model(args)
+    directory = tempfile.mkdtemp()
+    length = args.lengths[0]
+    _, masked_tokens, target_tokens = masked_batch(args.batch_size, length)
+
+    def train_step(model, optimizer):
+        optimizer.zero_grad()
+        logits = model(masked_tokens)["logits"]
+        F.cross_entropy(logits.view(-1, logits.size(-1)), target_tokens.view(-1),
+                        ignore_index=alphabet.padding_idx).backward()
+        optimizer.step()
+
+    print(f"{'rank':>6s} {'trainable':>10s} {'adamw MB':>9s} {'file MB':>8s} {'step ms':>8s} {'infer ms':>9s} "
+          f"{'merged ms':>9s}")
+    for rank in [0] + args.ranks:
+        model = copy.deepcopy(base).train()
+        path = os.path.join(directory, f"rank{rank}.pt")
+        if rank:
+            inject_lora(model, rank=rank)
+        parameters = [p for p in model.parameters() if p.requires_grad]
+        optimizer = torch.optim.AdamW(parameters, lr=1e-4)
+        seconds = timeit(lambda: train_step(model, optimizer), args.repeat)
+        if rank:
+            save_lora(model, path)
+        else:
+            torch.save(model.state_dict(), path)
+
+        model.eval()
+
+        def infer():
+            with torch.inference_mode():
+                model(masked_tokens, repr_layers=[args.num_layers], return_logits=False)
+
+        infer_seconds = timeit(infer, args.repeat)
+        merged_seconds = infer_seconds
+        if rank:
+            merge_lora(model)
+            merged_seconds = timeit(infer, args.repeat)
+        print(f"{rank if rank else 'full':>6} {sum(p.numel() for p in parameters):10d} "
+              f"{optimizer_state_mb(optimizer):9.1f} {os.path.getsize(path) / 2 ** 20:8.2f} {seconds * 1e3:8.1f} "
+              f"{infer_seconds * 1e3:9.1f} {merged_seconds * 1e3:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
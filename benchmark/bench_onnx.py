@@ -0,0 +1,39 @@
+"""
+onnxruntime (CPU provider) against eager PyTorch: latency per sequence length, and parity of the outputs.
+
+    python benchmark/bench_onnx.py --lengths 64 256 1022 --batch_size 1
+"""
+import os
+import tempfile
+
+import torch
+
+from common import build_parser, build_model, masked_batch, timeit
+from openprotein.models.onnx import export_onnx, OnnxEsm1b
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--onnx_path", default=None, type=str, help="reuse or keep the exported graph")
+    args = parser.parse_args()
+    model, _ = build_model(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.onnx_path or os.path.join(tmp, "model.onnx")
+        if not os.path.exists(path):
+            export_onnx(model, path, repr_layers=[args.num_layers], return_contacts=True)
+        runner = OnnxEsm1b(path, num_threads=args.threads or torch.get_num_threads())
+
+        print(f"{'length':>6s} {'eager ms':>9s} {'onnx ms':>9s} {'speedup':>8s} {'max |diff|':>11s}")
+        for length in args.lengths:
+            tokens, _, _ = masked_batch(args.batch_size, length)
+            with torch.no_grad():
+                expected = model(tokens)["logits"]
+                t_eager = timeit(lambda: model(tokens), args.repeat)
+            diff = (runner(tokens)["logits"] - expected).abs().max().item()
+            t_onnx = timeit(lambda: runner(tokens), args.repeat)
+            print(f"{length:6d} {t_eager * 1e3:9.1f} {t_onnx * 1e3:9.1f} {t_eager / t_onnx:8.2f} {diff:11.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Training step time and peak memory of pipeline-parallel training, the layers split over 1, 2, 4... gloo
+processes, for the "gpipe" and "1f1b" schedules and several micro-batch counts. "1f1b" keeps fewer
+micro-batches of activations alive, so its peak memory on the first stages is lower at the same step time.
+
+    python benchmark/bench_pipeline.py --world_sizes 1 2 4 --micro_batches 4 8 --batch_size 16 --lengths 512
+"""
+import os
+import socket
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from common import build_parser, build_model, masked_batch, timeit, peak_rss_mb
+from openprotein.piplines import PipelineStage, PipelineTrain
+
+
+def run_rank(rank, world_size, port, args, path):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.set_num_threads(max(args.total_threads // world_size, 1))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    _, alphabet = build_model(args)
+    stage = PipelineStage(args, alphabet, rank, world_size, checkpoint_path=path)
+    optimizer = torch.optim.SGD(stage.parameters(), lr=1e-5)
+    for length in args.lengths:
+        _, masked_tokens, target_tokens = masked_batch(args.batch_size, length)
+        for schedule in ["gpipe", "1f1b"]:
+            for num_micro_batches in args.micro_batches:
+                train = PipelineTrain(stage, optimizer, alphabet.padding_idx, num_micro_batches, schedule)
+
+                def step():
+                    train.step(masked_tokens, target_tokens)
+                    dist.barrier()
+
+                seconds = timeit(step, args.repeat)
+                # the peak of the first stage, it holds the most activations
+                if rank == 0:
+                    print(f"{world_size:6d} {length:6d} {schedule:>8s} {num_micro_batches:6d} "
+                          f"{seconds * 1e3:10.1f} {peak_rss_mb():10.1f}", flush=True)
+    dist.destroy_process_group()
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--world_sizes", default=[1, 2], type=int, nargs="+")
+    parser.add_argument("--micro_batches", default=[1, 4], type=int, nargs="+")
+    parser.add_argument("--total_threads", default=os.cpu_count(), type=int)
+    args = parser.parse_args()
+    model, _ = build_model(args)
+    path = os.path.join(tempfile.mkdtemp(), "model.pt")
+    torch.save(model.state_dict(), path)
+    del model
+
+    print(f"{'ranks':>6s} {'length':>6s} {'schedule':>8s} {'micro':>6s} {'step ms':>10s} {'peak MB':>10s}")
+    for world_size in args.world_sizes:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        mp.spawn(run_rank, args=(world_size, port, args, path), nprocs=world_size)
+
+
+if __name__ == "__main__":
+    main()
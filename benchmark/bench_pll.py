@@ -0,0 +1,54 @@
+"""
+Throughput of pseudo-log-likelihood scoring: one masked forward per position against the batched
+exact, disjoint and subset modes of ``PseudoLikelihood``.
+
+    python benchmark/bench_pll.py --lengths 300 --num_sequences 100 --max_tokens 16384 --k 8
+"""
+import time
+
+import torch
+
+from common import build_parser, build_model, random_sequences
+from openprotein.data import BatchConverter
+from openprotein.piplines import PseudoLikelihood
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--num_sequences", default=20, type=int)
+    parser.add_argument("--max_tokens", default=8192, type=int)
+    parser.add_argument("--k", default=8, type=int, help="masked positions per copy of the disjoint mode")
+    parser.add_argument("--num_positions", default=32, type=int, help="scored positions of the subset mode")
+    parser.add_argument("--naive_limit", default=2, type=int, help="sequences timed with the naive loop")
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+    converter = BatchConverter(alphabet)
+
+    print(f"{'length':>6s} {'mode':>9s} {'seq/s':>8s} {'forwards':>9s} {'mean |error|':>13s}")
+    for length in args.lengths:
+        sequences = random_sequences(args.num_sequences, length)
+
+        start = time.perf_counter()
+        with torch.inference_mode():
+            for sequence in sequences[:args.naive_limit]:
+                tokens = converter([sequence])
+                for position in range(1, length + 1):
+                    masked = tokens.clone()
+                    masked[0, position] = alphabet.mask_idx
+                    model(masked)
+        naive = args.naive_limit / (time.perf_counter() - start)
+        print(f"{length:6d} {'naive':>9s} {naive:8.2f}")
+
+        exact = None
+        for mode in PseudoLikelihood.MODES:
+            pll = PseudoLikelihood(model, alphabet, mode=mode, k=args.k, num_positions=args.num_positions,
+                                   max_tokens=args.max_tokens)
+            scores = torch.tensor(pll.score(sequences))
+            exact = scores if exact is None else exact
+            error = (scores - exact).abs().mean().item()
+            print(f"{length:6d} {mode:>9s} {pll.stats['sequences_per_second']:8.2f} {pll.stats['forwards']:9d} "
+                  f"{error:13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+bf16 autocast against fp32 on CPU: throughput of the forward and of a training step, and memory
+of the activations saved for backward.
+
+    python benchmark/bench_precision.py --lengths 128 512 --batch_size 4
+"""
+import torch
+import torch.nn.functional as F
+
+from common import build_parser, build_model, masked_batch, timeit
+from openprotein.models.quantize import compare_models
+from openprotein.utils.precision import autocast
+
+
+def saved_activation_mb(model, masked_tokens, target_tokens, precision) -> float:
+    nbytes = [0]
+
+    def pack(tensor):
+        nbytes[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = train_loss(model, masked_tokens, target_tokens, precision)
+    loss.backward()
+    model.zero_grad()
+    return nbytes[0] / 2 ** 20
+
+
+def train_loss(model, masked_tokens, target_tokens, precision):
+    with autocast(precision):
+        logits = model(masked_tokens)["logits"]
+        return F.cross_entropy(logits.view(-1, logits.size(-1)), target_tokens.view(-1),
+                               ignore_index=model.padding_idx)
+
+
+def train_step(model, masked_tokens, target_tokens, precision):
+    train_loss(model, masked_tokens, target_tokens, precision).backward()
+    model.zero_grad()
+
+
+def main():
+    args = build_parser(__doc__).parse_args()
+    model, alphabet = build_model(args)
+
+    _, masked_tokens, target_tokens = masked_batch(args.batch_size, args.lengths[0])
+    bf16_model, _ = build_model(args)
+    bf16_model.precision = "bf16"
+    for key, value in compare_models(model, bf16_model, masked_tokens, target_tokens, alphabet.padding_idx).items():
+        print(f"{key:24s} {value:.4f}")
+
+    print(f"{'length':>6s} {'precision':>9s} {'fwd seq/s':>10s} {'train seq/s':>12s} {'saved MB':>10s}")
+    for length in args.lengths:
+        _, masked_tokens, target_tokens = masked_batch(args.batch_size, length)
+        for precision in ["fp32", "bf16"]:
+            model.precision = precision
+            with torch.no_grad():
+                t_forward = timeit(lambda: model(masked_tokens), args.repeat)
+            model.train()
+            t_train = timeit(lambda: train_step(model, masked_tokens, target_tokens, precision), args.repeat)
+            saved = saved_activation_mb(model, masked_tokens, target_tokens, precision)
+            model.eval()
+            print(f"{length:6d} {precision:>9s} {args.batch_size / t_forward:10.2f} "
+                  f"{args.batch_size / t_train:12.2f} {saved:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
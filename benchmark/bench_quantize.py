@@ -0,0 +1,48 @@
+"""
+Int8 dynamic quantization against fp32: accuracy, latency and memory.
+
+    python benchmark/bench_quantize.py --lengths 128 512 --batch_size 4
+"""
+import gc
+
+import torch
+
+from common import build_parser, build_model, masked_batch, timeit, rss_mb
+from openprotein.models.quantize import quantize_dynamic, compare_models
+
+
+def main():
+    args = build_parser(__doc__).parse_args()
+    base_rss = rss_mb()
+    model, alphabet = build_model(args)
+    fp32_rss = rss_mb() - base_rss
+    qmodel = quantize_dynamic(model)
+    gc.collect()
+    print(f"weights RSS  fp32 {fp32_rss:8.1f} MB  int8 + fp32 copy {rss_mb() - base_rss:8.1f} MB")
+    fp32_bytes = sum(t.numel() * t.element_size() for t in model.state_dict().values())
+    int8_bytes = len(_serialized(qmodel))
+    print(f"state dict   fp32 {fp32_bytes / 2 ** 20:8.1f} MB  int8 {int8_bytes / 2 ** 20:8.1f} MB")
+
+    _, masked_tokens, target_tokens = masked_batch(args.batch_size, args.lengths[0])
+    report = compare_models(model, qmodel, masked_tokens, target_tokens, alphabet.padding_idx)
+    for key, value in report.items():
+        print(f"{key:24s} {value:.4f}")
+
+    print(f"{'length':>8s} {'fp32 ms':>10s} {'int8 ms':>10s} {'speedup':>8s}")
+    for length in args.lengths:
+        origin_tokens, _, _ = masked_batch(args.batch_size, length)
+        with torch.no_grad():
+            t_fp32 = timeit(lambda: model(origin_tokens), args.repeat)
+            t_int8 = timeit(lambda: qmodel(origin_tokens), args.repeat)
+        print(f"{length:8d} {t_fp32 * 1e3:10.1f} {t_int8 * 1e3:10.1f} {t_fp32 / t_int8:8.2f}")
+
+
+def _serialized(model) -> bytes:
+    import io
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getvalue()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Rotary embeddings: the rebuilt full-width tables with ``rotate_half`` against the cached half-width tables, on
+batches of varying length, and a rotary ``TransformerLayer`` on the eager attention against the SDPA path.
+
+    python benchmark/bench_rotary.py --embed_dim 1280 --attention_heads 20 --lengths 128 256 512 1022
+"""
+import random
+
+import torch
+
+from common import build_parser, timeit
+from openprotein.layers import RotaryEmbedding, TransformerLayer
+from openprotein.layers.embedding import apply_rotary_pos_emb
+
+
+def rebuilt(rotary, q, k):
+    # the previous implementation: new tables on every length change
+    t = torch.arange(k.size(-2), device=k.device).type_as(rotary.inv_freq)
+    freqs = torch.einsum("i,j->ij", t, rotary.inv_freq)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    cos, sin = emb.cos()[None], emb.sin()[None]
+    return apply_rotary_pos_emb(q, cos, sin), apply_rotary_pos_emb(k, cos, sin)
+
+
+def main():
+    args = build_parser(__doc__).parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    head_dim = args.embed_dim // args.attention_heads
+    rotary = RotaryEmbedding(head_dim)
+    layer = TransformerLayer(args.embed_dim, args.ffn_embed_dim, args.attention_heads, add_bias_kv=False,
+                             use_rotary_embeddings=True).eval()
+    rng = random.Random(0)
+
+    print(f"{'length':>7s} {'rebuilt ms':>11s} {'cached ms':>10s} {'eager layer ms':>15s} {'sdpa layer ms':>14s}")
+    for length in args.lengths:
+        # a different length on every call, as with length-sorted batches
+        shapes = [rng.randint(length // 2, length) for _ in range(8)]
+        qs = [torch.randn(args.batch_size * args.attention_heads, n, head_dim) for n in shapes]
+        x = torch.randn(length, args.batch_size, args.embed_dim)
+
+        def run(fn):
+            with torch.inference_mode():
+                for q in qs:
+                    fn(rotary, q, q)
+
+        rebuilt_seconds = timeit(lambda: run(rebuilt), args.repeat) / len(qs)
+        cached_seconds = timeit(lambda: run(RotaryEmbedding.forward), args.repeat) / len(qs)
+        with torch.inference_mode():
+            eager_seconds = timeit(lambda: layer(x, need_head_weights=True), args.repeat)
+            sdpa_seconds = timeit(lambda: layer(x), args.repeat)
+        print(f"{length:7d} {rebuilt_seconds * 1e3:11.3f} {cached_seconds * 1e3:10.3f} {eager_seconds * 1e3:15.1f} "
+              f"{sdpa_seconds * 1e3:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
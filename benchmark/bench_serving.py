@@ -0,0 +1,45 @@
+"""
+Load test of the dynamic batching inference server: concurrent clients send embedding requests of
+random lengths, for every worker pool configuration ``workers x threads``.
+
+    python benchmark/bench_serving.py --pools 1x8 2x4 4x2 8x1 --num_requests 2000 --clients 32 --max_tokens 8192
+"""
+import time
+import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from common import build_parser, build_model, random_sequences
+from openprotein.serving import InferenceServer
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--pools", default=["1x4", "2x2", "4x1"], nargs="+", help="workers x threads per worker")
+    parser.add_argument("--num_requests", default=500, type=int)
+    parser.add_argument("--clients", default=16, type=int, help="concurrent clients")
+    parser.add_argument("--max_tokens", default=4096, type=int)
+    parser.add_argument("--max_wait", default=0.005, type=float)
+    args = parser.parse_args()
+    rng = random.Random(0)
+    lengths = [rng.choice(args.lengths) // rng.choice([1, 2, 4]) for _ in range(args.num_requests)]
+    sequences = [random_sequences(1, length, seed=i)[0] for i, length in enumerate(lengths)]
+    builder = functools.partial(build_model, args)
+
+    print(f"{'pool':>6s} {'req/s':>8s} {'p50 ms':>7s} {'p95 ms':>7s} {'queue p95 ms':>13s} {'fill':>5s} {'batches':>8s}")
+    for pool in args.pools:
+        workers, threads = map(int, pool.split("x"))
+        with InferenceServer(builder, num_workers=workers, threads_per_worker=threads, max_tokens=args.max_tokens,
+                             max_wait=args.max_wait) as server:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.clients) as clients:
+                list(clients.map(server.embed, sequences))
+            elapsed = time.perf_counter() - start
+            metrics = server.metrics()
+        print(f"{pool:>6s} {len(sequences) / elapsed:8.1f} {metrics['latency_p50'] * 1e3:7.1f} "
+              f"{metrics['latency_p95'] * 1e3:7.1f} {metrics['queue_latency_p95'] * 1e3:13.1f} "
+              f"{metrics['batch_fill_ratio']:5.2f} {metrics['batches']:8d}")
+
+
+if __name__ == "__main__":
+    main()
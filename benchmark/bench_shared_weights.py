@@ -0,0 +1,54 @@
+"""
+Memory of an inference worker pool: every worker building its own weights against every worker
+mapping one flat weight file. Reports the proportional set size (PSS, shared pages divided among
+the processes mapping them) summed over the workers.
+
+    python benchmark/bench_shared_weights.py --num_workers 8 --weights /dev/shm/esm1b.bin
+"""
+import os
+import functools
+import tempfile
+
+from common import build_parser, build_model, random_sequences
+from openprotein.models import save_flat_weights, FlatWeightsBuilder
+from openprotein.serving import InferenceServer
+
+
+def memory_mb(pid: int) -> dict:
+    """
+    RSS and PSS of a process in MB, from ``/proc/<pid>/smaps_rollup``
+    """
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ("Rss:", "Pss:"):
+                values[fields[0][:-1].lower()] = int(fields[1]) / 2 ** 10
+    return values
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--num_workers", default=4, type=int)
+    parser.add_argument("--weights", default=None, help="flat weight file, default a temporary file")
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+    weights_mb = sum(p.numel() * p.element_size() for p in model.parameters()) / 2 ** 20
+    path = args.weights or os.path.join(tempfile.mkdtemp(), "weights.bin")
+    save_flat_weights(model, path)
+    del model
+
+    builders = {"private": functools.partial(build_model, args), "mapped": FlatWeightsBuilder(path, alphabet)}
+    sequences = random_sequences(2 * args.num_workers, max(args.lengths))
+    print(f"weights {weights_mb:.1f} MB, {args.num_workers} workers")
+    print(f"{'weights':>8s} {'total RSS MB':>13s} {'total PSS MB':>13s}")
+    for name, builder in builders.items():
+        with InferenceServer(builder, num_workers=args.num_workers, threads_per_worker=1, max_batch_size=1) as server:
+            for future in [server.submit("embedding", sequence) for sequence in sequences]:
+                future.result()
+            memory = [memory_mb(worker.pid) for worker in server._workers]
+        print(f"{name:>8s} {sum(m['rss'] for m in memory):13.1f} {sum(m['pss'] for m in memory):13.1f}")
+
+
+if __name__ == "__main__":
+    main()
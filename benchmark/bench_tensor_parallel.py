@@ -0,0 +1,60 @@
+"""
+Latency of a single long sequence with the transformer layers split over 1, 2, 4... gloo processes,
+every process with ``total_threads / world_size`` torch threads. Pin one process per NUMA node,
+e.g. by running under ``numactl --interleave=all`` or setting the affinity per rank.
+
+    python benchmark/bench_tensor_parallel.py --world_sizes 1 2 --total_threads 64 --lengths 1022
+"""
+import os
+import socket
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from common import build_parser, build_model, masked_batch, timeit
+from openprotein.models import save_flat_weights, load_tensor_parallel
+
+
+def run_rank(rank, world_size, port, args, path):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.set_num_threads(max(args.total_threads // world_size, 1))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    _, alphabet = build_model(args)
+    model = load_tensor_parallel(args, alphabet, path)
+    for length in args.lengths:
+        tokens, _, _ = masked_batch(1, length)
+
+        def forward():
+            with torch.inference_mode():
+                model(tokens, repr_layers=[args.num_layers], return_logits=False)
+            dist.barrier()
+
+        seconds = timeit(forward, args.repeat)
+        if rank == 0:
+            print(f"{world_size:6d} {length:6d} {seconds * 1e3:10.1f}", flush=True)
+    dist.destroy_process_group()
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--world_sizes", default=[1, 2], type=int, nargs="+")
+    parser.add_argument("--total_threads", default=os.cpu_count(), type=int)
+    args = parser.parse_args()
+    model, _ = build_model(args)
+    path = os.path.join(tempfile.mkdtemp(), "weights.bin")
+    save_flat_weights(model, path, column_major=True)
+    del model
+
+    print(f"{'ranks':>6s} {'length':>6s} {'latency ms':>10s}")
+    for world_size in args.world_sizes:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        mp.spawn(run_rank, args=(world_size, port, args, path), nprocs=world_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Throughput of variant effect scoring: one masked forward per mutant against the batched
+masked-marginals and the single-forward wt-marginals strategies of ``VariantScorer``.
+
+    python benchmark/bench_variant.py --lengths 300 --num_mutants 2000 --max_tokens 8192
+"""
+import random
+import time
+
+import torch
+
+from common import build_parser, build_model, random_sequences, AMINO_ACIDS
+from openprotein.data import BatchConverter
+from openprotein.piplines import VariantScorer
+
+
+def random_mutants(sequence: str, num: int, max_mutations: int = 3, seed: int = 0):
+    rng = random.Random(seed)
+    mutants = []
+    for _ in range(num):
+        positions = sorted(rng.sample(range(len(sequence)), rng.randint(1, max_mutations)))
+        mutants.append(":".join(
+            f"{sequence[p]}{p + 1}{rng.choice(AMINO_ACIDS.replace(sequence[p], ''))}" for p in positions
+        ))
+    return mutants
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--num_mutants", default=500, type=int)
+    parser.add_argument("--max_tokens", default=8192, type=int)
+    parser.add_argument("--naive_limit", default=50, type=int, help="mutants timed with the naive loop")
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+    converter = BatchConverter(alphabet)
+
+    print(f"{'length':>6s} {'strategy':>17s} {'mutants/s':>10s} {'forwards':>9s}")
+    for length in args.lengths:
+        sequence = random_sequences(1, length)[0]
+        mutants = random_mutants(sequence, args.num_mutants)
+
+        tokens = converter([sequence])
+        start = time.perf_counter()
+        with torch.inference_mode():
+            for mutant in mutants[:args.naive_limit]:
+                for position in [int(m[1:-1]) for m in mutant.split(":")]:
+                    masked = tokens.clone()
+                    masked[0, position] = alphabet.mask_idx
+                    model(masked)
+        naive = args.naive_limit / (time.perf_counter() - start)
+        print(f"{length:6d} {'naive':>17s} {naive:10.1f} {'':>9s}")
+
+        for strategy in VariantScorer.STRATEGIES:
+            scorer = VariantScorer(model, alphabet, strategy=strategy, max_tokens=args.max_tokens)
+            scorer.score(sequence, mutants)
+            print(f"{length:6d} {strategy:>17s} {scorer.stats['mutants_per_second']:10.1f} "
+                  f"{scorer.stats['forwards']:9d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+Throughput of sliding-window inference on sequences longer than ``max_positions``: windows per sequence,
+latency and residues per second of ``--batch_size`` sequences, per window overlap.
+
+    python benchmark/bench_window.py --lengths 1500 3000 6000 --overlaps 128 256 512 --batch_size 4
+"""
+from common import build_parser, build_model, random_sequences, timeit
+from openprotein.models import SlidingWindowEsm1b
+
+
+def main():
+    parser = build_parser(__doc__)
+    parser.add_argument("--overlaps", default=[64, 256], type=int, nargs="+")
+    parser.add_argument("--window_batch_size", default=8, type=int, help="windows per forward")
+    parser.add_argument("--contacts", action="store_true", help="also stitch the contacts")
+    args = parser.parse_args()
+    model, alphabet = build_model(args)
+
+    print(f"{'overlap':>7s} {'length':>6s} {'windows':>7s} {'latency ms':>10s} {'residues/s':>10s}")
+    for overlap in args.overlaps:
+        windowed = SlidingWindowEsm1b(model, alphabet, overlap=overlap, batch_size=args.window_batch_size)
+        for length in args.lengths:
+            sequences = random_sequences(args.batch_size, length)
+            seconds = timeit(lambda: windowed(sequences, repr_layers=[args.num_layers], return_logits=False,
+                                              return_contacts=args.contacts), args.repeat)
+            print(f"{overlap:7d} {length:6d} {len(windowed.windows(length)):7d} {seconds * 1e3:10.1f} "
+                  f"{args.batch_size * length / seconds:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Shared helpers of the benchmark scripts.
+
+Every script builds the model from the ``ProteinBertModel`` command line arguments, so the
+same script runs on a small config for a quick check or on the full 33-layer ESM-1b.
+"""
+import os
+import time
+import random
+import argparse
+import resource
+from typing import *
+
+import torch
+
+from openprotein.data import Alphabet, MaskedConverter
+from openprotein.models import Esm1b
+
+PROTEINSEQ_TOKS = {
+    'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+             'X', 'B', 'U', 'Z', 'O', '.', '-']
+}
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def build_parser(description: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    Esm1b.add_args(parser)
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--lengths", default=[128, 256, 512], type=int, nargs="+", help="sequence lengths")
+    parser.add_argument("--repeat", default=5, type=int, help="timed iterations per measure")
+    parser.add_argument("--threads", default=None, type=int, help="torch intra-op threads")
+    return parser
+
+
+def build_model(args) -> Tuple[Esm1b, Alphabet]:
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    alphabet = Alphabet.build_alphabet(PROTEINSEQ_TOKS)
+    return Esm1b(args, alphabet).eval(), alphabet
+
+
+def random_sequences(num: int, length: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return ["".join(rng.choice(AMINO_ACIDS) for _ in range(length)) for _ in range(num)]
+
+
+def masked_batch(num: int, length: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    converter = MaskedConverter.build_convert(PROTEINSEQ_TOKS)
+    return converter(random_sequences(num, length))
+
+
+def timeit(fn: Callable, repeat: int, warmup: int = 1) -> float:
+    """
+    Median wall time of ``fn`` in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def rss_mb() -> float:
+    """
+    Current resident set size of the process in MB
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
@@ -1,7 +1,9 @@
 from .uniref import Uniref
-from .process import MaskedConverter, Alphabet
+from .process import MaskedConverter, Alphabet, BatchConverter
 from .dataset import DataFactory
+from .fasta import read_fasta
+from .sampler import TokenBudgetBatchSampler
 
 __all__ = [
-    "Uniref", "MaskedConverter", "Alphabet", "DataFactory"
+    "Uniref", "MaskedConverter", "Alphabet", "BatchConverter", "DataFactory", "read_fasta", "TokenBudgetBatchSampler"
 ]
\ No newline at end of file
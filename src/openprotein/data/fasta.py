@@ -0,0 +1,32 @@
+from typing import *
+
+
+def read_fasta(path: str) -> Iterator[Tuple[str, str]]:
+    """
+    Read a FASTA file lazily, one record at a time
+
+    Args:
+        path (str): path for the FASTA file
+
+    Returns:
+        an iterator of (name, sequence) tuples, the name is the first word of the header line
+
+    Examples:
+        >>> for name, sequence in read_fasta("./resources/uniref50.fasta"):
+        >>>     print(name, len(sequence))
+    """
+    name, chunks = None, []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(">"):
+                if name is not None:
+                    yield name, "".join(chunks)
+                name = line[1:].split()[0] if len(line) > 1 else ""
+                chunks = []
+            else:
+                chunks.append(line)
+    if name is not None:
+        yield name, "".join(chunks)
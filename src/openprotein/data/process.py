@@ -341,4 +341,66 @@ class Alphabet(object):
         return tokenized_text
 
     def encode(self, text):
-        return [self.tok_to_idx[tok] for tok in self.tokenize(text)]
\ No newline at end of file
+        return [self.tok_to_idx[tok] for tok in self.tokenize(text)]
+
+class BatchConverter(object):
+    """
+    Convert a batch of raw sequences into a padded token tensor for inference, no masking is applied.
+
+    Args:
+        alphabet (Alphabet): the alphabet of the model
+        truncation_seq_length (int, optional): sequences longer than this are truncated
+
+    Examples:
+        >>> converter = BatchConverter(alphabet)
+        >>> tokens = converter(["MKTAYIAK", "MKV"])
+        >>> tokens.shape
+        torch.Size([2, 10])
+    """
+
+    def __init__(self, alphabet: Alphabet, truncation_seq_length: Optional[int] = None):
+        self.alphabet = alphabet
+        self.truncation_seq_length = truncation_seq_length
+
+    def tokenize(self, sequence: str) -> List[str]:
+        # plain residue strings are split per character, tokenize is only needed for special tokens
+        if "<" in sequence:
+            return self.alphabet.tokenize(sequence)
+        return list(sequence)
+
+    def truncate(self, sequence: str) -> str:
+        """
+        The sequence cut to its first ``truncation_seq_length`` tokens, the string :meth:`encode` actually
+        encodes, to key caches and deduplication with
+        """
+        if self.truncation_seq_length is None:
+            return sequence
+        if "<" not in sequence:
+            return sequence[:self.truncation_seq_length]
+        return "".join(self.tokenize(sequence)[:self.truncation_seq_length])
+
+    def encode(self, sequence: str) -> List[int]:
+        if "<" in sequence:
+            encoded = self.alphabet.encode(sequence)
+        else:
+            encoded = [self.alphabet.tok_to_idx.get(tok, self.alphabet.unk_idx) for tok in sequence]
+        if self.truncation_seq_length is not None:
+            encoded = encoded[:self.truncation_seq_length]
+        return encoded
+
+    def __call__(self, raw_batch: Sequence[str]) -> torch.Tensor:
+        encoded_sequences = [self.encode(sequence) for sequence in raw_batch]
+        max_length = max(len(encoded_sequence) for encoded_sequence in encoded_sequences)
+        offset = int(self.alphabet.prepend_bos)
+        tokens = torch.full(
+            (len(encoded_sequences), max_length + offset + int(self.alphabet.append_eos)),
+            self.alphabet.padding_idx,
+            dtype=torch.int64,
+        )
+        for i, encoded_sequence in enumerate(encoded_sequences):
+            if self.alphabet.prepend_bos:
+                tokens[i, 0] = self.alphabet.cls_idx
+            tokens[i, offset:len(encoded_sequence) + offset] = torch.tensor(encoded_sequence, dtype=torch.int64)
+            if self.alphabet.append_eos:
+                tokens[i, len(encoded_sequence) + offset] = self.alphabet.eos_idx
+        return tokens
@@ -0,0 +1,61 @@
+from typing import *
+
+
+class TokenBudgetBatchSampler(object):
+    """
+    Group sequences of similar length into batches whose padded size stays under a token budget.
+
+    The cost of a batch is ``batch_size * (longest_length + extra_tokens)``, which is what the model
+    actually computes on once the batch is padded. Sorting by length keeps padding small, so the budget
+    is mostly spent on real residues.
+
+    Args:
+        lengths (Sequence[int]): length of every sequence, in dataset order
+        max_tokens (int): upper bound of the padded tokens of one batch.
+            A sequence longer than the budget is put in a batch on its own.
+        max_batch_size (int, optional): upper bound of the number of sequences in one batch
+        extra_tokens (int): tokens added to every sequence by the converter, 2 for <cls> and <eos>
+        sort (bool): sort by length (longest first) before batching, set to False to keep the input order
+
+    Examples:
+        >>> sampler = TokenBudgetBatchSampler([5, 300, 20, 290], max_tokens=700)
+        >>> list(sampler)
+        [[1, 3], [2, 0]]
+        >>> dl = DataLoader(dataset, batch_sampler=sampler, collate_fn=converter)
+    """
+
+    def __init__(self, lengths: Sequence[int], max_tokens: int, max_batch_size: Optional[int] = None,
+                 extra_tokens: int = 2, sort: bool = True):
+        if max_tokens <= 0:
+            raise ValueError(f"max_tokens must be greater than zero, get {max_tokens}")
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.extra_tokens = extra_tokens
+        self.sort = sort
+        self._batches = self._build_batches()
+
+    def _build_batches(self) -> List[List[int]]:
+        order = list(range(len(self.lengths)))
+        if self.sort:
+            order.sort(key=lambda i: self.lengths[i], reverse=True)
+
+        batches, batch, longest = [], [], 0
+        for index in order:
+            size = self.lengths[index] + self.extra_tokens
+            new_longest = max(longest, size)
+            too_many = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (new_longest * (len(batch) + 1) > self.max_tokens or too_many):
+                batches.append(batch)
+                batch, new_longest = [], size
+            batch.append(index)
+            longest = new_longest
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self._batches)
+
+    def __len__(self) -> int:
+        return len(self._batches)
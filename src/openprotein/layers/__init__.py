@@ -1,8 +1,14 @@
 from .attention import MultiheadAttention
-from .embedding import RotaryEmbedding, LearnedPositionalEmbedding, ContactPredictionHead, RobertaLMHead
+from .embedding import RotaryEmbedding, LearnedPositionalEmbedding, ContactPredictionHead, RobertaLMHead, RegressionHead
 from .transformerLayer import TransformerLayer
+from .normalization import ESM1bLayerNorm
+from .parallel import ParallelMultiheadAttention, ParallelTransformerLayer
+from .lora import LoRALinear
+from .efficient_attention import PerformerAttention, LocalGlobalAttention, build_attention
 
 __all__ = [
     "MultiheadAttention", "RotaryEmbedding", "LearnedPositionalEmbedding", "ContactPredictionHead", "RobertaLMHead",
-    "TransformerLayer",
+    "TransformerLayer", "ESM1bLayerNorm", "ParallelMultiheadAttention", "ParallelTransformerLayer",
+    "PerformerAttention", "LocalGlobalAttention", "build_attention", "LoRALinear",
+    "RegressionHead",
 ]
\ No newline at end of file
@@ -1,17 +1,70 @@
 from typing import *
 import math
+import uuid
 
 import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
 from torch.nn import Parameter
 
+from ..utils.precision import is_autocast_enabled, fp32
+from .embedding import RotaryEmbedding
+
 def utils_softmax(x, dim: int, onnx_trace: bool = False):
     if onnx_trace:
         return F.softmax(x.float(), dim=dim)
+    elif x.dtype != torch.float32 and is_autocast_enabled(x.device.type):
+        with fp32(x.device.type):
+            return F.softmax(x.float(), dim=dim)
     else:
         return F.softmax(x, dim=dim, dtype=torch.float32)
 
+def chunked_attention(q: Tensor, k: Tensor, v: Tensor, key_padding_mask: Optional[Tensor] = None,
+                      chunk_size: int = 256) -> Tensor:
+    """
+    Softmax attention computed in blocks of ``chunk_size`` queries and keys with an online softmax: the running
+    maximum and sum of every query row are rescaled as the key blocks go by, so at most a
+    ``[B * H, chunk_size, chunk_size]`` block of scores exists at a time instead of the ``[B * H, T, S]`` matrix.
+
+    Args:
+        q (Tensor): (B * H, T, D) queries, already scaled
+        k (Tensor): (B * H, S, D) keys
+        v (Tensor): (B * H, S, D) values
+        key_padding_mask (Tensor, optional): (B, S), True at the padded keys
+        chunk_size (int): queries and keys per block
+
+    Returns:
+        (B * H, T, D) attention output, the same as ``softmax(q @ k^T) @ v``
+    """
+    heads, tgt_len, head_dim = q.size()
+    src_len = k.size(1)
+    if key_padding_mask is not None:
+        # (B, S) => (B * H, 1, S)
+        key_padding_mask = key_padding_mask.to(torch.bool).repeat_interleave(
+            heads // key_padding_mask.size(0), dim=0).unsqueeze(1)
+    output = torch.empty_like(q)
+    for q_start in range(0, tgt_len, chunk_size):
+        q_block = q[:, q_start:q_start + chunk_size]
+        rows = q_block.size(1)
+        row_max = q.new_full((heads, rows, 1), float("-inf"), dtype=torch.float32)
+        row_sum = q.new_zeros((heads, rows, 1), dtype=torch.float32)
+        acc = q.new_zeros((heads, rows, head_dim), dtype=torch.float32)
+        for k_start in range(0, src_len, chunk_size):
+            scores = torch.bmm(q_block, k[:, k_start:k_start + chunk_size].transpose(1, 2)).float()
+            if key_padding_mask is not None:
+                scores.masked_fill_(key_padding_mask[:, :, k_start:k_start + chunk_size], float("-inf"))
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # rows without any unmasked key so far keep a zero sum, avoid -inf - -inf
+            safe_max = new_max.masked_fill(new_max.isinf(), 0.0)
+            probs = torch.exp(scores - safe_max)
+            rescale = torch.exp(row_max - safe_max)
+            row_sum = row_sum * rescale + probs.sum(dim=-1, keepdim=True)
+            acc = acc * rescale + torch.bmm(probs.to(v.dtype), v[:, k_start:k_start + chunk_size]).float()
+            row_max = new_max
+        output[:, q_start:q_start + rows] = (acc / row_sum).to(output.dtype)
+    return output
+
+
 class MultiheadAttention(nn.Module):
     """Multi-headed attention.
     See "Attention Is All You Need" for more details.
@@ -30,6 +83,7 @@ class MultiheadAttention(nn.Module):
         self_attention: bool = False,
         encoder_decoder_attention: bool = False,
         use_rotary_embeddings: bool = False,
+        max_positions: int = 1024,
     ):
         super().__init__()
         self.embed_dim = embed_dim
@@ -71,7 +125,9 @@ class MultiheadAttention(nn.Module):
         self.onnx_trace = False
         self.rot_emb = None
         if use_rotary_embeddings:
-            self.rot_emb = RotaryEmbedding(dim=self.head_dim)
+            self.rot_emb = RotaryEmbedding(dim=self.head_dim, max_positions=max_positions)
+
+        self._incremental_state_id = str(uuid.uuid4())
 
         self.enable_torch_version = False
         if hasattr(F, "multi_head_attention_forward"):
@@ -82,6 +138,56 @@ class MultiheadAttention(nn.Module):
     def prepare_for_onnx_export_(self):
         self.onnx_trace = True
 
+    def _plain_projections(self) -> bool:
+        return all(
+            type(proj) is nn.Linear for proj in (self.q_proj, self.k_proj, self.v_proj, self.out_proj)
+        )
+
+    def chunked_forward(self, query: Tensor, key_padding_mask: Optional[Tensor] = None,
+                        chunk_size: int = 256) -> Tensor:
+        """
+        Self-attention with memory linear in the length, see :func:`chunked_attention`; the output of
+        :meth:`forward` without the attention weights, Time x Batch x Channel
+        """
+        assert not self.add_zero_attn, "zero attention is not supported by the chunked attention"
+        tgt_len, bsz, embed_dim = query.size()
+        q = self.q_proj(query) * self.scaling
+        k = self.k_proj(query)
+        v = self.v_proj(query)
+        if self.bias_k is not None:
+            k = torch.cat([k, self.bias_k.repeat(1, bsz, 1)])
+            v = torch.cat([v, self.bias_v.repeat(1, bsz, 1)])
+            if key_padding_mask is not None:
+                key_padding_mask = torch.cat(
+                    [key_padding_mask, key_padding_mask.new_zeros(key_padding_mask.size(0), 1)], dim=1
+                )
+        q = q.contiguous().view(tgt_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        k = k.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        v = v.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        if self.rot_emb:
+            q, k = self.rot_emb(q, k)
+        attn = chunked_attention(q, k, v, key_padding_mask, chunk_size)
+        attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        return self.out_proj(attn)
+
+    def _rotary_sdpa_forward(self, query: Tensor, key_padding_mask: Optional[Tensor]) -> Tensor:
+        # rotary self-attention through F.scaled_dot_product_attention, without the attention weights
+        tgt_len, bsz, embed_dim = query.size()
+
+        def heads(x):
+            # (T, B, E) => (B, H, T, D)
+            return x.view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+
+        q, k = self.rot_emb(heads(self.q_proj(query)), heads(self.k_proj(query)))
+        v = heads(self.v_proj(query))
+        mask = None
+        if key_padding_mask is not None:
+            mask = ~key_padding_mask.to(torch.bool)[:, None, None, :]
+        attn = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                              dropout_p=self.dropout if self.training else 0.0)
+        attn = attn.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        return self.out_proj(attn)
+
     def reset_parameters(self):
         if self.qkv_same_dim:
             # Empirically observed the convergence to be much better with
@@ -138,6 +244,24 @@ class MultiheadAttention(nn.Module):
         assert embed_dim == self.embed_dim
         assert list(query.size()) == [tgt_len, bsz, embed_dim]
 
+        if (
+            self.rot_emb is not None
+            and key is query
+            and value is query
+            and incremental_state is None
+            and not static_kv
+            and not need_weights
+            and not before_softmax
+            and attn_mask is None
+            and self.bias_k is None
+            and not self.add_zero_attn
+            and not self.onnx_trace
+            and not torch.jit.is_scripting()
+            # SDPA would run the softmax in reduced precision
+            and not is_autocast_enabled(query.device.type)
+        ):
+            return self._rotary_sdpa_forward(query, key_padding_mask), None
+
         if (
             not self.rot_emb
             and self.enable_torch_version
@@ -148,6 +272,10 @@ class MultiheadAttention(nn.Module):
             # treats bias in linear module as method.
             and not torch.jit.is_scripting()
             and not need_head_weights
+            # quantized or adapted projections don't expose a plain weight tensor
+            and self._plain_projections()
+            # the fused kernel would run the softmax in reduced precision
+            and not is_autocast_enabled(query.device.type)
         ):
             assert key is not None and value is not None
             return F.multi_head_attention_forward(
@@ -413,6 +541,27 @@ class MultiheadAttention(nn.Module):
             empty_result: Dict[str, Optional[Tensor]] = {}
             return empty_result
 
+    def get_incremental_state(
+        self, incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]], key: str
+    ) -> Optional[Dict[str, Optional[Tensor]]]:
+        """Helper for getting incremental state for an nn.Module."""
+        full_key = "{}.{}".format(self._incremental_state_id, key)
+        if incremental_state is None or full_key not in incremental_state:
+            return None
+        return incremental_state[full_key]
+
+    def set_incremental_state(
+        self,
+        incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]],
+        key: str,
+        value: Dict[str, Optional[Tensor]],
+    ) -> Optional[Dict[str, Dict[str, Optional[Tensor]]]]:
+        """Helper for setting incremental state for an nn.Module."""
+        if incremental_state is not None:
+            full_key = "{}.{}".format(self._incremental_state_id, key)
+            incremental_state[full_key] = value
+        return incremental_state
+
     def _set_input_buffer(
         self,
         incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
@@ -0,0 +1,237 @@
+import math
+from typing import *
+
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+
+from openprotein.layers.attention import MultiheadAttention
+
+ATTENTIONS = ("full", "performer", "local")
+
+
+def orthogonal_random_features(num_features: int, head_dim: int, generator: Optional[torch.Generator] = None
+                               ) -> Tensor:
+    """
+    (num_features, head_dim) Gaussian projections, orthogonal within every block of ``head_dim`` rows and with
+    the row norms of Gaussian vectors
+    """
+    blocks = []
+    for _ in range(math.ceil(num_features / head_dim)):
+        q, _ = torch.linalg.qr(torch.randn(head_dim, head_dim, generator=generator))
+        blocks.append(q.t())
+    norms = torch.randn(num_features, head_dim, generator=generator).norm(dim=1, keepdim=True)
+    return torch.cat(blocks)[:num_features] * norms
+
+
+class _ApproximateAttention(MultiheadAttention):
+    """
+    Self-attention with the projections and state dict of :class:`MultiheadAttention`, so the weights of an
+    exact model load as they are, and an approximate kernel in ``_attend``
+    """
+
+    def __init__(self, embed_dim, num_heads, add_bias_kv: bool = False, use_rotary_embeddings: bool = False,
+                 max_positions: int = 1024):
+        if add_bias_kv:
+            raise ValueError(f"{type(self).__name__} does not support bias_kv")
+        super().__init__(embed_dim, num_heads, add_bias_kv=False, add_zero_attn=False,
+                         use_rotary_embeddings=use_rotary_embeddings, max_positions=max_positions)
+
+    def forward(self, query, key=None, value=None, key_padding_mask=None, incremental_state=None,
+                need_weights=True, static_kv=False, attn_mask=None, before_softmax=False,
+                need_head_weights=False) -> Tuple[Tensor, Optional[Tensor]]:
+        """
+        Self-attention, Time x Batch x Channel. The approximate attention matrix costs O(T^2) and is only built
+        for ``need_head_weights``, in the (H, B, T, S) layout of :class:`MultiheadAttention`; otherwise the
+        weights are None
+        """
+        if incremental_state is not None or attn_mask is not None or before_softmax:
+            raise ValueError(f"{type(self).__name__} only supports self-attention with a key padding mask")
+        tgt_len, bsz, embed_dim = query.size()
+        q = self.q_proj(query) * self.scaling
+        k = self.k_proj(query)
+        v = self.v_proj(query)
+        q = q.contiguous().view(tgt_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        k = k.contiguous().view(tgt_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        v = v.contiguous().view(tgt_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        if self.rot_emb:
+            q, k = self.rot_emb(q, k)
+        if key_padding_mask is not None:
+            # (B, S) => (B * H, S)
+            key_padding_mask = key_padding_mask.to(torch.bool).repeat_interleave(self.num_heads, dim=0)
+        attn, weights = self._attend(q, k, v, key_padding_mask, need_head_weights)
+        attn = attn.to(v.dtype).transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        attn = self.out_proj(attn)
+        if weights is not None:
+            weights = weights.view(bsz, self.num_heads, tgt_len, tgt_len).type_as(attn).transpose(1, 0)
+        return attn, weights
+
+    def chunked_forward(self, query: Tensor, key_padding_mask: Optional[Tensor] = None,
+                        chunk_size: int = 256) -> Tensor:
+        # already linear in the length
+        return self(query, key_padding_mask=key_padding_mask, need_weights=False)[0]
+
+    def _attend(self, q, k, v, key_padding_mask, need_weights) -> Tuple[Tensor, Optional[Tensor]]:
+        raise NotImplementedError
+
+
+class PerformerAttention(_ApproximateAttention):
+    """
+    Softmax attention approximated with positive orthogonal random features (FAVOR+, Performer): with
+    ``phi(x) = exp(W x - |x|^2 / 2) / sqrt(m)``, ``softmax(q k^T) v`` is approximated by
+    ``phi(q) (phi(k)^T v)`` normalized by ``phi(q) phi(k)^T 1``, O(T * m * head_dim) time and O(T * m) memory.
+
+    The features are drawn once from ``feature_seed`` and are not part of the state dict; the error shrinks
+    as ``num_features`` grows, and fine-tuning lets the model adapt to a fixed draw.
+
+    Args:
+        embed_dim (int): embedding dimension
+        num_heads (int): number of heads
+        num_features (int): random features per head
+        feature_seed (int): seed of the random features
+    """
+
+    def __init__(self, embed_dim, num_heads, add_bias_kv: bool = False, use_rotary_embeddings: bool = False,
+                 num_features: int = 256, feature_seed: int = 0, max_positions: int = 1024):
+        super().__init__(embed_dim, num_heads, add_bias_kv, use_rotary_embeddings, max_positions)
+        self.num_features = num_features
+        self.feature_seed = feature_seed
+        self.register_buffer("features", torch.empty(num_features, self.head_dim), persistent=False)
+        self.redraw_features()
+
+    def redraw_features(self, seed: Optional[int] = None):
+        """
+        Draw new random features, from ``seed`` or the seed given at construction
+        """
+        if self.features.is_meta:
+            # drawn when the module is materialized
+            return
+        generator = torch.Generator().manual_seed(self.feature_seed if seed is None else seed)
+        features = orthogonal_random_features(self.num_features, self.head_dim, generator)
+        self.features.copy_(features)
+
+    def _apply(self, fn, *args, **kwargs):
+        # the features are not in the state dict, draw them after to_empty
+        was_meta = self.features.is_meta
+        result = super()._apply(fn, *args, **kwargs)
+        if was_meta and not self.features.is_meta:
+            with torch.no_grad():
+                self.redraw_features()
+        return result
+
+    def _feature_map(self, x: Tensor, is_query: bool) -> Tensor:
+        # exp(q.k / sqrt(d)) = E[phi(q') phi(k')] with q' = q d^-1/4, k' = k d^-1/4; q is already scaled by d^-1/2
+        x = x.float() * (self.head_dim ** 0.25 if is_query else self.head_dim ** -0.25)
+        projection = x @ self.features.float().t()
+        # the maximum cancels in the normalization: per row for the queries, per head for the keys
+        if is_query:
+            stabilizer = projection.detach().amax(dim=-1, keepdim=True)
+        else:
+            stabilizer = projection.detach().amax(dim=(-2, -1), keepdim=True)
+        # in place on the (B * H, T, m) projection, with the 1 / sqrt(m) folded into the exponent
+        shift = (x * x).sum(dim=-1, keepdim=True) / 2 + stabilizer + 0.5 * math.log(self.num_features)
+        return torch.exp(projection.sub_(shift))
+
+    def _attend(self, q, k, v, key_padding_mask, need_weights):
+        phi_q = self._feature_map(q, True)
+        phi_k = self._feature_map(k, False)
+        if key_padding_mask is not None:
+            phi_k = phi_k.masked_fill(key_padding_mask.unsqueeze(-1), 0.0)
+        kv = phi_k.transpose(1, 2) @ v.float()  # (B * H, m, D)
+        normalizer = phi_q @ phi_k.sum(dim=1).unsqueeze(-1)  # (B * H, T, 1)
+        attn = (phi_q @ kv) / normalizer
+        weights = None
+        if need_weights:
+            weights = (phi_q @ phi_k.transpose(1, 2)) / normalizer
+        return attn, weights
+
+
+class LocalGlobalAttention(_ApproximateAttention):
+    """
+    Sparse attention: every token attends to the tokens at most ``window`` positions away and to the first
+    ``global_tokens`` tokens (the ``<cls>`` token by default), and those global tokens attend to every token.
+    The scores are computed on blocks of ``window`` queries against their neighbour blocks, O(T * window) time
+    and memory; within its reach the attention is exact.
+
+    Args:
+        embed_dim (int): embedding dimension
+        num_heads (int): number of heads
+        window (int): one-sided reach of the local attention
+        global_tokens (int): number of leading tokens with global attention
+    """
+
+    def __init__(self, embed_dim, num_heads, add_bias_kv: bool = False, use_rotary_embeddings: bool = False,
+                 window: int = 64, global_tokens: int = 1, max_positions: int = 1024):
+        super().__init__(embed_dim, num_heads, add_bias_kv, use_rotary_embeddings, max_positions)
+        self.window = window
+        self.global_tokens = global_tokens
+
+    def _attend(self, q, k, v, key_padding_mask, need_weights):
+        heads, length, head_dim = q.size()
+        w, g = self.window, min(self.global_tokens, length)
+        num_blocks = math.ceil(length / w)
+        padded = num_blocks * w
+
+        # keys of block b: positions [(b - 1) w, (b + 2) w), out of range positions are masked
+        q_blocks = F.pad(q, (0, 0, 0, padded - length)).view(heads, num_blocks, w, head_dim)
+        k_blocks = F.pad(k, (0, 0, w, padded - length + w)).unfold(1, 3 * w, w).transpose(2, 3)
+        v_blocks = F.pad(v, (0, 0, w, padded - length + w)).unfold(1, 3 * w, w).transpose(2, 3)
+        scores = (q_blocks @ k_blocks.transpose(2, 3)).float()  # (B * H, blocks, w, 3w)
+
+        rows = torch.arange(padded, device=q.device).view(num_blocks, w, 1)
+        cols = (torch.arange(num_blocks, device=q.device).view(num_blocks, 1, 1) - 1) * w + torch.arange(
+            3 * w, device=q.device).view(1, 1, 3 * w)
+        # the global keys are scored once, in their own columns
+        invalid = ((rows - cols).abs() > w) | (cols < g) | (cols >= length)
+        scores = scores.masked_fill(invalid, float("-inf"))
+        if key_padding_mask is not None:
+            padding = F.pad(key_padding_mask, (w, padded - length + w), value=True).unfold(1, 3 * w, w)
+            scores = scores.masked_fill(padding.unsqueeze(2), float("-inf"))
+
+        global_scores = (q @ k[:, :g].transpose(1, 2)).float()  # (B * H, T, g)
+        if key_padding_mask is not None:
+            global_scores = global_scores.masked_fill(key_padding_mask[:, None, :g], float("-inf"))
+        global_scores = F.pad(global_scores, (0, 0, 0, padded - length)).view(heads, num_blocks, w, g)
+
+        probs = torch.softmax(torch.cat([scores, global_scores], dim=-1), dim=-1).nan_to_num(0.0)
+        local_probs, global_probs = probs[..., :3 * w], probs[..., 3 * w:]
+        attn = local_probs.to(v.dtype) @ v_blocks + global_probs.to(v.dtype) @ v[:, None, :g]
+        attn = attn.view(heads, padded, head_dim)[:, :length].float()
+
+        # rows of the global tokens attend to everything
+        full_scores = (q[:, :g] @ k.transpose(1, 2)).float()
+        if key_padding_mask is not None:
+            full_scores = full_scores.masked_fill(key_padding_mask[:, None], float("-inf"))
+        full_probs = torch.softmax(full_scores, dim=-1)
+        attn[:, :g] = full_probs @ v.float()
+
+        weights = None
+        if need_weights:
+            weights = q.new_zeros((heads, length, length), dtype=torch.float32)
+            for b in range(num_blocks):
+                start, end = b * w, min((b + 1) * w, length)
+                key_start, key_end = max(start - w, 0), min(start + 2 * w, length)
+                weights[:, start:end, key_start:key_end] = \
+                    local_probs[:, b, :end - start, key_start - (start - w):key_end - (start - w)]
+            weights[:, :, :g] = global_probs.reshape(heads, padded, g)[:, :length]
+            weights[:, :g] = full_probs
+        return attn, weights
+
+
+def build_attention(attention: str, embed_dim: int, num_heads: int, add_bias_kv: bool = False,
+                    use_rotary_embeddings: bool = False, max_positions: int = 1024, **options) -> MultiheadAttention:
+    """
+    The self-attention of a layer: "full" :class:`MultiheadAttention`, "performer" :class:`PerformerAttention`
+    or "local" :class:`LocalGlobalAttention`, ``options`` go to the approximate attentions. ``max_positions``
+    sizes the tables of the rotary embeddings
+    """
+    if attention == "full":
+        return MultiheadAttention(embed_dim, num_heads, add_bias_kv=add_bias_kv, add_zero_attn=False,
+                                  use_rotary_embeddings=use_rotary_embeddings, max_positions=max_positions)
+    if attention == "performer":
+        return PerformerAttention(embed_dim, num_heads, add_bias_kv, use_rotary_embeddings,
+                                  max_positions=max_positions, **options)
+    if attention == "local":
+        return LocalGlobalAttention(embed_dim, num_heads, add_bias_kv, use_rotary_embeddings,
+                                    max_positions=max_positions, **options)
+    raise ValueError(f"attention must be one of {ATTENTIONS}, get {attention}")
@@ -3,8 +3,10 @@ from typing import *
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torch.nn import LayerNorm as ESM1bLayerNorm
 from ..utils import gelu
+from ..utils.graph import is_static_graph
+from ..utils.precision import fp32
+from .normalization import ESM1bLayerNorm
 
 def symmetrize(x):
     "Make layer symmetric in final two dimensions, used for contact prediction."
@@ -33,6 +35,28 @@ def apply_rotary_pos_emb(x, cos, sin):
     return (x * cos) + (rotate_half(x) * sin)
 
 
+def apply_rotary(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    """
+    ``apply_rotary_pos_emb`` with the half-width tables [>= T, D / 2] of :meth:`RotaryEmbedding.cos_sin_tables`:
+    every pair of dimensions (i, i + D / 2) of ``x`` [..., T, D] is rotated by its angle, written straight into
+    the output instead of through the ``rotate_half`` copy. A lower-precision ``x`` (e.g. bf16 under autocast) is
+    rotated in the dtype of the tables and cast back
+    """
+    if x.dtype != cos.dtype:
+        return apply_rotary(x.to(cos.dtype), cos, sin).to(x.dtype)
+    cos, sin = cos[: x.size(-2)], sin[: x.size(-2)]
+    half = x.size(-1) // 2
+    x1, x2 = x[..., :half], x[..., half:]
+    out = torch.empty_like(x)
+    if torch.is_grad_enabled() and x.requires_grad:
+        out[..., :half] = torch.addcmul(x1 * cos, x2, sin, value=-1)
+        out[..., half:] = torch.addcmul(x2 * cos, x1, sin)
+    else:
+        torch.mul(x1, cos, out=out[..., :half]).addcmul_(x2, sin, value=-1)
+        torch.mul(x2, cos, out=out[..., half:]).addcmul_(x1, sin)
+    return out
+
+
 class RotaryEmbedding(torch.nn.Module):
     """
     The rotary position embeddings from RoFormer_ (Su et. al).
@@ -45,17 +69,46 @@ class RotaryEmbedding(torch.nn.Module):
     .. _GPT-NeoX: https://github.com/EleutherAI/gpt-neox
     .. warning: Please note that this embedding is not registered on purpose, as it is transformative
         (it does not create the embedding dimension) and will likely be picked up (imported) on a ad-hoc basis
+
+    The cos and sin tables are built once per device for ``max_positions`` positions (doubled when a longer input
+    comes) and sliced for every call, so batches of varying length do not rebuild them. They are kept in fp32,
+    the angles of far positions would lose their precision in bf16; a bf16 query or key is rotated in fp32 and
+    cast back. Traced, scripted and compiled graphs rebuild them from the input length, as before.
     """
 
-    def __init__(self, dim: int, *_, **__):
+    def __init__(self, dim: int, max_positions: int = 1024, *_, **__):
         super().__init__()
         # Generate and save the inverse frequency buffer (non trainable)
         inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2).float() / dim))
         self.register_buffer("inv_freq", inv_freq)
+        self.max_positions = max_positions
 
         self._seq_len_cached = None
         self._cos_cached = None
         self._sin_cached = None
+        self._tables = {}
+        self._tables_version = None
+
+    def cos_sin_tables(self, seq_len: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        [seq_len, dim / 2] fp32 cos and sin of the angles of the first ``seq_len`` positions, for
+        :func:`apply_rotary`
+        """
+        # a loaded checkpoint may bring other frequencies
+        version = (self.inv_freq.data_ptr(), self.inv_freq._version)
+        if version != self._tables_version:
+            self._tables.clear()
+            self._tables_version = version
+        tables = self._tables.get(device)
+        if tables is None or tables[0].size(0) < seq_len:
+            size = self.max_positions
+            while size < seq_len:
+                size *= 2
+            t = torch.arange(size, device=device, dtype=torch.float32)
+            freqs = torch.outer(t, self.inv_freq.to(device=device, dtype=torch.float32))
+            tables = (freqs.cos(), freqs.sin())
+            self._tables[device] = tables
+        return tables[0][:seq_len], tables[1][:seq_len]
 
     def _update_cos_sin_tables(self, x, seq_dimension=1):
         seq_len = x.shape[seq_dimension]
@@ -74,12 +127,15 @@ class RotaryEmbedding(torch.nn.Module):
         return self._cos_cached, self._sin_cached
 
     def forward(self, q: torch.Tensor, k: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        self._cos_cached, self._sin_cached = self._update_cos_sin_tables(k, seq_dimension=-2)
+        if is_static_graph():
+            self._cos_cached, self._sin_cached = self._update_cos_sin_tables(k, seq_dimension=-2)
 
-        return (
-            apply_rotary_pos_emb(q, self._cos_cached, self._sin_cached),
-            apply_rotary_pos_emb(k, self._cos_cached, self._sin_cached),
-        )
+            return (
+                apply_rotary_pos_emb(q, self._cos_cached, self._sin_cached),
+                apply_rotary_pos_emb(k, self._cos_cached, self._sin_cached),
+            )
+        cos, sin = self.cos_sin_tables(max(q.size(-2), k.size(-2)), k.device)
+        return apply_rotary(q, cos, sin), apply_rotary(k, cos, sin)
 
 class LearnedPositionalEmbedding(nn.Embedding):
     """
@@ -154,10 +210,51 @@ class ContactPredictionHead(nn.Module):
         attentions = attentions.to(
             self.regression.weight.device
         )  # attentions always float32, may need to convert to float16
-        attentions = apc(symmetrize(attentions))
+        with fp32(attentions.device.type):
+            attentions = apc(symmetrize(attentions.float()))
         attentions = attentions.permute(0, 2, 3, 1)
         return self.activation(self.regression(attentions).squeeze(3))
 
+    def top_contacts(self, weighted: torch.Tensor, row_sums: torch.Tensor, k: int, offset: int = 1,
+                     block_size: int = 256) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        The ``k`` most probable contacts (i, j), j >= i + ``offset``, of one sequence from its reduced attention
+        maps, with the values of :meth:`forward` on those pairs, without the [layers * heads, L, L] features.
+
+        The regression is linear, so the symmetrized maps are summed over the channels first; the apc
+        correction of every channel is the outer product of its row sums. The pairs are scored in blocks of
+        ``block_size`` rows, the logits and the correction of a block are [block_size, L], and only the best
+        ``k`` pairs are kept from one block to the next: neither the [L, L] probabilities or correction nor the
+        indices of the triangle are built.
+
+        Args:
+            weighted (torch.Tensor): [L, L] sum of the attention maps over the residues, weighted by
+                ``regression.weight``
+            row_sums (torch.Tensor): [layers * heads, L] row sums of the symmetrized maps ``A + A^T``
+            k (int): number of contacts, at most the number of pairs
+            offset (int): minimum separation of the pairs
+            block_size (int): rows scored at once
+
+        Returns:
+            i, j and the contact probabilities of the pairs, most probable first
+        """
+        weight = self.regression.weight.view(-1).float()
+        scaled = row_sums * (weight / row_sums.sum(-1))[:, None]
+        length = weighted.size(0)
+        columns = torch.arange(length, device=weighted.device)
+        best_logits, best_index = weighted.new_empty(0), columns.new_empty(0)
+        for start in range(0, max(length - offset, 0), block_size):
+            end = min(start + block_size, length)
+            logits = weighted[start:end] + weighted[:, start:end].t()
+            logits -= scaled[:, start:end].t() @ row_sums
+            logits.masked_fill_(columns < columns[start:end, None] + offset, float("-inf"))
+            logits, index = logits.view(-1).topk(min(k, logits.numel()))
+            best_logits, top = torch.cat([best_logits, logits]).topk(min(k, len(best_logits) + len(logits)))
+            best_index = torch.cat([best_index, index + start * length])[top]
+        if self.regression.bias is not None:
+            best_logits = best_logits + self.regression.bias.float()
+        return best_index // length, best_index % length, self.activation(best_logits)
+
 
 class RobertaLMHead(nn.Module):
     """Head for masked language modeling."""
@@ -175,4 +272,29 @@ class RobertaLMHead(nn.Module):
         x = self.layer_norm(x)
         # project back to size of vocabulary with bias
         x = F.linear(x, self.weight) + self.bias
-        return x
\ No newline at end of file
+        return x
+
+class RegressionHead(nn.Module):
+    """
+    Property head on frozen embeddings: per-residue features [B, L, E] are mean pooled over the residues of
+    ``mask`` first, then a linear layer, or an MLP with one hidden layer of ``hidden_dim``
+    """
+
+    def __init__(self, in_features: int, num_outputs: int = 1, hidden_dim: int = 0, dropout: float = 0.0):
+        super().__init__()
+        self.num_outputs = num_outputs
+        if hidden_dim:
+            self.mlp = nn.Sequential(nn.Dropout(dropout), nn.Linear(in_features, hidden_dim), nn.GELU(),
+                                     nn.Dropout(dropout), nn.Linear(hidden_dim, num_outputs))
+        else:
+            self.mlp = nn.Sequential(nn.Dropout(dropout), nn.Linear(in_features, num_outputs))
+
+    def forward(self, features, mask=None):
+        if features.dim() == 3:
+            if mask is None:
+                features = features.mean(1)
+            else:
+                mask = mask.unsqueeze(-1).to(features)
+                features = (features * mask).sum(1) / mask.sum(1).clamp(min=1)
+        x = self.mlp(features)
+        return x.squeeze(-1) if self.num_outputs == 1 else x
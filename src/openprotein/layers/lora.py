@@ -0,0 +1,73 @@
+import math
+from typing import *
+
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+
+
+class LoRALinear(nn.Module):
+    """
+    Low-rank adapter around a frozen ``nn.Linear``: ``y = base(x) + (alpha / rank) * B A dropout(x)``, with A of
+    shape (rank, in_features) and B of shape (out_features, rank).
+
+    B starts at zero, so the adapted layer first computes exactly the base layer. Only A and B are trainable.
+    It is deliberately not an ``nn.Linear``: the code paths that read the weight of a plain linear layer (the
+    fused encoder layer kernel, quantization) see the adapter and fall back; :meth:`merge` gives the
+    ``nn.Linear`` with the adapter folded into its weight.
+
+    Args:
+        base (nn.Linear): the adapted layer, frozen
+        rank (int): rank of the update
+        alpha (float): scale of the update, the update is scaled by ``alpha / rank``
+        dropout (float): dropout on the input of the adapter
+    """
+
+    def __init__(self, base: nn.Linear, rank: int = 8, alpha: float = 16.0, dropout: float = 0.0):
+        super().__init__()
+        if rank <= 0:
+            raise ValueError(f"rank must be positive, get {rank}")
+        self.base = base
+        for parameter in self.base.parameters():
+            parameter.requires_grad_(False)
+        self.in_features = base.in_features
+        self.out_features = base.out_features
+        self.rank = rank
+        self.alpha = alpha
+        self.scaling = alpha / rank
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
+        factory = {"device": base.weight.device, "dtype": base.weight.dtype}
+        self.lora_A = nn.Parameter(torch.empty(rank, self.in_features, **factory))
+        self.lora_B = nn.Parameter(torch.empty(self.out_features, rank, **factory))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        nn.init.zeros_(self.lora_B)
+
+    def forward(self, x: Tensor) -> Tensor:
+        return self.base(x) + F.linear(F.linear(self.dropout(x), self.lora_A), self.lora_B) * self.scaling
+
+    def delta_weight(self) -> Tensor:
+        """
+        The update of the weight, (out_features, in_features)
+        """
+        return (self.lora_B @ self.lora_A) * self.scaling
+
+    def merge(self) -> nn.Linear:
+        """
+        A new ``nn.Linear`` computing the adapted layer, the base weight plus the update
+        """
+        linear = nn.Linear(self.in_features, self.out_features, bias=self.base.bias is not None,
+                           device=self.base.weight.device, dtype=self.base.weight.dtype)
+        with torch.no_grad():
+            linear.weight.copy_(self.base.weight + self.delta_weight().to(self.base.weight.dtype))
+            if self.base.bias is not None:
+                linear.bias.copy_(self.base.bias)
+        linear.weight.requires_grad_(self.base.weight.requires_grad)
+        if linear.bias is not None:
+            linear.bias.requires_grad_(self.base.bias.requires_grad)
+        return linear
+
+    def extra_repr(self) -> str:
+        return f"rank={self.rank}, alpha={self.alpha}"
@@ -0,0 +1,23 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from ..utils.precision import is_autocast_enabled, fp32
+
+
+class ESM1bLayerNorm(nn.LayerNorm):
+    """
+    LayerNorm that always normalizes in float32.
+
+    Same parameters and state dict as ``nn.LayerNorm``. Outside autocast it is exactly ``nn.LayerNorm``,
+    inside a reduced precision autocast region the statistics are computed in float32 and the output
+    is cast back to the dtype of the input.
+    """
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not is_autocast_enabled(x.device.type) and x.dtype == torch.float32:
+            return super().forward(x)
+        with fp32(x.device.type):
+            weight = self.weight.float() if self.weight is not None else None
+            bias = self.bias.float() if self.bias is not None else None
+            return F.layer_norm(x.float(), self.normalized_shape, weight, bias, self.eps).type_as(x)
@@ -0,0 +1,157 @@
+from typing import *
+
+import torch
+import torch.distributed as dist
+from torch import nn, Tensor
+
+from openprotein.layers.attention import MultiheadAttention, utils_softmax
+from openprotein.layers.transformerLayer import TransformerLayer
+from openprotein.utils import gelu
+
+
+def shard_range(size: int, rank: int, world_size: int) -> Tuple[int, int]:
+    """
+    [start, end) of the shard of ``rank`` when ``size`` items are split into ``world_size`` near-equal parts
+    """
+    base, extra = divmod(size, world_size)
+    start = rank * base + min(rank, extra)
+    return start, start + base + (rank < extra)
+
+
+def _linear(weight: Tensor, bias: Optional[Tensor]) -> nn.Linear:
+    linear = nn.Linear(weight.size(1), weight.size(0), bias=bias is not None, device="meta")
+    linear.weight = nn.Parameter(weight.detach().clone(), requires_grad=False)
+    if bias is not None:
+        linear.bias = nn.Parameter(bias.detach().clone(), requires_grad=False)
+    return linear
+
+
+class ParallelMultiheadAttention(nn.Module):
+    """
+    Self-attention split by heads over the ranks of a process group, for inference.
+
+    Every rank holds the q/k/v projection rows and the ``out_proj`` columns of its heads, computes the attention
+    of its heads and its partial output projection; the partial outputs are summed with one ``all_reduce``.
+
+    Args:
+        attention (MultiheadAttention): the full attention the shard is cut from
+        group (ProcessGroup, optional): the tensor-parallel group, default the world
+    """
+
+    def __init__(self, attention: MultiheadAttention, group=None):
+        super().__init__()
+        if attention.bias_k is not None or attention.add_zero_attn or attention.rot_emb is not None:
+            raise ValueError("only the attention of ESM-1b (no bias_kv, zero attention or rotary) can be split")
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+        self.embed_dim = attention.embed_dim
+        self.num_heads = attention.num_heads
+        self.head_dim = attention.head_dim
+        self.scaling = attention.scaling
+        start, end = shard_range(self.num_heads, self.rank, self.world_size)
+        self.local_heads = end - start
+        rows = slice(start * self.head_dim, end * self.head_dim)
+
+        def proj(linear):
+            return _linear(linear.weight[rows], None if linear.bias is None else linear.bias[rows])
+
+        self.q_proj = proj(attention.q_proj)
+        self.k_proj = proj(attention.k_proj)
+        self.v_proj = proj(attention.v_proj)
+        self.out_proj = _linear(attention.out_proj.weight[:, rows], None)
+        self.out_bias = nn.Parameter(attention.out_proj.bias.detach().clone(), requires_grad=False)
+
+    def forward(self, query, key=None, value=None, key_padding_mask=None, need_weights=True, attn_mask=None,
+                need_head_weights=False) -> Tuple[Tensor, Optional[Tensor]]:
+        """
+        Same inputs and outputs as :meth:`MultiheadAttention.forward` for self-attention, Time x Batch x Channel
+        """
+        tgt_len, bsz, _ = query.size()
+        heads = bsz * self.local_heads
+        q = (self.q_proj(query) * self.scaling).contiguous().view(tgt_len, heads, self.head_dim).transpose(0, 1)
+        k = self.k_proj(query).contiguous().view(tgt_len, heads, self.head_dim).transpose(0, 1)
+        v = self.v_proj(query).contiguous().view(tgt_len, heads, self.head_dim).transpose(0, 1)
+
+        attn_weights = torch.bmm(q, k.transpose(1, 2))
+        if attn_mask is not None:
+            attn_weights += attn_mask.unsqueeze(0)
+        if key_padding_mask is not None:
+            attn_weights = attn_weights.view(bsz, self.local_heads, tgt_len, tgt_len)
+            attn_weights = attn_weights.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2).to(torch.bool),
+                                                    float("-inf"))
+            attn_weights = attn_weights.view(heads, tgt_len, tgt_len)
+        attn_weights_float = utils_softmax(attn_weights, dim=-1)
+        attn = torch.bmm(attn_weights_float.type_as(q), v)
+        attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, self.local_heads * self.head_dim)
+        attn = self.out_proj(attn)
+        dist.all_reduce(attn, group=self.group)
+        attn = attn + self.out_bias
+
+        if not (need_weights or need_head_weights):
+            return attn, None
+        # (B, H_local, T, S) => (H_local, B, T, S)
+        weights = attn_weights_float.view(bsz, self.local_heads, tgt_len, tgt_len).type_as(attn).transpose(1, 0)
+        if need_head_weights:
+            # all_gather needs equal shapes, uneven shards are padded to the largest one
+            sizes = [end - start for start, end in
+                     (shard_range(self.num_heads, r, self.world_size) for r in range(self.world_size))]
+            padded = weights.new_zeros((max(sizes),) + weights.shape[1:])
+            padded[:self.local_heads] = weights
+            gathered = [torch.empty_like(padded) for _ in sizes]
+            dist.all_gather(gathered, padded, group=self.group)
+            return attn, torch.cat([g[:size] for g, size in zip(gathered, sizes)], 0)
+        weights = weights.sum(0)
+        dist.all_reduce(weights, group=self.group)
+        return attn, weights / self.num_heads
+
+
+class ParallelTransformerLayer(nn.Module):
+    """
+    ``TransformerLayer`` with the attention split by heads and the FFN split along ``ffn_embed_dim``, for
+    inference over a ``torch.distributed`` process group (e.g. gloo, one process per NUMA node).
+
+    The LayerNorms are replicated. ``fc1`` is split by rows and ``fc2`` by columns, so the FFN needs one
+    ``all_reduce`` and the whole layer two.
+
+    Args:
+        layer (TransformerLayer): the full layer the shard is cut from
+        group (ProcessGroup, optional): the tensor-parallel group, default the world
+    """
+
+    def __init__(self, layer: TransformerLayer, group=None):
+        super().__init__()
+        self.group = group
+        rank, world_size = dist.get_rank(group), dist.get_world_size(group)
+        self.embed_dim = layer.embed_dim
+        self.ffn_embed_dim = layer.ffn_embed_dim
+        self.attention_heads = layer.attention_heads
+        self.self_attn = ParallelMultiheadAttention(layer.self_attn, group)
+        self.self_attn_layer_norm = layer.self_attn_layer_norm
+        self.final_layer_norm = layer.final_layer_norm
+        start, end = shard_range(layer.ffn_embed_dim, rank, world_size)
+        self.fc1 = _linear(layer.fc1.weight[start:end], layer.fc1.bias[start:end])
+        self.fc2 = _linear(layer.fc2.weight[:, start:end], None)
+        self.fc2_bias = nn.Parameter(layer.fc2.bias.detach().clone(), requires_grad=False)
+
+    def forward(self, x, self_attn_mask=None, self_attn_padding_mask=None, need_head_weights=False):
+        residual = x
+        x = self.self_attn_layer_norm(x)
+        x, attn = self.self_attn(
+            query=x,
+            key_padding_mask=self_attn_padding_mask,
+            # the averaged weights are never used by the model, skip their reduction
+            need_weights=need_head_weights,
+            need_head_weights=need_head_weights,
+            attn_mask=self_attn_mask,
+        )
+        x = residual + x
+
+        residual = x
+        x = self.final_layer_norm(x)
+        x = gelu(self.fc1(x))
+        x = self.fc2(x)
+        dist.all_reduce(x, group=self.group)
+        x = residual + x + self.fc2_bias
+
+        return x, attn
@@ -1,12 +1,50 @@
+from typing import *
+
+import torch
 import torch.nn as nn
-from torch.nn import LayerNorm as ESM1bLayerNorm
 
 from openprotein.layers.attention import MultiheadAttention
+from openprotein.layers.efficient_attention import build_attention
+from openprotein.layers.normalization import ESM1bLayerNorm
 
 from openprotein.utils import gelu
+from openprotein.utils.graph import is_static_graph
+from openprotein.utils.precision import is_autocast_enabled
+
 
 class TransformerLayer(nn.Module):
-    """Transformer layer block."""
+    """Transformer layer block.
+
+    In inference the whole pre-LayerNorm block runs as one call to PyTorch's fused encoder layer kernel
+    (``torch._transformer_encoder_layer_fwd`` with ``norm_first=True``), which computes the same function with
+    fewer intermediate tensors. The layer falls back to the module-by-module forward when gradients are needed,
+    when attention weights are requested or with an attention mask, under autocast, while tracing, exporting or
+    compiling, and when the layer is not a plain ESM-1b layer (bias_kv, rotary embeddings, an odd number of
+    heads, quantized or adapted projections, hooks). The fused path returns no attention weights.
+
+    The kernel takes the q/k/v projections packed in one tensor. With ``cache_packed_qkv`` the packed tensor is
+    kept and rebuilt only when a projection changes. Weights mapped from a file and shared by several processes
+    (see :mod:`openprotein.models.weights`) turn it off, the cache would be a private copy of them in every
+    process; they are packed again on every call instead.
+
+    With ``chunk_size`` set, inference on sequences longer than ``chunk_size`` runs the attention in blocks of
+    queries and keys with an online softmax and the FFN in chunks of positions, so neither the
+    ``[B * H, T, T]`` scores nor the ``[T, B, ffn_embed_dim]`` intermediate is ever allocated whole and the
+    activation memory grows linearly with the length. It falls back like the fused path, except that it
+    supports bias_kv, rotary embeddings and any projection modules.
+
+    The self-attention is exact ("full") or one of the linear-complexity approximations of
+    :mod:`openprotein.layers.efficient_attention` ("performer", "local"), with the same parameters.
+
+    Args:
+        fused (bool): allow the fused inference path
+        chunk_size (int, optional): tokens per block of the chunked inference path, None disables it
+        cache_packed_qkv (bool): keep the packed q/k/v projections of the fused path between calls
+        attention (str): "full", "performer" or "local"
+        attention_options (dict, optional): arguments of the approximate attention, e.g. ``num_features`` or
+            ``window``
+        max_positions (int): positions the rotary embedding tables are built for
+    """
 
     def __init__(
         self,
@@ -15,20 +53,32 @@ class TransformerLayer(nn.Module):
         attention_heads,
         add_bias_kv=True,
         use_rotary_embeddings: bool = False,
+        fused: bool = True,
+        chunk_size: Optional[int] = None,
+        attention: str = "full",
+        attention_options: Optional[Dict[str, Any]] = None,
+        cache_packed_qkv: bool = True,
+        max_positions: int = 1024,
     ):
         super().__init__()
+        self.fused = fused
+        self.cache_packed_qkv = cache_packed_qkv
+        self._packed_qkv_cache = None
+        self.chunk_size = chunk_size
         self.embed_dim = embed_dim
         self.ffn_embed_dim = ffn_embed_dim
         self.attention_heads = attention_heads
         self.use_rotary_embeddings = use_rotary_embeddings
         BertLayerNorm = ESM1bLayerNorm
 
-        self.self_attn = MultiheadAttention(
+        self.self_attn = build_attention(
+            attention,
             self.embed_dim,
             self.attention_heads,
             add_bias_kv=add_bias_kv,
-            add_zero_attn=False,
             use_rotary_embeddings=self.use_rotary_embeddings,
+            max_positions=max_positions,
+            **(attention_options or {}),
         )
         self.self_attn_layer_norm = BertLayerNorm(self.embed_dim)
 
@@ -37,9 +87,94 @@ class TransformerLayer(nn.Module):
 
         self.final_layer_norm = BertLayerNorm(self.embed_dim)
 
+    def _needs_grad(self, x) -> bool:
+        return torch.is_grad_enabled() and (x.requires_grad or any(p.requires_grad for p in self.parameters()))
+
+    def _can_chunk(self, x, self_attn_mask, need_head_weights) -> bool:
+        if not self.chunk_size or x.size(0) <= self.chunk_size or self.self_attn.add_zero_attn:
+            return False
+        if need_head_weights or self_attn_mask is not None or is_static_graph():
+            return False
+        return not self._needs_grad(x)
+
+    def _chunked_forward(self, x, self_attn_padding_mask):
+        x = x + self.self_attn.chunked_forward(
+            self.self_attn_layer_norm(x), key_padding_mask=self_attn_padding_mask, chunk_size=self.chunk_size
+        )
+        for start in range(0, x.size(0), self.chunk_size):
+            chunk = x[start:start + self.chunk_size]
+            # in place, the chunks are disjoint and x is a new tensor
+            chunk += self.fc2(gelu(self.fc1(self.final_layer_norm(chunk))))
+        return x
+
+    def _can_fuse(self, x, self_attn_mask, need_head_weights) -> bool:
+        attn = self.self_attn
+        if not self.fused or need_head_weights or self_attn_mask is not None or is_static_graph():
+            return False
+        if type(attn) is not MultiheadAttention:
+            return False
+        if attn.bias_k is not None or attn.rot_emb is not None or attn.onnx_trace or attn.num_heads % 2:
+            return False
+        if not attn._plain_projections() or type(self.fc1) is not nn.Linear or type(self.fc2) is not nn.Linear:
+            return False
+        if is_autocast_enabled(x.device.type) or x.device.type not in ("cpu", "cuda"):
+            return False
+        if x.dtype != self.fc1.weight.dtype or self.self_attn_layer_norm.eps != self.final_layer_norm.eps:
+            return False
+        if self._needs_grad(x):
+            return False
+        return not any(m._forward_hooks or m._forward_pre_hooks for m in self.modules())
+
+    def _packed_qkv(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        attn = self.self_attn
+        weights = (attn.q_proj.weight, attn.k_proj.weight, attn.v_proj.weight)
+        biases = (attn.q_proj.bias, attn.k_proj.bias, attn.v_proj.bias)
+        if not self.cache_packed_qkv:
+            return torch.cat(weights), torch.cat(biases)
+        # a new tensor (loaded, moved, cast) or an in-place update of one rebuilds the cache
+        version = tuple((p.data_ptr(), p._version) for p in weights + biases)
+        if self._packed_qkv_cache is None or self._packed_qkv_cache[0] != version:
+            with torch.no_grad():
+                self._packed_qkv_cache = (version, torch.cat(weights), torch.cat(biases))
+        return self._packed_qkv_cache[1], self._packed_qkv_cache[2]
+
+    def _fused_forward(self, x, self_attn_padding_mask):
+        attn = self.self_attn
+        weight, bias = self._packed_qkv()
+        # the kernel takes Batch x Time x Channel and one packed q/k/v projection; it scales q by
+        # head_dim ** -0.5 like the attention of the layer
+        x = torch._transformer_encoder_layer_fwd(
+            x.transpose(0, 1),
+            self.embed_dim,
+            attn.num_heads,
+            weight,
+            bias,
+            attn.out_proj.weight,
+            attn.out_proj.bias,
+            True,  # gelu
+            True,  # norm_first
+            self.self_attn_layer_norm.eps,
+            self.self_attn_layer_norm.weight,
+            self.self_attn_layer_norm.bias,
+            self.final_layer_norm.weight,
+            self.final_layer_norm.bias,
+            self.fc1.weight,
+            self.fc1.bias,
+            self.fc2.weight,
+            self.fc2.bias,
+            self_attn_padding_mask,
+            None if self_attn_padding_mask is None else 1,  # key padding mask
+        )
+        return x.transpose(0, 1)
+
     def forward(
         self, x, self_attn_mask=None, self_attn_padding_mask=None, need_head_weights=False
     ):
+        if self._can_chunk(x, self_attn_mask, need_head_weights):
+            return self._chunked_forward(x, self_attn_padding_mask), None
+        if self._can_fuse(x, self_attn_mask, need_head_weights):
+            return self._fused_forward(x, self_attn_padding_mask), None
+
         residual = x
         x = self.self_attn_layer_norm(x)
         x, attn = self.self_attn(
@@ -47,7 +182,8 @@ class TransformerLayer(nn.Module):
             key=x,
             value=x,
             key_padding_mask=self_attn_padding_mask,
-            need_weights=True,
+            # the weights are only used per head, without them attention can take the SDPA kernels
+            need_weights=need_head_weights,
             need_head_weights=need_head_weights,
             attn_mask=self_attn_mask,
         )
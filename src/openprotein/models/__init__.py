@@ -1,5 +1,15 @@
 from .esm1b import ProteinBertModel as Esm1b
+from .quantize import quantize_dynamic, compare_models
+from .onnx import export_onnx, OnnxEsm1b
+from .compile import CompiledEsm1b
+from .weights import save_flat_weights, load_flat_weights, FlatWeightsBuilder
+from .parallel import tensor_parallel, load_tensor_parallel
+from .window import SlidingWindowEsm1b
+from .lora import inject_lora, lora_state_dict, save_lora, load_lora, merge_lora
 
 __all__ = [
-    "Esm1b",
+    "Esm1b", "quantize_dynamic", "compare_models", "export_onnx", "OnnxEsm1b", "CompiledEsm1b",
+    "save_flat_weights", "load_flat_weights", "FlatWeightsBuilder",
+    "tensor_parallel", "load_tensor_parallel", "SlidingWindowEsm1b",
+    "inject_lora", "lora_state_dict", "save_lora", "load_lora", "merge_lora",
 ]
\ No newline at end of file
@@ -0,0 +1,185 @@
+import time
+import logging
+import contextlib
+from typing import *
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def power_of_two_buckets(max_length: int, min_length: int = 32) -> List[int]:
+    """
+    Padded lengths 32, 64, 128, ... up to and including ``max_length``
+    """
+    buckets, length = [], min_length
+    while length < max_length:
+        buckets.append(length)
+        length *= 2
+    buckets.append(max_length)
+    return buckets
+
+
+class _StaticForward(nn.Module):
+    """
+    ``forward`` with its python arguments fixed, so the compiled graph has one tensor input and tensor outputs
+    """
+
+    def __init__(self, model, repr_layers: Tuple[int, ...], need_head_weights: bool, return_contacts: bool,
+                 return_logits: bool):
+        super().__init__()
+        self.model = model
+        self.repr_layers = list(repr_layers)
+        self.need_head_weights = need_head_weights
+        self.return_contacts = return_contacts
+        self.return_logits = return_logits
+
+    def forward(self, tokens):
+        result = self.model(tokens, repr_layers=self.repr_layers, need_head_weights=self.need_head_weights,
+                            return_contacts=self.return_contacts, return_logits=self.return_logits)
+        outputs = [result["representations"][layer] for layer in self.repr_layers]
+        for key in ["logits", "attentions", "contacts"]:
+            if key in result:
+                outputs.append(result[key])
+        return tuple(outputs)
+
+
+class CompiledEsm1b(object):
+    """
+    Compiled inference mode of a protein language model, with the same call signature as ``Esm1b.forward``.
+
+    Every batch is right-padded with ``<pad>`` to the smallest bucket length that holds it, and one graph is
+    compiled per (bucket, outputs) combination, so variable-length inputs only ever trigger a bounded number of
+    compilations. The outputs are cut back to the length of the batch. Batches longer than the largest bucket
+    run eagerly.
+
+    Args:
+        model (Esm1b): the model, switched to eval mode
+        buckets (Sequence[int], optional): padded lengths, default powers of two up to ``max_positions``
+        backend (str): "inductor" for ``torch.compile``, or "torchscript" for ``torch.jit.trace``
+
+    Examples:
+        >>> compiled = CompiledEsm1b(model, backend="inductor")
+        >>> compiled.warmup(batch_size=8, repr_layers=[33])
+        >>> compiled(tokens, repr_layers=[33])["representations"][33]
+        >>> compiled.cache_status()
+    """
+    BACKENDS = ("inductor", "torchscript")
+
+    def __init__(self, model, buckets: Optional[Sequence[int]] = None, backend: str = "inductor"):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"backend must be one of {self.BACKENDS}, get {backend}")
+        self.model = model.eval()
+        self.buckets = sorted(buckets) if buckets is not None else power_of_two_buckets(model.args.max_positions)
+        self.backend = backend
+        self._compiled = {}
+        self._stats = {}
+        self.eager_calls = 0
+
+    def bucket(self, length: int) -> Optional[int]:
+        """
+        The padded length of a batch of ``length`` tokens, None if it is longer than every bucket
+        """
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        return None
+
+    def __call__(self, tokens, repr_layers=[], need_head_weights=False, return_contacts=False, return_logits=True):
+        if return_contacts:
+            need_head_weights = True
+        batch_size, length = tokens.shape
+        bucket = self.bucket(length)
+        if bucket is None:
+            self.eager_calls += 1
+            with torch.no_grad():
+                return self.model(tokens, repr_layers=repr_layers, need_head_weights=need_head_weights,
+                                  return_contacts=return_contacts, return_logits=return_logits)
+
+        flags = (tuple(sorted(set(repr_layers))), need_head_weights, return_contacts, return_logits)
+        padded = F.pad(tokens, (0, bucket - length), value=self.model.padding_idx)
+        fn = self._get(bucket, batch_size, flags, padded)
+        with torch.no_grad(), self._dynamo_config():
+            outputs = list(fn(padded))
+
+        result = {"representations": {layer: outputs.pop(0)[:, :length] for layer in flags[0]}}
+        if return_logits:
+            result["logits"] = outputs.pop(0)[:, :length]
+        if need_head_weights:
+            result["attentions"] = outputs.pop(0)[..., :length, :length]
+        if return_contacts:
+            contact_length = length - int(self.model.prepend_bos) - int(self.model.append_eos)
+            result["contacts"] = outputs.pop(0)[:, :contact_length, :contact_length]
+        return result
+
+    def warmup(self, batch_size: int = 1, repr_layers: Sequence[int] = (), need_head_weights: bool = False,
+               return_contacts: bool = False, return_logits: bool = True, buckets: Optional[Sequence[int]] = None):
+        """
+        Compile the graphs of the given buckets ahead of the first real batch
+
+        Args:
+            batch_size (int): batch size of the dummy batches
+            buckets (Sequence[int], optional): buckets to compile, default all
+            the other arguments select the outputs, as in ``Esm1b.forward``
+        """
+        for bucket in buckets if buckets is not None else self.buckets:
+            tokens = torch.full((batch_size, bucket), self.model.mask_idx, dtype=torch.int64,
+                                device=next(self.model.parameters()).device)
+            tokens[:, 0] = self.model.cls_idx
+            tokens[:, -1] = self.model.eos_idx
+            self(tokens, repr_layers=repr_layers, need_head_weights=need_head_weights,
+                 return_contacts=return_contacts, return_logits=return_logits)
+
+    def cache_status(self) -> Dict[str, Any]:
+        """
+        The compiled graphs, with their compile time and number of calls
+
+        Returns:
+            dict with ``backend``, ``buckets``, ``eager_calls`` and ``graphs``: a list of
+            {"bucket", "batch_size", "outputs", "compile_seconds", "calls"}
+        """
+        graphs = []
+        for (bucket, batch_size, flags), stats in self._stats.items():
+            graphs.append({
+                "bucket": bucket,
+                "batch_size": batch_size,
+                "outputs": {"repr_layers": list(flags[0]), "need_head_weights": flags[1],
+                            "return_contacts": flags[2], "return_logits": flags[3]},
+                "compile_seconds": stats["compile_seconds"],
+                "calls": stats["calls"],
+            })
+        return {"backend": self.backend, "buckets": self.buckets, "eager_calls": self.eager_calls, "graphs": graphs}
+
+    def _get(self, bucket: int, batch_size: int, flags: tuple, sample: torch.Tensor) -> Callable:
+        # graphs are specialized on the batch size too, serving batch sizes are usually few
+        key = (bucket, batch_size, flags)
+        if key not in self._compiled:
+            start = time.perf_counter()
+            module = _StaticForward(self.model, *flags)
+            with torch.no_grad(), self._dynamo_config():
+                if self.backend == "torchscript":
+                    compiled = torch.jit.trace(module, (sample,), check_trace=False)
+                else:
+                    compiled = torch.compile(module, dynamic=False)
+                # the first call does the actual compilation
+                compiled(sample)
+            self._compiled[key] = compiled
+            self._stats[key] = {"compile_seconds": time.perf_counter() - start, "calls": 0}
+            logging.info(f"compiled bucket {bucket} batch size {batch_size} in {self._stats[key]['compile_seconds']:.1f}s")
+        self._stats[key]["calls"] += 1
+        return self._compiled[key]
+
+    def _dynamo_config(self):
+        """
+        Context of the compilations and calls of the inductor graphs: dynamo caches graphs per code object, leave
+        room for one graph per bucket and output set. The global config of the process is left as it is
+        """
+        if self.backend != "inductor":
+            return contextlib.nullcontext()
+        config = torch._dynamo.config
+        # renamed recompile_limit in newer releases
+        name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit"
+        limits = {name: max(getattr(config, name), 8 * len(self.buckets))}
+        if hasattr(config, "accumulated_cache_size_limit"):
+            limits["accumulated_cache_size_limit"] = max(config.accumulated_cache_size_limit, 64 * len(self.buckets))
+        return config.patch(limits)
@@ -1,10 +1,19 @@
+import math
+import logging
+from typing import *
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn import LayerNorm as ESM1bLayerNorm
+from torch.utils.checkpoint import checkpoint
 
+from openprotein.layers.normalization import ESM1bLayerNorm
 from openprotein.layers.embedding import LearnedPositionalEmbedding, ContactPredictionHead, RobertaLMHead
 from openprotein.layers.transformerLayer import TransformerLayer
+from openprotein.models.weights import read_checkpoint, tie_weights, keep_weights_shared, materialize
+from openprotein.utils.graph import is_static_graph
+from openprotein.utils.precision import autocast
+
 
 class ProteinBertModel(nn.Module):
     @classmethod
@@ -34,7 +43,43 @@ class ProteinBertModel(nn.Module):
         )
         parser.add_argument("--max_positions", default=1024, type=int, help="number of positional embeddings to learn")
         parser.add_argument("--emb_layer_norm_before", default=True, type=bool)
-        parser.add_argument("--checkpoint_path", type=str)
+        parser.add_argument(
+            "--checkpoint_path",
+            type=str,
+            help="weights to load, a torch.save state dict or a flat weight file; the model is then built on the "
+                 "meta device and its parameters are mapped from the file instead of being initialized",
+        )
+        parser.add_argument(
+            "--precision",
+            default="fp32",
+            choices=["fp32", "bf16"],
+            help="run the forward under autocast, LayerNorms, softmax and apc stay in fp32",
+        )
+        parser.add_argument(
+            "--activation_checkpointing",
+            default="none",
+            choices=["none", "all", "every", "budget"],
+            help="recompute the activations of some layers in backward instead of storing them: all layers, "
+                 "every --checkpoint_every layers, or as few layers as fit --activation_memory_budget",
+        )
+        parser.add_argument("--checkpoint_every", default=2, type=int, metavar="K",
+                            help="checkpoint one layer out of K")
+        parser.add_argument("--activation_memory_budget", default=None, type=float, metavar="MB",
+                            help="memory for the stored activations of the transformer layers, in MB")
+        parser.add_argument("--no_fused_layers", action="store_true",
+                            help="disable the fused encoder layer kernel in inference")
+        parser.add_argument("--chunk_size", default=None, type=int, metavar="N",
+                            help="inference on longer sequences runs the attention in blocks of N queries and keys "
+                                 "and the FFN in chunks of N positions, memory linear in the length")
+        parser.add_argument("--attention", default="full", choices=["full", "performer", "local"],
+                            help="self-attention of the layers: exact, random-feature (Performer) or local plus "
+                                 "global sparse, the weights of an exact model load into either")
+        parser.add_argument("--performer_features", default=256, type=int, metavar="M",
+                            help="random features per head of the performer attention")
+        parser.add_argument("--local_window", default=64, type=int, metavar="W",
+                            help="one-sided reach of the local attention")
+        parser.add_argument("--global_tokens", default=1, type=int, metavar="G",
+                            help="leading tokens with global attention in the local attention, 1 for <cls>")
 
     def __init__(self, args, alphabet):
         super().__init__()
@@ -48,8 +93,64 @@ class ProteinBertModel(nn.Module):
         self.append_eos = alphabet.append_eos
         self.emb_layer_norm_before = getattr(self.args, "emb_layer_norm_before", False)
         self.model_version = "ESM-1b"
-        self._init_submodules_esm1b()
+        self.precision = getattr(self.args, "precision", "fp32")
+        self.activation_checkpointing = getattr(self.args, "activation_checkpointing", "none")
+        checkpoint_path = getattr(self.args, "checkpoint_path", None)
+        if checkpoint_path:
+            # skip the random initialization the checkpoint overwrites anyway
+            with torch.device("meta"):
+                self._init_submodules_esm1b()
+            self.load_checkpoint(checkpoint_path)
+        else:
+            self._init_submodules_esm1b()
+
+    def embed(self, tokens):
+        """
+        Token and positional embeddings of the input of the first layer, (B, T, E) with zeros at the padding
+        """
+        padding_mask = tokens.eq(self.padding_idx)  # B, T
+        x = self.embed_scale * self.embed_tokens(tokens)
+
+        if getattr(self.args, "token_dropout", False):
+            x.masked_fill_((tokens == self.mask_idx).unsqueeze(-1), 0.0)
+            # x: B x T x C
+            mask_ratio_train = 0.15 * 0.8
+            src_lengths = (~padding_mask).sum(-1)
+            mask_ratio_observed = (tokens == self.mask_idx).sum(-1).float() / src_lengths
+            x = x * (1 - mask_ratio_train) / (1 - mask_ratio_observed)[:, None, None]
 
+        x = x + self.embed_positions(tokens)
+
+        if self.model_version == "ESM-1b":
+            if self.emb_layer_norm_before:
+                x = self.emb_layer_norm_before(x)
+            if padding_mask is not None:
+                x = x * (1 - padding_mask.unsqueeze(-1).type_as(x))
+        return x
+
+    def load_checkpoint(self, path: str):
+        """
+        Load the weights of a checkpoint, mapped from the file rather than copied, see
+        :func:`openprotein.models.weights.read_checkpoint`. Tensors missing from the checkpoint, e.g. the
+        contact head of a fair-esm checkpoint, are initialized by :func:`openprotein.models.weights.materialize`.
+        """
+        _, unexpected = self.load_state_dict(read_checkpoint(path), strict=False, assign=True)
+        tie_weights(self)
+        keep_weights_shared(self)
+        if unexpected:
+            raise RuntimeError(f"unexpected keys in {path}: {unexpected}")
+        initialized = materialize(self)
+        if initialized:
+            logging.info(f"keys missing from {path} are initialized: {initialized}")
+
+    def _attention_options(self) -> Dict[str, Any]:
+        attention = getattr(self.args, "attention", "full")
+        if attention == "performer":
+            return {"num_features": getattr(self.args, "performer_features", 256)}
+        if attention == "local":
+            return {"window": getattr(self.args, "local_window", 64),
+                    "global_tokens": getattr(self.args, "global_tokens", 1)}
+        return {}
 
     def _init_submodules_common(self):
         self.embed_tokens = nn.Embedding(
@@ -62,6 +163,11 @@ class ProteinBertModel(nn.Module):
                     self.args.ffn_embed_dim,
                     self.args.attention_heads,
                     add_bias_kv=(self.model_version != "ESM-1b"),
+                    fused=not getattr(self.args, "no_fused_layers", False),
+                    chunk_size=getattr(self.args, "chunk_size", None),
+                    attention=getattr(self.args, "attention", "full"),
+                    attention_options=self._attention_options(),
+                    max_positions=self.args.max_positions,
                 )
                 for _ in range(self.args.num_layers)
             ]
@@ -90,32 +196,45 @@ class ProteinBertModel(nn.Module):
             weight=self.embed_tokens.weight,
         )
 
-    def forward(self, tokens, repr_layers=[], need_head_weights=False, return_contacts=False):
+    def forward(self, tokens, repr_layers=[], need_head_weights=False, return_contacts=False, return_logits=True,
+                logits_mask=None):
+        """
+        ``logits_mask`` (B, T bool tensor, optional) restricts the LM head to the selected positions, e.g. the
+        positions scored by the MLM loss; ``logits`` is then the compact (N, V) tensor of the N selected positions
+        in row-major order, matching ``target_tokens[logits_mask]``
+        """
+        if self.precision == "fp32":
+            return self._forward(tokens, repr_layers, need_head_weights, return_contacts, return_logits, logits_mask)
+
+        with autocast(self.precision, tokens.device.type):
+            result = self._forward(tokens, repr_layers, need_head_weights, return_contacts, return_logits,
+                                   logits_mask)
+        # outputs are handed back in fp32, so losses and metrics downstream stay in full precision
+        for key, value in result.items():
+            if key == "representations":
+                result[key] = {layer: x.float() for layer, x in value.items()}
+            else:
+                result[key] = value.float()
+        return result
+
+    def _forward(self, tokens, repr_layers, need_head_weights, return_contacts, return_logits, logits_mask=None):
         if return_contacts:
             need_head_weights = True
 
         assert tokens.ndim == 2
         padding_mask = tokens.eq(self.padding_idx)  # B, T
 
-        x = self.embed_scale * self.embed_tokens(tokens)
-
-        if getattr(self.args, "token_dropout", False):
-            x.masked_fill_((tokens == self.mask_idx).unsqueeze(-1), 0.0)
-            # x: B x T x C
-            mask_ratio_train = 0.15 * 0.8
-            src_lengths = (~padding_mask).sum(-1)
-            mask_ratio_observed = (tokens == self.mask_idx).sum(-1).float() / src_lengths
-            x = x * (1 - mask_ratio_train) / (1 - mask_ratio_observed)[:, None, None]
+        repr_layers = set(repr_layers)
+        # attentions of every layer are needed for contacts, and logits need the final layer;
+        # otherwise stop after the deepest requested representation
+        if return_logits or need_head_weights:
+            last_layer = self.args.num_layers
+        else:
+            last_layer = max(repr_layers, default=0)
+        assert 0 <= last_layer <= self.args.num_layers
 
-        x = x + self.embed_positions(tokens)
+        x = self.embed(tokens)
 
-        if self.model_version == "ESM-1b":
-            if self.emb_layer_norm_before:
-                x = self.emb_layer_norm_before(x)
-            if padding_mask is not None:
-                x = x * (1 - padding_mask.unsqueeze(-1).type_as(x))
-
-        repr_layers = set(repr_layers)
         hidden_representations = {}
         if 0 in repr_layers:
             hidden_representations[0] = x
@@ -126,13 +245,24 @@ class ProteinBertModel(nn.Module):
         # (B, T, E) => (T, B, E)
         x = x.transpose(0, 1)
 
-        if not padding_mask.any():
+        # a traced or compiled graph keeps the mask, the batches it will see may be padded
+        if not is_static_graph() and not padding_mask.any():
             padding_mask = None
 
-        for layer_idx, layer in enumerate(self.layers):
-            x, attn = layer(
-                x, self_attn_padding_mask=padding_mask, need_head_weights=need_head_weights
-            )
+        checkpointed = set()
+        if self.training and torch.is_grad_enabled():
+            checkpointed = set(self.checkpointed_layers(tokens.size(0), tokens.size(1)))
+
+        for layer_idx, layer in enumerate(self.layers[:last_layer]):
+            if layer_idx in checkpointed:
+                # dropout masks are replayed from the saved RNG state during the recomputation
+                x, attn = checkpoint(
+                    layer, x, None, padding_mask, need_head_weights, use_reentrant=False, preserve_rng_state=True
+                )
+            else:
+                x, attn = layer(
+                    x, self_attn_padding_mask=padding_mask, need_head_weights=need_head_weights
+                )
             if (layer_idx + 1) in repr_layers:
                 hidden_representations[layer_idx + 1] = x.transpose(0, 1)
             if need_head_weights:
@@ -140,18 +270,24 @@ class ProteinBertModel(nn.Module):
                 attn_weights.append(attn.transpose(1, 0))
 
         if self.model_version == "ESM-1b":
-            x = self.emb_layer_norm_after(x)
+            if last_layer == self.args.num_layers:
+                x = self.emb_layer_norm_after(x)
             x = x.transpose(0, 1)  # (T, B, E) => (B, T, E)
 
             # last hidden representation should have layer norm applied
-            if (layer_idx + 1) in repr_layers:
-                hidden_representations[layer_idx + 1] = x
-            x = self.lm_head(x)
-        else:
+            if last_layer == self.args.num_layers and last_layer in repr_layers:
+                hidden_representations[last_layer] = x
+            if return_logits:
+                if logits_mask is not None:
+                    x = x[logits_mask]
+                x = self.lm_head(x)
+        elif return_logits:
             x = F.linear(x, self.embed_out, bias=self.embed_out_bias)
             x = x.transpose(0, 1)  # (T, B, E) => (B, T, E)
 
-        result = {"logits": x, "representations": hidden_representations}
+        result = {"representations": hidden_representations}
+        if return_logits:
+            result["logits"] = x
         if need_head_weights:
             # attentions: B x L x H x T x T
             attentions = torch.stack(attn_weights, 1)
@@ -169,9 +305,46 @@ class ProteinBertModel(nn.Module):
 
         return result
 
+    def layer_activation_bytes(self, batch_size: int, length: int) -> int:
+        """
+        Rough size of the activations a ``TransformerLayer`` stores for backward: about ten ``embed_dim``
+        and four ``ffn_embed_dim`` vectors per token, and the attention scores and probabilities
+        """
+        element_size = 2 if self.precision == "bf16" else 4
+        per_token = 10 * self.args.embed_dim + 4 * self.args.ffn_embed_dim
+        attention = 2 * self.args.attention_heads * length * length
+        return batch_size * (length * per_token + attention) * element_size
+
+    def checkpointed_layers(self, batch_size: int, length: int) -> List[int]:
+        """
+        Indices of the layers run under activation checkpointing for a batch of this shape in training
+
+        With ``activation_checkpointing="budget"``, the fewest layers are checkpointed so that the stored
+        activations fit ``activation_memory_budget``; a checkpointed layer only keeps its input. The layers
+        are spread evenly over the depth.
+        """
+        num_layers = self.args.num_layers
+        if self.activation_checkpointing == "all":
+            return list(range(num_layers))
+        if self.activation_checkpointing == "every":
+            k = getattr(self.args, "checkpoint_every", 2)
+            return list(range(0, num_layers, k))
+        if self.activation_checkpointing == "budget":
+            budget = getattr(self.args, "activation_memory_budget", None)
+            if budget is None:
+                raise ValueError("activation_checkpointing=budget needs activation_memory_budget")
+            stored = self.layer_activation_bytes(batch_size, length)
+            kept = batch_size * length * self.args.embed_dim * (2 if self.precision == "bf16" else 4)
+            excess = num_layers * stored - budget * 2 ** 20
+            if excess <= 0:
+                return []
+            num = min(num_layers, math.ceil(excess / (stored - kept)))
+            return sorted({int(i * num_layers / num) for i in range(num)})
+        return []
+
     def predict_contacts(self, tokens):
-        return self(tokens, return_contacts=True)["contacts"]
+        return self(tokens, return_contacts=True, return_logits=False)["contacts"]
 
     @property
     def num_layers(self):
-        return self.args.layers
\ No newline at end of file
+        return self.args.num_layers
\ No newline at end of file
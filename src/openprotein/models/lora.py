@@ -0,0 +1,120 @@
+from typing import *
+
+import torch
+import torch.nn as nn
+
+from openprotein.layers.lora import LoRALinear
+from openprotein.layers.transformerLayer import TransformerLayer
+
+LORA_TARGETS = ("q_proj", "k_proj", "v_proj", "out_proj", "fc1", "fc2")
+
+
+def inject_lora(model: nn.Module, rank: int = 8, alpha: float = 16.0, dropout: float = 0.0,
+                targets: Sequence[str] = LORA_TARGETS, layers: Optional[Sequence[int]] = None) -> nn.Module:
+    """
+    Wrap the linear layers of the ``TransformerLayer`` blocks of a model with :class:`LoRALinear` adapters and
+    freeze everything else, in place.
+
+    Only the adapters are trainable, so the optimizer state covers a tiny fraction of the parameters; give the
+    optimizer the trainable parameters only. The adapted model starts as the base model, the adapters are
+    initialized to a zero update.
+
+    Args:
+        model (Esm1b): the model
+        rank (int): rank of the adapters
+        alpha (float): scale of the adapters, the update is scaled by ``alpha / rank``
+        dropout (float): dropout on the input of the adapters
+        targets (Sequence[str]): names of the adapted linear layers, among "q_proj", "k_proj", "v_proj",
+            "out_proj", "fc1" and "fc2"
+        layers (Sequence[int], optional): indices of the adapted layers, default all
+
+    Returns:
+        the model
+
+    Examples:
+        >>> inject_lora(model, rank=8, targets=("q_proj", "v_proj"))
+        >>> optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+        >>> Train(dataloader, model, F.cross_entropy, optimizer).fit(reduction="mean", ingore_index=padding_idx)
+        >>> save_lora(model, "task.lora.pt")
+    """
+    unknown = set(targets) - set(LORA_TARGETS)
+    if unknown:
+        raise ValueError(f"targets must be among {LORA_TARGETS}, get {sorted(unknown)}")
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+    for index, layer in enumerate(model.layers):
+        if layers is not None and index not in layers:
+            continue
+        if not isinstance(layer, TransformerLayer):
+            raise TypeError(f"layer {index} is a {type(layer).__name__}, not a TransformerLayer")
+        for parent, name in _target_parents(layer, targets):
+            linear = getattr(parent, name)
+            if isinstance(linear, LoRALinear):
+                raise ValueError(f"layer {index} already has a {name} adapter")
+            setattr(parent, name, LoRALinear(linear, rank, alpha, dropout))
+    model.lora_config = {"rank": rank, "alpha": alpha, "dropout": dropout, "targets": list(targets),
+                         "layers": None if layers is None else list(layers)}
+    return model
+
+
+def lora_state_dict(model: nn.Module) -> Dict[str, torch.Tensor]:
+    """
+    The parameters of the adapters of a model, under their names in the model
+    """
+    return {name: tensor for name, tensor in model.state_dict().items()
+            if name.endswith(".lora_A") or name.endswith(".lora_B")}
+
+
+def save_lora(model: nn.Module, path: str):
+    """
+    Save the adapters of a model and their configuration, a file of a few MB instead of a full checkpoint
+    """
+    if not hasattr(model, "lora_config"):
+        raise ValueError("the model has no adapters, see inject_lora")
+    torch.save({"config": model.lora_config, "state_dict": lora_state_dict(model)}, path)
+
+
+def load_lora(model: nn.Module, path: str) -> nn.Module:
+    """
+    Inject the adapters saved by :func:`save_lora` into a base model and load their weights, in place
+
+    Args:
+        model (Esm1b): the base model, without adapters
+        path (str): the adapter file
+
+    Returns:
+        the model with the adapters
+    """
+    checkpoint = torch.load(path, map_location="cpu", weights_only=True)
+    inject_lora(model, **checkpoint["config"])
+    missing, unexpected = model.load_state_dict(checkpoint["state_dict"], strict=False)
+    missing = [name for name in missing if name.endswith(".lora_A") or name.endswith(".lora_B")]
+    if missing or unexpected:
+        raise RuntimeError(f"adapters of {path} do not match the model: missing {missing}, unexpected {unexpected}")
+    return model
+
+
+def merge_lora(model: nn.Module) -> nn.Module:
+    """
+    Fold the adapters into the base weights, in place: every :class:`LoRALinear` becomes a plain ``nn.Linear``,
+    the model has its original structure and state dict names and runs without overhead, through the fused
+    inference path.
+
+    Returns:
+        the model
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRALinear):
+                setattr(module, name, child.merge())
+    if hasattr(model, "lora_config"):
+        del model.lora_config
+    return model
+
+
+def _target_parents(layer: TransformerLayer, targets: Sequence[str]) -> List[Tuple[nn.Module, str]]:
+    parents = []
+    for name in targets:
+        parent = layer if name in ("fc1", "fc2") else layer.self_attn
+        parents.append((parent, name))
+    return parents
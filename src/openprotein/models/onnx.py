@@ -0,0 +1,141 @@
+import copy
+import inspect
+from typing import *
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from openprotein.layers.attention import MultiheadAttention
+
+
+class _ExportWrapper(nn.Module):
+    """
+    Fixes the python arguments of ``forward`` so the graph has a single tensor input and a tuple of outputs
+    """
+
+    def __init__(self, model, repr_layers: Sequence[int], return_contacts: bool):
+        super().__init__()
+        self.model = model
+        self.repr_layers = list(repr_layers)
+        self.return_contacts = return_contacts
+
+    def forward(self, tokens):
+        result = self.model(tokens, repr_layers=self.repr_layers, return_contacts=self.return_contacts)
+        outputs = [result["logits"]]
+        outputs.extend(result["representations"][layer] for layer in self.repr_layers)
+        if self.return_contacts:
+            outputs.append(result["contacts"])
+        return tuple(outputs)
+
+
+def export_onnx(model, path: str, repr_layers: Sequence[int] = (), return_contacts: bool = False,
+                opset_version: int = 17, sample_tokens: Optional[torch.Tensor] = None):
+    """
+    Export a protein language model to an ONNX graph with dynamic batch and sequence axes.
+
+    The graph takes ``tokens`` [batch, length] and returns ``logits``, ``representations_<layer>`` for every
+    layer of ``repr_layers`` and, if ``return_contacts``, ``contacts``.
+
+    Args:
+        model (Esm1b): the model to export, it is not modified
+        path (str): output ``.onnx`` file
+        repr_layers (Sequence[int]): layers whose representations are graph outputs
+        return_contacts (bool): add the contact map output
+        opset_version (int): ONNX opset
+        sample_tokens (torch.Tensor, optional): tokens traced through the model, must contain padding so the
+            padding mask stays in the graph; a small padded batch is built by default
+
+    Examples:
+        >>> export_onnx(model, "esm1b.onnx", repr_layers=[33], return_contacts=True)
+        >>> runner = OnnxEsm1b("esm1b.onnx")
+        >>> runner(tokens, repr_layers=[33])["representations"][33]
+    """
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        if isinstance(module, MultiheadAttention):
+            module.prepare_for_onnx_export_()
+    if sample_tokens is None:
+        sample_tokens = torch.full((2, 16), model.cls_idx, dtype=torch.int64)
+        sample_tokens[:, 1:-1] = model.mask_idx
+        sample_tokens[:, -1] = model.eos_idx
+        sample_tokens[1, 8:] = model.padding_idx
+
+    output_names = ["logits"] + [f"representations_{layer}" for layer in repr_layers]
+    dynamic_axes = {name: {0: "batch", 1: "length"} for name in ["tokens"] + output_names}
+    if return_contacts:
+        output_names.append("contacts")
+        dynamic_axes["contacts"] = {0: "batch", 1: "contact_length", 2: "contact_length"}
+
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # dynamic_axes belongs to the TorchScript based exporter
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            _ExportWrapper(model, repr_layers, return_contacts),
+            (sample_tokens,),
+            path,
+            input_names=["tokens"],
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            **kwargs,
+        )
+
+
+class OnnxEsm1b(object):
+    """
+    Runs an exported model on onnxruntime, with the same call signature as ``Esm1b.forward``.
+
+    Args:
+        path (str): the ``.onnx`` file written by :func:`export_onnx`
+        num_threads (int, optional): intra-op threads of onnxruntime, default all cores
+        providers (Sequence[str]): onnxruntime execution providers
+
+    Examples:
+        >>> runner = OnnxEsm1b("esm1b.onnx", num_threads=8)
+        >>> result = runner(tokens, repr_layers=[33], return_contacts=True)
+        >>> result["logits"].shape, result["contacts"].shape
+    """
+
+    def __init__(self, path: str, num_threads: Optional[int] = None,
+                 providers: Sequence[str] = ("CPUExecutionProvider",)):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=list(providers))
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        self.repr_layers = [int(name.split("_")[-1]) for name in self.output_names
+                            if name.startswith("representations_")]
+        self.has_contacts = "contacts" in self.output_names
+
+    def __call__(self, tokens, repr_layers=[], need_head_weights=False, return_contacts=False, return_logits=True):
+        if need_head_weights:
+            raise ValueError("attention weights are not an output of the exported graph")
+        missing = set(repr_layers) - set(self.repr_layers)
+        if missing:
+            raise ValueError(f"layers {sorted(missing)} were not exported, available {self.repr_layers}")
+        if return_contacts and not self.has_contacts:
+            raise ValueError("the graph was exported without contacts")
+
+        wanted = [f"representations_{layer}" for layer in repr_layers]
+        if return_logits:
+            wanted.append("logits")
+        if return_contacts:
+            wanted.append("contacts")
+        if isinstance(tokens, torch.Tensor):
+            tokens = tokens.cpu().numpy()
+        outputs = dict(zip(wanted, self.session.run(wanted, {"tokens": np.asarray(tokens, dtype=np.int64)})))
+
+        result = {"representations": {
+            layer: torch.from_numpy(outputs[f"representations_{layer}"]) for layer in repr_layers
+        }}
+        if return_logits:
+            result["logits"] = torch.from_numpy(outputs["logits"])
+        if return_contacts:
+            result["contacts"] = torch.from_numpy(outputs["contacts"])
+        return result
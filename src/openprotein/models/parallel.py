@@ -0,0 +1,56 @@
+import copy
+from typing import *
+
+import torch.nn as nn
+
+from openprotein.layers.parallel import ParallelTransformerLayer
+from openprotein.layers.transformerLayer import TransformerLayer
+from openprotein.models.esm1b import ProteinBertModel
+
+
+def tensor_parallel(model: nn.Module, group=None) -> nn.Module:
+    """
+    Split every ``TransformerLayer`` of a model over the ranks of a process group, in place.
+
+    Every rank must call it on the same model with the same group, then run the same forward. The embeddings,
+    the LM head and the contact head are replicated, every rank returns the full outputs.
+
+    Args:
+        model (Esm1b): the model, in eval mode
+        group (ProcessGroup, optional): the tensor-parallel group, default the world
+
+    Returns:
+        the model
+    """
+    for i, layer in enumerate(model.layers):
+        if isinstance(layer, TransformerLayer):
+            model.layers[i] = ParallelTransformerLayer(layer, group)
+    return model.eval()
+
+
+def load_tensor_parallel(args, alphabet, checkpoint_path: str, group=None) -> nn.Module:
+    """
+    Sharded loading: build the model from a memory-mapped checkpoint and keep the shard of this rank.
+
+    The model is built on the meta device and mapped from ``checkpoint_path`` (see ``--checkpoint_path``), the
+    shards are then copied out of the mapping. The row shards (q/k/v, ``fc1``) are contiguous ranges of a
+    row-major file, but the column shards of ``fc2`` and ``out_proj`` touch every row, so a rank pages in these
+    matrices whole. Write the flat file with ``save_flat_weights(model, path, column_major=True)`` to store them
+    transposed: a rank then reads only its own shard of every split weight, plus the replicated modules.
+
+    Args:
+        args (argparse.Namespace): arguments of the model
+        alphabet (Alphabet): the alphabet of the model
+        checkpoint_path (str): a ``torch.save`` state dict or a flat weight file
+        group (ProcessGroup, optional): the tensor-parallel group, default the world
+
+    Examples:
+        >>> torch.distributed.init_process_group("gloo", rank=rank, world_size=2)
+        >>> torch.set_num_threads(cores_per_numa_node)
+        >>> save_flat_weights(model, "/dev/shm/esm1b.bin", column_major=True)  # once
+        >>> model = load_tensor_parallel(args, alphabet, "/dev/shm/esm1b.bin")
+        >>> model(tokens, repr_layers=[33])["representations"][33]
+    """
+    args = copy.copy(args)
+    args.checkpoint_path = checkpoint_path
+    return tensor_parallel(ProteinBertModel(args, alphabet), group)
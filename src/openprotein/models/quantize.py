@@ -0,0 +1,79 @@
+import copy
+from typing import *
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from openprotein.layers.transformerLayer import TransformerLayer
+
+
+def quantize_dynamic(model: nn.Module, dtype: torch.dtype = torch.qint8, inplace: bool = False) -> nn.Module:
+    """
+    Int8 dynamic quantization of a protein language model for CPU inference.
+
+    Only the ``nn.Linear`` layers inside the ``TransformerLayer`` blocks are quantized, that is the q/k/v/out
+    projections of the attention and ``fc1``/``fc2`` of the FFN, which hold almost all the weights and the
+    compute. The embeddings, the ``RobertaLMHead`` with its tied weight, the contact head and every LayerNorm
+    stay in float. Weights are stored in int8, activations are quantized on the fly per batch.
+
+    Args:
+        model (Esm1b): the float model
+        dtype (torch.dtype): quantized dtype of the weights
+        inplace (bool): quantize the model in place instead of a copy
+
+    Returns:
+        the quantized model, in eval mode
+
+    Examples:
+        >>> qmodel = quantize_dynamic(model)
+        >>> qmodel(tokens, repr_layers=[33])["representations"][33]
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, TransformerLayer):
+            torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=dtype, inplace=True)
+    return model
+
+
+def compare_models(reference: nn.Module, candidate: nn.Module, masked_tokens: torch.Tensor,
+                   target_tokens: torch.Tensor, padding_idx: int, layer: Optional[int] = None) -> Dict[str, float]:
+    """
+    Accuracy check of an approximated model (quantized, reduced precision, ...) against its reference.
+
+    Args:
+        reference (Esm1b): the fp32 model
+        candidate (Esm1b): the model to check
+        masked_tokens (torch.Tensor): [B, T] masked input, e.g. from ``MaskedConverter``
+        target_tokens (torch.Tensor): [B, T] targets, ``padding_idx`` where no prediction is scored
+        padding_idx (int): padding index of the alphabet
+        layer (int, optional): layer of the compared embeddings, default the last layer
+
+    Returns:
+        dict of ``reference_mlm_accuracy``, ``candidate_mlm_accuracy``, ``mlm_agreement`` (fraction of
+        masked positions with the same prediction), ``embedding_cosine`` (mean cosine similarity of the
+        mean-pooled embeddings) and ``min_embedding_cosine``
+    """
+    layer = layer if layer is not None else reference.args.num_layers
+    with torch.no_grad():
+        ref = reference(masked_tokens, repr_layers=[layer])
+        cand = candidate(masked_tokens, repr_layers=[layer])
+
+    scored = target_tokens.ne(padding_idx)
+    ref_pred = ref["logits"].argmax(-1)[scored]
+    cand_pred = cand["logits"].argmax(-1)[scored]
+    targets = target_tokens[scored]
+
+    residues = masked_tokens.ne(padding_idx).unsqueeze(-1).type_as(ref["representations"][layer])
+    ref_emb = (ref["representations"][layer] * residues).sum(1) / residues.sum(1)
+    cand_emb = (cand["representations"][layer].float() * residues).sum(1) / residues.sum(1)
+    cosine = F.cosine_similarity(ref_emb, cand_emb, dim=-1)
+    return {
+        "reference_mlm_accuracy": ref_pred.eq(targets).float().mean().item(),
+        "candidate_mlm_accuracy": cand_pred.eq(targets).float().mean().item(),
+        "mlm_agreement": ref_pred.eq(cand_pred).float().mean().item(),
+        "embedding_cosine": cosine.mean().item(),
+        "min_embedding_cosine": cosine.min().item(),
+    }
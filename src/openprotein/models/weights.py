@@ -0,0 +1,263 @@
+import os
+import json
+import argparse
+import itertools
+from typing import *
+
+import torch
+import torch.nn as nn
+
+from openprotein.layers.embedding import RobertaLMHead
+
+ALIGNMENT = 64
+# weights the tensor-parallel layers split by columns, see save_flat_weights(column_major=True)
+COLUMN_SPLIT = ("fc2.weight", "out_proj.weight")
+# prefixes of the fair-esm checkpoints in front of the names of this model
+CHECKPOINT_PREFIXES = ("encoder.sentence_encoder.", "encoder.", "model.")
+
+
+def tie_weights(model: nn.Module) -> nn.Module:
+    """
+    Tie the output projection of the LM head to the token embedding again, after parameters were replaced
+    """
+    if hasattr(model, "lm_head") and hasattr(model, "embed_tokens"):
+        model.lm_head.weight = model.embed_tokens.weight
+    return model
+
+
+def keep_weights_shared(model: nn.Module) -> nn.Module:
+    """
+    Turn off the caches built from the parameters, after they were mapped from a file: the packed q/k/v
+    projections of the fused :class:`TransformerLayer` path would be a private copy in every process mapping it
+    """
+    for module in model.modules():
+        if hasattr(module, "cache_packed_qkv"):
+            module.cache_packed_qkv = False
+    return model
+
+
+def materialize(model: nn.Module, device: Union[str, torch.device] = "cpu") -> List[str]:
+    """
+    Allocate the tensors of a model still on the meta device, e.g. the ones missing from a loaded checkpoint,
+    and initialize them.
+
+    A module with a ``reset_parameters`` is reset, keeping its loaded parameters. Without one, a bias is zeroed
+    and the weight of a ``RobertaLMHead`` that is not tied to the token embedding is drawn like an embedding.
+    Non-persistent buffers are left to their module, like the random features of the Performer attention. Any
+    other tensor would keep uninitialized memory, it raises instead. Shared by :meth:`ProteinBertModel.load_checkpoint`
+    and :class:`PipelineStage`, so both meta-device loads initialize the same way.
+
+    Args:
+        model (nn.Module): the model
+        device (str or torch.device): device of the allocated tensors
+
+    Returns:
+        names of the initialized tensors
+    """
+    initialized = []
+    for prefix, module in model.named_modules():
+        tensors = dict(itertools.chain(module.named_parameters(recurse=False), module.named_buffers(recurse=False)))
+        meta = [name for name, tensor in tensors.items() if tensor.is_meta]
+        if not meta:
+            continue
+        if len(meta) == len(tensors):
+            # modules may hook to_empty, like the Performer attention drawing its features
+            module.to_empty(device=device, recurse=False)
+        else:
+            # to_empty would also replace the loaded tensors of the module, and the ones tied to them
+            with torch.no_grad():
+                for name in meta:
+                    tensor = torch.empty_like(tensors[name], device=device)
+                    if name in module._parameters:
+                        module._parameters[name] = nn.Parameter(tensor, requires_grad=tensors[name].requires_grad)
+                    elif name in module._non_persistent_buffers_set:
+                        raise RuntimeError(f"no initialization for the buffer {name} of {type(module).__name__}")
+                    else:
+                        module._buffers[name] = tensor
+        parameters = [name for name in meta if name in module._parameters]
+        buffers = [name for name in meta if name in module._buffers and name not in module._non_persistent_buffers_set]
+        names = [f"{prefix}.{name}" if prefix else name for name in parameters + buffers]
+        if not names:
+            continue
+        if hasattr(module, "reset_parameters") and parameters:
+            # reset_parameters of a module also resets its children, which may be loaded already, so only the
+            # modules with parameters of their own are reset; their loaded ones are swapped out meanwhile
+            loaded = {name: p for name, p in module._parameters.items() if p is not None and name not in meta}
+            for name, parameter in loaded.items():
+                module._parameters[name] = nn.Parameter(torch.empty_like(parameter), parameter.requires_grad)
+            module.reset_parameters()
+            module._parameters.update(loaded)
+        elif not buffers and all(name == "bias" or (name == "weight" and isinstance(module, RobertaLMHead))
+                                 for name in parameters):
+            with torch.no_grad():
+                for name in parameters:
+                    if name == "bias":
+                        nn.init.zeros_(module.bias)
+                    else:
+                        nn.init.normal_(module.weight)
+        else:
+            raise RuntimeError(f"no initialization for {names}, {type(module).__name__} has no reset_parameters")
+        initialized += names
+    return initialized
+
+
+def save_flat_weights(model: nn.Module, path: str, column_major: bool = False):
+    """
+    Write the state dict of a model into one flat, aligned binary file that processes can memory-map.
+
+    Writes ``path`` (the raw tensor data) and ``path + ".json"`` (name, dtype, shape and byte offset of every
+    tensor, and the ``args`` of the model). Tensors sharing their storage, like the tied embedding and LM head
+    weight, are written once.
+
+    With ``column_major``, the weights the tensor-parallel layers split by columns (``fc2`` and ``out_proj``)
+    are written transposed and mapped back as transposed views: the column shard of a rank is then one
+    contiguous range of the file, and :func:`load_tensor_parallel` pages in only its own shard of them. A
+    row-major column shard touches every page of the matrix.
+
+    Args:
+        model (Esm1b): the model
+        path (str): output file, put it on ``/dev/shm`` to keep the weights in shared memory rather than on disk
+        column_major (bool): write the column-split weights transposed, for :func:`load_tensor_parallel`
+
+    Examples:
+        >>> save_flat_weights(model, "/dev/shm/esm1b.bin")
+        >>> model, alphabet = FlatWeightsBuilder("/dev/shm/esm1b.bin", alphabet)()
+    """
+    index = {"args": vars(model.args) if hasattr(model, "args") else {}, "tensors": {}}
+    written = {}
+    offset = 0
+    with open(path, "wb") as f:
+        for name, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu()
+            transposed = column_major and tensor.dim() == 2 and name.endswith(COLUMN_SPLIT)
+            key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.dtype,
+                   transposed)
+            if key not in written:
+                data = tensor.t() if transposed else tensor
+                data = data.contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+                padding = -offset % ALIGNMENT
+                f.write(b"\0" * padding)
+                offset += padding
+                written[key] = offset
+                f.write(data)
+                offset += len(data)
+            index["tensors"][name] = {"dtype": str(tensor.dtype).replace("torch.", ""),
+                                      "shape": list(tensor.shape), "offset": written[key]}
+            if transposed:
+                index["tensors"][name]["transposed"] = True
+    with open(path + ".json", "w") as f:
+        json.dump(index, f, indent=2)
+
+
+def map_flat_weights(path: str) -> Dict[str, torch.Tensor]:
+    """
+    The state dict of a file written by :func:`save_flat_weights`, as views into the file mapped copy-on-write;
+    nothing is read until a tensor is used
+    """
+    with open(path + ".json", "r") as f:
+        index = json.load(f)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    state_dict = {}
+    for name, meta in index["tensors"].items():
+        dtype = getattr(torch, meta["dtype"])
+        element_size = torch.empty((), dtype=dtype).element_size()
+        tensor = torch.empty(0, dtype=dtype)
+        if meta.get("transposed", False):
+            tensor.set_(storage, meta["offset"] // element_size, meta["shape"][::-1])
+            tensor = tensor.t()
+        else:
+            tensor.set_(storage, meta["offset"] // element_size, meta["shape"])
+        state_dict[name] = tensor
+    return state_dict
+
+
+def read_checkpoint(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Read the state dict of a checkpoint without copying the weights into memory.
+
+    A flat weight file (with its ``.json`` index) is memory-mapped, a ``torch.save`` file is loaded with
+    ``torch.load(mmap=True)``. The state dict may be nested under "model" or "state_dict", and the prefixes of
+    the fair-esm checkpoints are removed. The ``argparse.Namespace`` the fair-esm checkpoints pickle under "args"
+    is the only object besides tensors and containers allowed in the file.
+
+    Args:
+        path (str): the checkpoint
+
+    Returns:
+        the state dict, tensors backed by the mapped file
+    """
+    if os.path.exists(path + ".json"):
+        return map_flat_weights(path)
+    with torch.serialization.safe_globals([argparse.Namespace]):
+        try:
+            checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except RuntimeError:
+            # files of the legacy torch.save format can not be mapped
+            checkpoint = torch.load(path, map_location="cpu", weights_only=True)
+    for key in ("model", "state_dict"):
+        if isinstance(checkpoint, dict) and isinstance(checkpoint.get(key), dict):
+            checkpoint = checkpoint[key]
+    state_dict = {}
+    for name, tensor in checkpoint.items():
+        for prefix in CHECKPOINT_PREFIXES:
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+                break
+        state_dict[name] = tensor
+    return state_dict
+
+
+def load_flat_weights(model: nn.Module, path: str) -> nn.Module:
+    """
+    Attach the parameters of a model to a file written by :func:`save_flat_weights`, without copying them.
+
+    The file is mapped copy-on-write (``MAP_PRIVATE``): the pages are shared through the page cache by every
+    process that maps the same file, so N inference workers cost one copy of the weights. The parameters are
+    frozen; a process writing into them only gets a private copy of the written pages.
+
+    Args:
+        model (Esm1b): the model, its parameters may live on the meta device
+        path (str): the flat weight file
+
+    Returns:
+        the model, in eval mode
+    """
+    model.load_state_dict(map_flat_weights(path), assign=True)
+    tie_weights(model)
+    keep_weights_shared(model)
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+    return model.eval()
+
+
+class FlatWeightsBuilder(object):
+    """
+    Picklable builder of :class:`InferenceServer` workers that share one copy of the weights.
+
+    Every worker builds the model with ``checkpoint_path`` set to the flat weight file: the model is built on the
+    meta device, so no weights are allocated, and the parameters are attached to the memory-mapped file.
+
+    Args:
+        path (str): the flat weight file, see :func:`save_flat_weights`
+        alphabet (Alphabet): the alphabet of the model
+
+    Examples:
+        >>> save_flat_weights(model, "/dev/shm/esm1b.bin")
+        >>> server = InferenceServer(FlatWeightsBuilder("/dev/shm/esm1b.bin", alphabet), num_workers=8)
+    """
+
+    def __init__(self, path: str, alphabet):
+        self.path = path
+        self.alphabet = alphabet
+
+    def __call__(self) -> Tuple[nn.Module, Any]:
+        # imported here, the model module itself loads its checkpoints with this module
+        from openprotein.models.esm1b import ProteinBertModel
+
+        with open(self.path + ".json", "r") as f:
+            args = argparse.Namespace(**json.load(f)["args"])
+        args.checkpoint_path = self.path
+        model = ProteinBertModel(args, self.alphabet)
+        for parameter in model.parameters():
+            parameter.requires_grad_(False)
+        return model.eval(), self.alphabet
@@ -0,0 +1,136 @@
+from typing import *
+
+import torch
+
+from openprotein.data.process import BatchConverter
+
+
+class SlidingWindowEsm1b(object):
+    """
+    Inference on sequences longer than ``max_positions``: every sequence is tiled into overlapping windows that
+    the model can take, the windows of all the sequences are batched together, and the per-residue outputs of
+    the windows are stitched back with overlap-weighted averaging.
+
+    Every window is a complete input of the model, with its own ``<cls>`` and ``<eos>``. Inside a window the
+    weight of a residue ramps up linearly over the first ``overlap`` residues and down over the last ones, so
+    where two windows overlap the residue is taken mostly from the window where it has more context; the weight
+    of a contact is the product of the weights of its two residues. Pairs of residues further apart than a
+    window never share one, their contact is 0. Sequences that fit in one window are run as they are.
+
+    Args:
+        model (Esm1b): the model, switched to eval mode
+        alphabet (Alphabet): the alphabet of the model
+        window (int, optional): residues per window, default ``max_positions - 2``
+        overlap (int, optional): residues shared by consecutive windows, default a quarter of the window
+        batch_size (int): windows per forward
+
+    Examples:
+        >>> windowed = SlidingWindowEsm1b(model, alphabet, overlap=256)
+        >>> results = windowed(["MKTAYIAK" * 400], repr_layers=[33], return_contacts=True)
+        >>> results[0]["representations"][33].shape, results[0]["contacts"].shape
+        (torch.Size([3200, 1280]), torch.Size([3200, 3200]))
+    """
+
+    def __init__(self, model, alphabet, window: Optional[int] = None, overlap: Optional[int] = None,
+                 batch_size: int = 8):
+        self.model = model.eval()
+        self.alphabet = alphabet
+        max_window = model.args.max_positions - int(alphabet.prepend_bos) - int(alphabet.append_eos)
+        self.window = max_window if window is None else window
+        if not 0 < self.window <= max_window:
+            raise ValueError(f"window must be in [1, {max_window}], get {self.window}")
+        self.overlap = self.window // 4 if overlap is None else overlap
+        if not 0 <= self.overlap < self.window:
+            raise ValueError(f"overlap must be in [0, {self.window}), get {self.overlap}")
+        self.batch_size = batch_size
+        self.converter = BatchConverter(alphabet)
+
+    def windows(self, length: int) -> List[Tuple[int, int]]:
+        """
+        [start, end) residues of the windows of a sequence of ``length`` residues
+        """
+        if length <= self.window:
+            return [(0, length)]
+        stride = self.window - self.overlap
+        starts = list(range(0, length - self.window, stride)) + [length - self.window]
+        return [(start, start + self.window) for start in starts]
+
+    def weights(self, start: int, end: int, length: int) -> torch.Tensor:
+        """
+        Averaging weights of the residues of the window [start, end) of a sequence of ``length`` residues
+        """
+        positions = torch.arange(end - start, dtype=torch.float32)
+        ramp = float(self.overlap + 1)
+        weights = torch.ones(end - start)
+        if start > 0:
+            weights = torch.minimum(weights, (positions + 1) / ramp)
+        if end < length:
+            weights = torch.minimum(weights, (end - start - positions) / ramp)
+        return weights
+
+    def __call__(self, sequences: Sequence[str], repr_layers: Sequence[int] = (), return_contacts: bool = False,
+                 return_logits: bool = True) -> List[Dict[str, Any]]:
+        """
+        Run the model on sequences of any length
+
+        Args:
+            sequences (Sequence[str]): the sequences
+            repr_layers (Sequence[int]): layers of the representations to return
+            return_contacts (bool): return the contacts
+            return_logits (bool): return the logits
+
+        Returns:
+            one dict per sequence, with "representations" ({layer: [length, embed_dim]}) and, as requested,
+            "logits" ([length, vocabulary]) and "contacts" ([length, length]), over the residues only
+        """
+        device = next(self.model.parameters()).device
+        first = int(self.alphabet.prepend_bos)
+        tiles = [(i, start, end) for i, sequence in enumerate(sequences)
+                 for start, end in self.windows(len(sequence))]
+        # windows of similar length share a batch
+        tiles.sort(key=lambda tile: tile[2] - tile[1], reverse=True)
+
+        sums = [{"weights": torch.zeros(len(sequence)), "representations": {}} for sequence in sequences]
+        for batch_start in range(0, len(tiles), self.batch_size):
+            batch = tiles[batch_start:batch_start + self.batch_size]
+            tokens = self.converter([sequences[i][start:end] for i, start, end in batch]).to(device)
+            with torch.inference_mode():
+                result = self.model(tokens, repr_layers=list(repr_layers), return_contacts=return_contacts,
+                                    return_logits=return_logits)
+            for b, (i, start, end) in enumerate(batch):
+                n = end - start
+                weights = self.weights(start, end, len(sequences[i]))
+                acc = sums[i]
+                acc["weights"][start:end] += weights
+                for layer in repr_layers:
+                    self._add(acc["representations"], layer, len(sequences[i]), start, end,
+                              result["representations"][layer][b, first:first + n], weights)
+                if return_logits:
+                    self._add(acc, "logits", len(sequences[i]), start, end, result["logits"][b, first:first + n],
+                              weights)
+                if return_contacts:
+                    pair_weights = weights[:, None] * weights[None, :]
+                    if "contacts" not in acc:
+                        acc["contacts"] = torch.zeros(len(sequences[i]), len(sequences[i]))
+                        acc["pair_weights"] = torch.zeros(len(sequences[i]), len(sequences[i]))
+                    acc["contacts"][start:end, start:end] += result["contacts"][b, :n, :n].float().cpu() * pair_weights
+                    acc["pair_weights"][start:end, start:end] += pair_weights
+
+        results = []
+        for acc in sums:
+            weights = acc["weights"][:, None]
+            result = {"representations": {layer: tensor / weights
+                                          for layer, tensor in acc["representations"].items()}}
+            if return_logits:
+                result["logits"] = acc["logits"] / weights
+            if return_contacts:
+                result["contacts"] = acc["contacts"] / acc["pair_weights"].clamp(min=1e-12)
+            results.append(result)
+        return results
+
+    @staticmethod
+    def _add(sums: dict, key, length: int, start: int, end: int, values: torch.Tensor, weights: torch.Tensor):
+        values = values.float().cpu()
+        if key not in sums:
+            sums[key] = torch.zeros(length, values.size(-1))
+        sums[key][start:end] += values * weights[:, None]
@@ -1,6 +1,18 @@
 from .train import Train
-from .metrics import MetricUnion, Accuracy, MeanSquaredError, Spearman
+from .metrics import MetricUnion, Accuracy, MeanSquaredError, Spearman, contact_precision
+from .embedding import Embedding, EmbeddingStore
+from .cache import EmbeddingCache, model_fingerprint
+from .variant import VariantScorer, parse_mutant
+from .pll import PseudoLikelihood
+from .parallel import PipelineStage, PipelineTrain
+from .downstream import FeatureDataset, DownstreamTrain
+from .distill import Distillation, TeacherEmbedding, build_student, layer_map, distillation_report, mask_sequences
+from .contacts import ContactPrediction
 
 __all__ = [
-    "Train", "MetricUnion", "Accuracy", "MeanSquaredError", "Spearman"
+    "Train", "MetricUnion", "Accuracy", "MeanSquaredError", "Spearman", "Embedding", "EmbeddingStore",
+    "EmbeddingCache", "model_fingerprint", "VariantScorer", "parse_mutant",
+    "PseudoLikelihood", "PipelineStage", "PipelineTrain", "FeatureDataset", "DownstreamTrain", "contact_precision",
+    "Distillation", "TeacherEmbedding", "build_student", "layer_map", "distillation_report",
+    "mask_sequences", "ContactPrediction"
 ]
\ No newline at end of file
@@ -0,0 +1,185 @@
+import io
+import hashlib
+import logging
+from struct import pack, unpack
+from typing import *
+
+import lmdb
+import numpy as np
+import torch
+
+
+def model_fingerprint(model: torch.nn.Module) -> str:
+    """
+    Fingerprint of the weights of a model, two models give the same fingerprint only if
+    their state dicts have the same names, shapes, dtypes and values
+
+    Args:
+        model (torch.nn.Module): the model
+
+    Returns:
+        hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        digest.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+class EmbeddingCache(object):
+    """
+    Persistent content-addressed cache of embeddings, stored in a local LMDB.
+
+    An entry is keyed by the hash of (model fingerprint, layer, pooling, dtype, precision, sequence), so the cache
+    can be shared by jobs and datasets, and entries of other models never collide. The dtype of the stored
+    embedding and the precision the model ran at are part of the key: a float16 or bf16 job never serves its
+    entries to a float32 one. The cache is bounded by ``max_bytes``:
+    once the stored embeddings grow past it, the least recently used entries are evicted until the size is
+    back under ``low_watermark * max_bytes``.
+
+    Args:
+        path (str): directory of the LMDB, created if it does not exist
+        fingerprint (str): fingerprint of the model weights, see :func:`model_fingerprint`
+        max_bytes (int): upper bound of the size of the stored embeddings
+        low_watermark (float): fraction of ``max_bytes`` kept after an eviction
+
+    Examples:
+        >>> cache = EmbeddingCache("./cache", model_fingerprint(model), max_bytes=10 * 2 ** 30)
+        >>> embedding = Embedding(model, alphabet, cache=cache)
+        >>> embedding.run("./uniref50.fasta", "./embeddings")
+        >>> cache.hit_rate
+        0.42
+    """
+
+    def __init__(self, path: str, fingerprint: str, max_bytes: int = 2 ** 34, low_watermark: float = 0.9):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        # lmdb only reserves address space, leave room for the keys and the b-tree pages
+        self._env = lmdb.open(path, map_size=max(2 * max_bytes, 2 ** 30), max_dbs=3, subdir=True)
+        self._data = self._env.open_db(b"data")
+        self._access = self._env.open_db(b"access")
+        self._info = self._env.open_db(b"info")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "evictions": self.evictions,
+                "bytes": self.nbytes}
+
+    @property
+    def nbytes(self) -> int:
+        with self._env.begin(db=self._info) as txn:
+            return self._get_int(txn, b"total_bytes")
+
+    def __len__(self) -> int:
+        with self._env.begin(db=self._data) as txn:
+            return txn.stat(self._data)["entries"]
+
+    def key(self, sequence: str, layer: int, pooling: str, dtype: str = "float32", precision: str = "fp32") -> bytes:
+        """
+        Content address of the embedding of a sequence, stored as ``dtype`` by a model run at ``precision``
+        """
+        content = f"{self.fingerprint}|{layer}|{pooling}|{dtype}|{precision}|{sequence}"
+        return hashlib.blake2b(content.encode(), digest_size=20).digest()
+
+    def get(self, sequence: str, layer: int, pooling: str, dtype: str = "float32",
+            precision: str = "fp32") -> Optional[np.ndarray]:
+        return self.get_many([(sequence, layer, pooling)], dtype, precision)[0]
+
+    def put(self, sequence: str, layer: int, pooling: str, value: np.ndarray, precision: str = "fp32"):
+        self.put_many([(sequence, layer, pooling, value)], precision)
+
+    def get_many(self, items: Sequence[Tuple[str, int, str]], dtype: str = "float32",
+                 precision: str = "fp32") -> List[Optional[np.ndarray]]:
+        """
+        Look up many embeddings in one transaction and refresh their recency
+
+        Args:
+            items (Sequence[Tuple[str, int, str]]): (sequence, layer, pooling) to look up
+            dtype (str): dtype of the embeddings
+            precision (str): precision the model ran at, e.g. "fp32" or "bf16"
+
+        Returns:
+            the cached embeddings, None for a miss
+        """
+        keys = [self.key(*item, dtype, precision) for item in items]
+        results = []
+        with self._env.begin(write=True) as txn:
+            clock = self._get_int(txn, b"clock", db=self._info)
+            for key in keys:
+                value = txn.get(key, db=self._data)
+                if value is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.hits += 1
+                clock += 1
+                _, size = unpack(">QQ", txn.get(key, db=self._access))
+                txn.put(key, pack(">QQ", clock, size), db=self._access)
+                results.append(np.load(io.BytesIO(value), allow_pickle=False))
+            txn.put(b"clock", pack(">Q", clock), db=self._info)
+        return results
+
+    def put_many(self, items: Sequence[Tuple[str, int, str, np.ndarray]], precision: str = "fp32"):
+        """
+        Store many embeddings in one transaction, evicting the least recently used entries if needed
+
+        Args:
+            items (Sequence[Tuple[str, int, str, np.ndarray]]): (sequence, layer, pooling, embedding) to store,
+                keyed with the dtype of the embedding
+            precision (str): precision the model ran at, e.g. "fp32" or "bf16"
+        """
+        with self._env.begin(write=True) as txn:
+            clock = self._get_int(txn, b"clock", db=self._info)
+            total = self._get_int(txn, b"total_bytes", db=self._info)
+            for sequence, layer, pooling, value in items:
+                key = self.key(sequence, layer, pooling, str(value.dtype), precision)
+                buffer = io.BytesIO()
+                np.save(buffer, np.ascontiguousarray(value), allow_pickle=False)
+                value = buffer.getvalue()
+                old = txn.get(key, db=self._access)
+                if old is not None:
+                    total -= unpack(">QQ", old)[1]
+                clock += 1
+                txn.put(key, value, db=self._data)
+                txn.put(key, pack(">QQ", clock, len(value)), db=self._access)
+                total += len(value)
+            if total > self.max_bytes:
+                total = self._evict(txn, total)
+            txn.put(b"clock", pack(">Q", clock), db=self._info)
+            txn.put(b"total_bytes", pack(">Q", total), db=self._info)
+
+    def _evict(self, txn, total: int) -> int:
+        target = int(self.max_bytes * self.low_watermark)
+        entries = []
+        for key, meta in txn.cursor(db=self._access):
+            clock, size = unpack(">QQ", meta)
+            entries.append((clock, size, bytes(key)))
+        entries.sort()
+        for _, size, key in entries:
+            if total <= target:
+                break
+            txn.delete(key, db=self._data)
+            txn.delete(key, db=self._access)
+            total -= size
+            self.evictions += 1
+        logging.info(f"evict the embedding cache {self.path} down to {total} bytes")
+        return total
+
+    def _get_int(self, txn, key: bytes, db=None) -> int:
+        value = txn.get(key, db=db if db is not None else self._info)
+        return unpack(">Q", value)[0] if value is not None else 0
+
+    def close(self):
+        self._env.close()
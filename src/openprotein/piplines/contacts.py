@@ -0,0 +1,195 @@
+import time
+import logging
+import itertools
+from typing import *
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from openprotein.data.process import BatchConverter
+from openprotein.data.sampler import TokenBudgetBatchSampler
+from openprotein.piplines.embedding import Embedding, EmbeddingStore
+
+
+class ContactPrediction(object):
+    """
+    Sparse contact maps of many sequences, streamed into an :class:`EmbeddingStore`.
+
+    Only the most probable contacts of every sequence are kept, as (i, j, p) records with i < j, sorted by
+    decreasing probability: field ``pairs`` holds the 0-based residues [k, 2] and field ``probs`` the
+    probabilities [k, 1]. The sequences of a chunk are sorted by length and cut into token-budget batches,
+    and the contact head runs per sequence on its own residues, so no work is quadratic in the longest
+    sequence of a batch. The attention maps of every layer are reduced as the layer runs, to their
+    regression-weighted sum and their row sums, instead of stacking the [layers, heads, T, T] maps of the
+    whole model. The head then scores the pairs in blocks of rows and keeps a running top k, see
+    ``ContactPredictionHead.top_contacts``.
+
+    Args:
+        model (Esm1b): the protein language model
+        alphabet (Alphabet): the alphabet of the model
+        top (float): contacts kept per sequence relative to its length L, 1.0 for L, 0.2 for L/5
+        top_k (int, optional): a fixed number of contacts per sequence instead
+        min_separation (int): minimum sequence separation of the kept pairs
+        max_tokens (int): padded tokens of one batch
+        chunk_size (int): records per shard, also the granularity of resuming
+        dtype (str): dtype of the stored probabilities, "float16" or "float32"
+        truncation_seq_length (int, optional): longer sequences are truncated,
+            default ``max_positions - 2`` of the model
+
+    Examples:
+        >>> contacts = ContactPrediction(model, alphabet, top=0.2, min_separation=6, max_tokens=8192)
+        >>> store = contacts.run("./uniref50.fasta", "./contacts")
+        >>> store.get("pairs", 0)[:2], store.get("probs", 0)[:2, 0]
+        (array([[12, 57], [13, 56]], dtype=int32), array([0.97, 0.95], dtype=float16))
+    """
+
+    def __init__(self, model, alphabet, top: float = 1.0, top_k: Optional[int] = None, min_separation: int = 6,
+                 max_tokens: int = 4096, chunk_size: int = 100000, dtype: str = "float16",
+                 truncation_seq_length: Optional[int] = None):
+        if min_separation < 1:
+            raise ValueError(f"min_separation must be at least 1, get {min_separation}")
+        self.model = model
+        self.alphabet = alphabet
+        self.top = top
+        self.top_k = top_k
+        self.min_separation = min_separation
+        self.max_tokens = max_tokens
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        if truncation_seq_length is None:
+            truncation_seq_length = model.args.max_positions - int(alphabet.prepend_bos) - int(alphabet.append_eos)
+        self.truncation_seq_length = truncation_seq_length
+        self.converter = BatchConverter(alphabet, truncation_seq_length)
+        self.stats = {}
+
+    @property
+    def fields(self) -> Dict[str, dict]:
+        return {
+            "pairs": {"dim": 2, "dtype": "int32", "per_residue": True},
+            "probs": {"dim": 1, "dtype": self.dtype, "per_residue": True},
+        }
+
+    @property
+    def settings(self) -> dict:
+        return {
+            "top": self.top,
+            "top_k": self.top_k,
+            "min_separation": self.min_separation,
+            "chunk_size": self.chunk_size,
+            "truncation_seq_length": self.truncation_seq_length,
+        }
+
+    def num_contacts(self, length: int) -> int:
+        """
+        Contacts kept for a sequence of ``length`` residues
+        """
+        span = max(length - self.min_separation, 0)
+        pairs = span * (span + 1) // 2
+        k = self.top_k if self.top_k is not None else int(self.top * length)
+        return min(k, pairs)
+
+    def run(self, source: Union[str, Iterable[Tuple[str, str]]], output: str) -> EmbeddingStore:
+        """
+        Predict the contacts of every record of the source into the store at ``output``, resuming after the
+        last complete shard
+
+        Args:
+            source (str or Iterable): a FASTA file, an LMDB dataset directory, or an iterable of (name, sequence)
+            output (str): directory of the :class:`EmbeddingStore`
+
+        Returns:
+            EmbeddingStore
+        """
+        store = EmbeddingStore(output)
+        store.setup(self.fields, self.settings)
+        records = Embedding.read_source(source)
+        done = len(store)
+        if done:
+            logging.info(f"resume {output} after {done} records")
+            records = itertools.islice(records, done, None)
+
+        self.model.eval()
+        num_sequences, num_tokens, start = 0, 0, time.perf_counter()
+        progress = tqdm(unit="seq", initial=done)
+        while True:
+            chunk = list(itertools.islice(records, self.chunk_size))
+            if not chunk:
+                break
+            ids, sequences = zip(*chunk)
+            sequences = [self.converter.truncate(s) for s in sequences]
+            lengths = [len(self.converter.encode(s)) for s in sequences]
+            writer = store.create_shard(ids, [self.num_contacts(length) for length in lengths])
+            for batch in TokenBudgetBatchSampler(lengths, self.max_tokens):
+                for row, (pairs, probs) in zip(batch, self.predict([sequences[i] for i in batch])):
+                    writer.write("pairs", row, pairs)
+                    writer.write("probs", row, probs[:, None])
+                num_tokens += len(batch) * (max(lengths[i] for i in batch) + 2)
+                progress.update(len(batch))
+            writer.commit()
+            num_sequences += len(sequences)
+        progress.close()
+
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            "sequences": num_sequences,
+            "tokens": num_tokens,
+            "seconds": elapsed,
+            "sequences_per_second": num_sequences / elapsed if elapsed > 0 else 0.0,
+        }
+        logging.info(f"predicted the contacts of {num_sequences} sequences in {elapsed:.1f}s, "
+                     f"{self.stats['sequences_per_second']:.1f} seq/s")
+        return store
+
+    def predict(self, sequences: Sequence[str]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Top contacts of a batch of sequences
+
+        Returns:
+            per sequence, the pairs [k, 2] (int32) and their probabilities [k] (``dtype``), most probable first
+        """
+        tokens = self.converter(list(sequences)).to(next(self.model.parameters()).device)
+        results = []
+        with torch.inference_mode():
+            for weighted, row_sums in self.reduced_attentions(tokens):
+                k = self.num_contacts(weighted.size(0))
+                if k == 0:
+                    results.append((np.zeros((0, 2), dtype=np.int32), np.zeros(0, dtype=self.dtype)))
+                    continue
+                i, j, probs = self.model.contact_head.top_contacts(weighted, row_sums, k, self.min_separation)
+                pairs = torch.stack([i, j], dim=1)
+                results.append((pairs.cpu().numpy().astype(np.int32), probs.cpu().numpy().astype(self.dtype)))
+        return results
+
+    def reduced_attentions(self, tokens: torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Run the layers of the model and reduce their attention maps over the residues of every sequence
+
+        Args:
+            tokens (torch.Tensor): [B, T] tokens from :class:`BatchConverter`
+
+        Returns:
+            per sequence, the [L, L] maps summed over the channels with the weights of the contact head, and the
+            [layers * heads, L] row sums of the symmetrized maps, see ``ContactPredictionHead.top_contacts``
+        """
+        model = self.model
+        first = int(self.alphabet.prepend_bos)
+        residues = tokens.ne(self.alphabet.padding_idx) & tokens.ne(self.alphabet.cls_idx)
+        residues &= tokens.ne(self.alphabet.eos_idx)
+        lengths = residues.sum(1).tolist()
+        with torch.inference_mode():
+            weights = model.contact_head.regression.weight.view(model.args.num_layers, -1).float()
+            padding_mask = tokens.eq(self.alphabet.padding_idx)
+            padding_mask = padding_mask if padding_mask.any() else None
+            x = model.embed(tokens).transpose(0, 1)
+            weighted = [torch.zeros(n, n, device=tokens.device) for n in lengths]
+            row_sums = [[] for _ in lengths]
+            for index, layer in enumerate(model.layers):
+                x, attn = layer(x, self_attn_padding_mask=padding_mask, need_head_weights=True)
+                # (H, B, T, T), one sequence at a time, over its residues only
+                for b, n in enumerate(lengths):
+                    maps = attn[:, b, first:first + n, first:first + n].float()
+                    weighted[b] += torch.einsum("h,hij->ij", weights[index], maps)
+                    row_sums[b].append(maps.sum(-1) + maps.sum(-2))
+                del attn
+        return [(w, torch.cat(r)) for w, r in zip(weighted, row_sums)]
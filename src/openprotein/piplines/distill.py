@@ -0,0 +1,439 @@
+import re
+import copy
+import time
+import zlib
+import logging
+from typing import *
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from openprotein.data.process import BatchConverter, MaskedConverter
+from openprotein.models.esm1b import ProteinBertModel
+from openprotein.piplines.embedding import Embedding, EmbeddingStore, ShardWriter
+from openprotein.piplines.metrics import contact_precision
+
+_LAYER = re.compile(r"^layers\.(\d+)\.(.*)$")
+
+
+def layer_map(teacher_layers: int, student_layers: int) -> Dict[int, int]:
+    """
+    Teacher layer matched to every student layer, both counted from 1, evenly spread with the last layer matched
+    to the last layer: 33 teacher and 6 student layers give ``{1: 5, 2: 11, 3: 16, 4: 22, 5: 27, 6: 33}``
+    """
+    return {s: s * teacher_layers // student_layers for s in range(1, student_layers + 1)}
+
+
+def build_student(teacher: ProteinBertModel, alphabet, num_layers: int, embed_dim: Optional[int] = None,
+                  ffn_embed_dim: Optional[int] = None, attention_heads: Optional[int] = None,
+                  init_from_teacher: bool = True) -> ProteinBertModel:
+    """
+    A shallow ``ProteinBertModel`` with the arguments of the teacher, ``num_layers`` layers and optionally narrower
+    dimensions.
+
+    With ``init_from_teacher``, the student starts as the teacher with the layers of :func:`layer_map` only: the
+    embeddings, LM head and final LayerNorm are copied, and the contact head keeps the weights of the attention
+    maps of the kept layers, scaled by ``teacher_layers / num_layers`` so its logits keep their scale. This needs
+    the dimensions of the teacher.
+
+    Examples:
+        >>> student = build_student(teacher, alphabet, num_layers=6)
+        >>> student.args.num_layers, student.args.embed_dim
+        (6, 1280)
+    """
+    args = copy.copy(teacher.args)
+    args.num_layers = num_layers
+    args.checkpoint_path = None
+    for name, value in (("embed_dim", embed_dim), ("ffn_embed_dim", ffn_embed_dim),
+                        ("attention_heads", attention_heads)):
+        if value is not None:
+            setattr(args, name, value)
+    student = ProteinBertModel(args, alphabet)
+    if not init_from_teacher:
+        return student
+    if any(getattr(args, name) != getattr(teacher.args, name)
+           for name in ("embed_dim", "ffn_embed_dim", "attention_heads")):
+        raise ValueError("init_from_teacher needs the embed_dim, ffn_embed_dim and attention_heads of the teacher")
+
+    teacher_layers = teacher.args.num_layers
+    mapping = layer_map(teacher_layers, num_layers)
+    teacher_state = teacher.state_dict()
+    state = {}
+    for name in student.state_dict():
+        match = _LAYER.match(name)
+        if match is not None:
+            state[name] = teacher_state[f"layers.{mapping[int(match.group(1)) + 1] - 1}.{match.group(2)}"]
+        elif name == "contact_head.regression.weight":
+            weight = teacher_state[name].view(teacher_layers, args.attention_heads)
+            kept = weight[[t - 1 for t in mapping.values()]] * (teacher_layers / num_layers)
+            state[name] = kept.reshape(1, -1)
+        else:
+            state[name] = teacher_state[name]
+    student.load_state_dict(state)
+    return student
+
+
+def mask_sequences(converter: MaskedConverter, sequences: Sequence[str], seed: int = 0
+                   ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    ``converter(sequences)`` with the masks of every sequence drawn from ``seed`` and the sequence alone, so a
+    record gets the same masks in any batch and in any run. The global numpy random state is left unchanged.
+
+    Returns:
+        origin, masked and target tokens [B, T], see :class:`MaskedConverter`
+    """
+    state = np.random.get_state()
+    batches = []
+    try:
+        for sequence in sequences:
+            np.random.seed(zlib.crc32(f"{seed}:{sequence}".encode()))
+            batches.append(converter([sequence]))
+    finally:
+        np.random.set_state(state)
+    length = max(batch[0].size(1) for batch in batches)
+    return tuple(
+        torch.cat([F.pad(batch[k], (0, length - batch[k].size(1)), value=converter.padding_idx) for batch in batches])
+        for k in range(3)
+    )
+
+
+class TeacherEmbedding(Embedding):
+    """
+    Per-residue outputs of a teacher for :class:`Distillation`, streamed into an :class:`EmbeddingStore` like
+    :class:`Embedding`: the logits (field ``logits``) and the representations of ``repr_layers`` (fields
+    ``per_residue_<layer>``).
+
+    The teacher runs on masked sequences, as the student will: every record is masked once, with masks drawn
+    from ``mask_seed`` and the sequence (see :func:`mask_sequences`), and its masked input and targets are
+    stored too (fields ``masked_tokens`` and ``targets``, the padding index where a residue is not scored).
+    The logits at the masked positions are then the predictions of the teacher, not a copy of the true residue.
+
+    Args:
+        model (Esm1b): the teacher
+        alphabet (Alphabet): the alphabet of the model
+        repr_layers (Sequence[int]): teacher layers matched by the student, see :func:`layer_map`
+        max_tokens (int): padded tokens of one batch
+        chunk_size (int): records per shard
+        dtype (str): dtype of the stored outputs
+        truncation_seq_length (int, optional): longer sequences are truncated
+        mask_seed (int): seed of the masks
+
+    Examples:
+        >>> layers = list(layer_map(33, 6).values())
+        >>> store = TeacherEmbedding(teacher, alphabet, layers, dtype="float16").run("./train.fasta", "./teacher")
+    """
+
+    def __init__(self, model, alphabet, repr_layers: Sequence[int], max_tokens: int = 4096,
+                 chunk_size: int = 100000, dtype: str = "float16", truncation_seq_length: Optional[int] = None,
+                 mask_seed: int = 0):
+        super().__init__(model, alphabet, repr_layers, pooling=("per_residue",), max_tokens=max_tokens,
+                         chunk_size=chunk_size, dtype=dtype, truncation_seq_length=truncation_seq_length)
+        self.mask_seed = mask_seed
+        self.masker = MaskedConverter(alphabet.standard_toks, alphabet.prepend_toks, alphabet.append_toks,
+                                      alphabet.prepend_bos, alphabet.append_eos)
+
+    @property
+    def fields(self) -> Dict[str, dict]:
+        fields = super().fields
+        fields["logits"] = {"dim": len(self.alphabet), "dtype": self.dtype, "per_residue": True}
+        fields["masked_tokens"] = {"dim": 1, "dtype": "int32", "per_residue": True}
+        fields["targets"] = {"dim": 1, "dtype": "int32", "per_residue": True}
+        return fields
+
+    @property
+    def settings(self) -> dict:
+        return {**super().settings, "logits": True, "mask_seed": self.mask_seed}
+
+    def _embed_batch(self, writer: ShardWriter, rows: Dict[str, List[int]], sequences: List[str]):
+        origin_tokens, masked_tokens, target_tokens = mask_sequences(self.masker, sequences, self.mask_seed)
+        # a random replacement may be any token, the residues are those of the unmasked sequence
+        residues = origin_tokens.ne(self.alphabet.padding_idx)
+        residues &= origin_tokens.ne(self.alphabet.cls_idx) & origin_tokens.ne(self.alphabet.eos_idx)
+        outputs = self.embed_tokens(masked_tokens.to(self._device()), residues.to(self._device()))
+        outputs["masked_tokens"] = [t[m, None].numpy().astype(np.int32) for t, m in zip(masked_tokens, residues)]
+        outputs["targets"] = [t[m, None].numpy().astype(np.int32) for t, m in zip(target_tokens, residues)]
+        for field, values in outputs.items():
+            for sequence, value in zip(sequences, values):
+                for row in rows[sequence]:
+                    writer.write(field, row, value)
+
+    def embed_tokens(self, tokens: torch.Tensor, residues: Optional[torch.Tensor] = None
+                     ) -> Dict[str, List[np.ndarray]]:
+        with torch.inference_mode():
+            result = self.model(tokens, repr_layers=self.repr_layers)
+            residue_mask = residues
+            if residue_mask is None:
+                residue_mask = tokens.ne(self.alphabet.padding_idx)
+                residue_mask &= tokens.ne(self.alphabet.cls_idx) & tokens.ne(self.alphabet.eos_idx)
+            outputs = {f"per_residue_{layer}": result["representations"][layer] for layer in self.repr_layers}
+            outputs["logits"] = result["logits"]
+            return {field: [r[m].float().cpu().numpy().astype(self.dtype) for r, m in zip(values, residue_mask)]
+                    for field, values in outputs.items()}
+
+
+class Distillation(object):
+    """
+    Knowledge distillation of a teacher ``Esm1b`` into a shallow student.
+
+    The student sees masked sequences and learns, on the masked positions, the temperature-softened distribution
+    of the teacher (KL divergence scaled by ``temperature ** 2``) and the true residues (cross entropy), and, on
+    every residue, the representations of the teacher layers of ``layer_map`` (mean squared error, through a
+    learned projection when the student is narrower).
+
+    Teacher outputs are computed on the fly from the same masked input, or read from a ``teacher_store`` written
+    by :class:`TeacherEmbedding`: the teacher then ran once on masked sequences, and the student trains on the
+    masked inputs of the store, so both modes distill the predictions of the teacher at the masked positions.
+    The masks of a store are fixed, every epoch sees the same ones, while the on-the-fly mode draws new masks
+    every step. The records given to :meth:`fit` must be the ones of the store, in store order.
+
+    Args:
+        teacher (Esm1b): the teacher
+        student (Esm1b): the student, e.g. from :func:`build_student`
+        alphabet (Alphabet): the alphabet of both models
+        teacher_store (EmbeddingStore or str, optional): cached teacher outputs
+        layers (dict, optional): student layer => teacher layer, default :func:`layer_map`
+        temperature (float): softmax temperature of the logit distillation
+        logit_weight (float): weight of the logit distillation loss
+        hidden_weight (float): weight of the representation loss
+        mlm_weight (float): weight of the masked language model loss on the true residues
+        lr (float): learning rate of AdamW
+        weight_decay (float): weight decay of AdamW
+
+    Examples:
+        >>> student = build_student(teacher, alphabet, num_layers=6)
+        >>> distillation = Distillation(teacher, student, alphabet, teacher_store="./teacher")
+        >>> distillation.fit(records, epochs=3, batch_size=16)
+        >>> distillation_report(teacher, student, alphabet, valid_sequences)["speedup"]
+        5.4
+    """
+
+    def __init__(self, teacher: ProteinBertModel, student: ProteinBertModel, alphabet,
+                 teacher_store: Optional[Union[EmbeddingStore, str]] = None, layers: Optional[Dict[int, int]] = None,
+                 temperature: float = 2.0, logit_weight: float = 1.0, hidden_weight: float = 1.0,
+                 mlm_weight: float = 1.0, lr: float = 1e-4, weight_decay: float = 0.01):
+        self.teacher = teacher.eval()
+        self.student = student
+        self.alphabet = alphabet
+        self.layers = dict(layers) if layers is not None else layer_map(teacher.args.num_layers,
+                                                                         student.args.num_layers)
+        self.temperature = temperature
+        self.logit_weight = logit_weight
+        self.hidden_weight = hidden_weight
+        self.mlm_weight = mlm_weight
+
+        self.teacher_store = EmbeddingStore(teacher_store) if isinstance(teacher_store, str) else teacher_store
+        if self.teacher_store is not None:
+            needed = ["logits", "masked_tokens", "targets"] + [f"per_residue_{t}" for t in self.layers.values()]
+            missing = [field for field in needed if field not in self.teacher_store.fields]
+            if missing:
+                raise ValueError(f"the teacher store has no fields {missing}, see TeacherEmbedding")
+        self.projections = None
+        if student.args.embed_dim != teacher.args.embed_dim:
+            self.projections = nn.ModuleDict({
+                str(s): nn.Linear(student.args.embed_dim, teacher.args.embed_dim) for s in self.layers
+            })
+        self.converter = MaskedConverter(alphabet.standard_toks, alphabet.prepend_toks, alphabet.append_toks,
+                                         alphabet.prepend_bos, alphabet.append_eos)
+        self.truncation_seq_length = student.args.max_positions - int(alphabet.prepend_bos) - int(
+            alphabet.append_eos)
+        self.truncation = BatchConverter(alphabet, self.truncation_seq_length)
+        self.optimizer = torch.optim.AdamW(self.parameters(), lr=lr, weight_decay=weight_decay)
+
+    def parameters(self) -> List[nn.Parameter]:
+        """
+        The trained parameters, the student and the projections of its representations
+        """
+        parameters = list(self.student.parameters())
+        if self.projections is not None:
+            parameters += list(self.projections.parameters())
+        return parameters
+
+    def step(self, sequences: Sequence[str], indices: Optional[Sequence[int]] = None) -> Dict[str, float]:
+        """
+        One optimizer step on a batch of sequences
+
+        Args:
+            sequences (Sequence[str]): the sequences
+            indices (Sequence[int], optional): positions of the sequences in the teacher store
+
+        Returns:
+            the total loss and its "logits", "hidden" and "mlm" terms
+        """
+        device = next(self.student.parameters()).device
+        if self.teacher_store is not None:
+            origin_tokens, masked_tokens, target_tokens = self._stored_masks(sequences, indices)
+        else:
+            origin_tokens, masked_tokens, target_tokens = self.converter(sequences)
+        origin_tokens, masked_tokens = origin_tokens.to(device), masked_tokens.to(device)
+        target_tokens = target_tokens.to(device)
+        scored = target_tokens.ne(self.alphabet.padding_idx)
+        residues = origin_tokens.ne(self.alphabet.padding_idx)
+        residues &= origin_tokens.ne(self.alphabet.cls_idx) & origin_tokens.ne(self.alphabet.eos_idx)
+        teacher_logits, teacher_hidden = self._teacher_outputs(masked_tokens, scored, residues, indices)
+
+        self.student.train()
+        self.optimizer.zero_grad()
+        result = self.student(masked_tokens, repr_layers=list(self.layers), logits_mask=scored)
+        losses = {"logits": torch.zeros((), device=device), "mlm": torch.zeros((), device=device)}
+        if scored.any():
+            t = self.temperature
+            losses["logits"] = F.kl_div(F.log_softmax(result["logits"] / t, dim=-1),
+                                        F.log_softmax(teacher_logits / t, dim=-1),
+                                        reduction="batchmean", log_target=True) * t ** 2
+            losses["mlm"] = F.cross_entropy(result["logits"], target_tokens[scored])
+        hidden = []
+        for s, t in self.layers.items():
+            x = result["representations"][s][residues]
+            if self.projections is not None:
+                x = self.projections[str(s)](x)
+            hidden.append(F.mse_loss(x, teacher_hidden[t]))
+        losses["hidden"] = torch.stack(hidden).mean()
+        loss = (self.logit_weight * losses["logits"] + self.hidden_weight * losses["hidden"]
+                + self.mlm_weight * losses["mlm"])
+        loss.backward()
+        self.optimizer.step()
+        return {"loss": loss.item(), **{name: value.item() for name, value in losses.items()}}
+
+    def fit(self, records: Sequence[Union[str, Tuple[str, str]]], epochs: int = 1, batch_size: int = 8,
+            seed: int = 0) -> List[float]:
+        """
+        Train the student on the records for some epochs, in a new random order every epoch
+
+        Args:
+            records (Sequence): sequences or (name, sequence), in store order with a teacher store
+            epochs (int): passes over the records
+            batch_size (int): sequences per step
+            seed (int): seed of the order of the records
+
+        Returns:
+            the mean loss of every epoch
+        """
+        sequences = [r if isinstance(r, str) else r[1] for r in records]
+        sequences = [self.truncation.truncate(s) for s in sequences]
+        if self.teacher_store is not None and len(sequences) != len(self.teacher_store):
+            raise ValueError(f"get {len(sequences)} records for a teacher store of {len(self.teacher_store)}")
+        generator = torch.Generator().manual_seed(seed)
+        history = []
+        for epoch in range(epochs):
+            order = torch.randperm(len(sequences), generator=generator).tolist()
+            total = 0.0
+            for start in tqdm(range(0, len(order), batch_size)):
+                indices = order[start:start + batch_size]
+                total += self.step([sequences[i] for i in indices], indices)["loss"] * len(indices)
+            history.append(total / max(len(sequences), 1))
+            logging.info(f"epoch {epoch} loss {history[-1]:.4f}")
+        return history
+
+    def _stored_masks(self, sequences, indices) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # origin, masked and target tokens of the sequences, with the masks the teacher of the store saw
+        if indices is None:
+            raise ValueError("the positions of the sequences in the teacher store are needed")
+        origin_tokens = self.truncation(sequences)
+        masked_tokens = origin_tokens.clone()
+        target_tokens = torch.full_like(origin_tokens, self.alphabet.padding_idx)
+        first = int(self.alphabet.prepend_bos)
+        for b, (sequence, index) in enumerate(zip(sequences, indices)):
+            masked = torch.from_numpy(self.teacher_store.get("masked_tokens", index)[:, 0].astype(np.int64))
+            targets = torch.from_numpy(self.teacher_store.get("targets", index)[:, 0].astype(np.int64))
+            if len(masked) != len(self.truncation.encode(sequence)):
+                raise ValueError("the sequences do not match the records of the teacher store")
+            masked_tokens[b, first:first + len(masked)] = masked
+            target_tokens[b, first:first + len(targets)] = targets
+        return origin_tokens, masked_tokens, target_tokens
+
+    def _teacher_outputs(self, masked_tokens, scored, residues, indices
+                         ) -> Tuple[torch.Tensor, Dict[int, torch.Tensor]]:
+        # logits of the scored positions (N, V) and representations of the residues (R, E), in row-major order
+        if self.teacher_store is None:
+            with torch.no_grad():
+                result = self.teacher(masked_tokens, repr_layers=list(self.layers.values()))
+            hidden = {t: result["representations"][t][residues].float() for t in self.layers.values()}
+            return result["logits"][scored].float(), hidden
+        device = masked_tokens.device
+
+        def gather(field):
+            return torch.from_numpy(np.concatenate([self.teacher_store.get(field, i) for i in indices])).to(
+                device=device, dtype=torch.float32)
+
+        hidden = {t: gather(f"per_residue_{t}") for t in self.layers.values()}
+        logits = gather("logits")
+        if len(logits) != int(residues.sum()):
+            raise ValueError("the sequences do not match the records of the teacher store")
+        return logits[scored[residues]], hidden
+
+
+def distillation_report(teacher: ProteinBertModel, student: ProteinBertModel, alphabet, sequences: Sequence[str],
+                        contacts: Optional[Sequence[np.ndarray]] = None, batch_size: int = 8,
+                        min_separation: int = 6, seed: int = 0) -> Dict[str, float]:
+    """
+    Speed-up and quality retention of a student against its teacher: inference throughput, MLM accuracy on the
+    same masked sequences, and contact precision at L, against true contacts or, when none are given, against
+    the top L contacts of the teacher (the teacher then scores 1.0). Retentions are student / teacher.
+
+    Args:
+        teacher (Esm1b): the teacher
+        student (Esm1b): the student
+        alphabet (Alphabet): the alphabet of both models
+        sequences (Sequence[str]): held-out sequences
+        contacts (Sequence[np.ndarray], optional): [L, L] true contacts of every sequence
+        batch_size (int): sequences per forward
+        min_separation (int): minimum sequence separation of the scored contacts
+        seed (int): seed of the masks
+
+    Returns:
+        "<model>_sequences_per_second", "speedup", "<model>_mlm_accuracy", "mlm_retention",
+        "<model>_contact_precision" and "contact_retention", with <model> "teacher" or "student"
+    """
+    converter = MaskedConverter(alphabet.standard_toks, alphabet.prepend_toks, alphabet.append_toks,
+                                alphabet.prepend_bos, alphabet.append_eos)
+    state = np.random.get_state()
+    np.random.seed(seed)
+    batches = [converter(sequences[start:start + batch_size]) for start in range(0, len(sequences), batch_size)]
+    np.random.set_state(state)
+
+    report, predicted = {}, {}
+    for name, model in (("teacher", teacher), ("student", student)):
+        model.eval()
+        device = next(model.parameters()).device
+        correct, total, elapsed = 0, 0, 0.0
+        predicted[name] = []
+        with torch.inference_mode():
+            for origin_tokens, masked_tokens, target_tokens in batches:
+                start = time.perf_counter()
+                logits = model(masked_tokens.to(device))["logits"]
+                elapsed += time.perf_counter() - start
+                scored = target_tokens.ne(alphabet.padding_idx)
+                correct += int((logits.argmax(-1).cpu()[scored] == target_tokens[scored]).sum())
+                total += int(scored.sum())
+                batch_contacts = model.predict_contacts(origin_tokens.to(device)).float().cpu()
+                for b in range(len(origin_tokens)):
+                    length = int(origin_tokens[b].ne(alphabet.padding_idx).sum()) - 2
+                    predicted[name].append(batch_contacts[b, :length, :length].numpy())
+        report[f"{name}_sequences_per_second"] = len(sequences) / elapsed if elapsed > 0 else 0.0
+        report[f"{name}_mlm_accuracy"] = correct / total if total else 0.0
+
+    for name in ("teacher", "student"):
+        precisions = []
+        for i, pred in enumerate(predicted[name]):
+            if contacts is not None:
+                true = contacts[i]
+            else:
+                # the top L contacts of the teacher
+                reference = predicted["teacher"][i]
+                rows, cols = np.triu_indices(len(reference), min_separation)
+                top = np.argsort(-reference[rows, cols], kind="stable")[:len(reference)]
+                true = np.zeros(reference.shape, dtype=bool)
+                true[rows[top], cols[top]] = True
+            precisions.append(contact_precision(true, pred, min_separation=min_separation))
+        report[f"{name}_contact_precision"] = float(np.mean(precisions)) if precisions else 0.0
+
+    def ratio(a, b):
+        return a / b if b else 0.0
+
+    report["speedup"] = ratio(report["student_sequences_per_second"], report["teacher_sequences_per_second"])
+    report["mlm_retention"] = ratio(report["student_mlm_accuracy"], report["teacher_mlm_accuracy"])
+    report["contact_retention"] = ratio(report["student_contact_precision"], report["teacher_contact_precision"])
+    return report
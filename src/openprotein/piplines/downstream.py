@@ -0,0 +1,254 @@
+import time
+import logging
+import itertools
+from typing import *
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from openprotein.piplines.embedding import EmbeddingStore
+from openprotein.piplines.metrics import Spearman
+
+
+class FeatureDataset(object):
+    """
+    Labelled features of one field of an :class:`EmbeddingStore`, batched straight from the store arrays.
+
+    Pooled fields are read once into one contiguous tensor in the dtype of the store (``in_memory``), or
+    gathered from the memory maps batch by batch for stores larger than the memory. Per-residue fields stay
+    memory-mapped, a batch is padded to its longest record and comes with its residue mask.
+
+    Args:
+        store (EmbeddingStore or str): the store, or its directory
+        field (str): name of the field, e.g. ``mean_33`` or ``per_residue_33``
+        labels (Sequence or dict): one label per record of the store, in store order, or
+            record name => label, then the records without a label are left out
+        indices (Sequence[int], optional): positions of the records to keep, e.g. a train split, default all
+        in_memory (bool): hold a pooled field in memory
+
+    Examples:
+        >>> train_data = FeatureDataset("./embeddings", "mean_33", labels, indices=train_indices)
+        >>> x, mask, y = next(train_data.batches(256, shuffle=True))
+        >>> x.shape, mask, y.shape
+        (torch.Size([256, 1280]), None, torch.Size([256]))
+    """
+
+    def __init__(self, store: Union[EmbeddingStore, str], field: str, labels: Union[Sequence, Dict[str, Any]],
+                 indices: Optional[Sequence[int]] = None, in_memory: bool = True):
+        self.store = EmbeddingStore(store) if isinstance(store, str) else store
+        if field not in self.store.fields:
+            raise ValueError(f"field must be one of {self.store.fields}, get {field}")
+        self.field = field
+        self.per_residue = self.store.index["fields"][field]["per_residue"]
+        self.dim = self.store.index["fields"][field]["dim"]
+
+        if isinstance(labels, dict):
+            ids = list(self.store.ids())
+            positions = [i for i in range(len(ids)) if ids[i] in labels]
+            values = [labels[ids[i]] for i in positions]
+        else:
+            if len(labels) != len(self.store):
+                raise ValueError(f"get {len(labels)} labels for a store of {len(self.store)} records")
+            positions = list(range(len(self.store)))
+            values = list(labels)
+        if indices is not None:
+            keep = set(indices)
+            values = [value for position, value in zip(positions, values) if position in keep]
+            positions = [position for position in positions if position in keep]
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.labels = torch.as_tensor(np.asarray(values, dtype=np.float32))
+
+        starts = np.asarray(self.store._starts)
+        self._shards = np.searchsorted(starts, self.positions, side="right") - 1
+        self._rows = self.positions - starts[self._shards]
+        self.features = None
+        if self.per_residue:
+            self._spans = np.zeros((len(self.positions), 2), dtype=np.int64)
+            for shard in np.unique(self._shards):
+                selected = self._shards == shard
+                offsets = np.asarray(self.store.offsets(shard))
+                self._spans[selected, 0] = offsets[self._rows[selected]]
+                self._spans[selected, 1] = offsets[self._rows[selected] + 1]
+        elif in_memory:
+            self.features = torch.from_numpy(self._gather(np.arange(len(self.positions))))
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def batches(self, batch_size: int, shuffle: bool = False, generator: Optional[torch.Generator] = None
+                ) -> Iterator[Tuple[torch.Tensor, Optional[torch.Tensor], torch.Tensor]]:
+        """
+        Iterate over the records in batches
+
+        Args:
+            batch_size (int): records per batch
+            shuffle (bool): draw the records in a random order
+            generator (torch.Generator, optional): generator of the random order
+
+        Returns:
+            (features, mask, labels) batches: pooled features [B, dim] and a None mask, or per-residue
+            features [B, L, dim] and their residue mask [B, L]; float32 features and labels
+        """
+        order = torch.randperm(len(self), generator=generator) if shuffle else torch.arange(len(self))
+        for start in range(0, len(self), batch_size):
+            index = order[start:start + batch_size]
+            if self.per_residue:
+                features, mask = self._gather_residues(index.numpy())
+            elif self.features is not None:
+                features, mask = self.features[index].float(), None
+            else:
+                features, mask = torch.from_numpy(self._gather(index.numpy())).float(), None
+            yield features, mask, self.labels[index]
+
+    def _gather(self, index: np.ndarray) -> np.ndarray:
+        # one fancy-indexed read per shard, in row order
+        out = np.empty((len(index), self.dim), dtype=self.store.index["fields"][self.field]["dtype"])
+        shards = self._shards[index]
+        for shard in np.unique(shards):
+            selected = np.flatnonzero(shards == shard)
+            out[selected] = self.store.array(self.field, shard)[self._rows[index[selected]]]
+        return out
+
+    def _gather_residues(self, index: np.ndarray) -> Tuple[torch.Tensor, torch.Tensor]:
+        spans = self._spans[index]
+        lengths = spans[:, 1] - spans[:, 0]
+        features = np.zeros((len(index), int(lengths.max(initial=0)), self.dim), dtype=np.float32)
+        for b, i in enumerate(index):
+            features[b, :lengths[b]] = self.store.array(self.field, self._shards[i])[spans[b, 0]:spans[b, 1]]
+        mask = torch.arange(features.shape[1])[None, :] < torch.from_numpy(lengths)[:, None]
+        return torch.from_numpy(features), mask
+
+
+class DownstreamTrain(object):
+    """
+    Trains small heads on the frozen features of an :class:`EmbeddingStore`.
+
+    The backbone runs once per dataset, through :class:`Embedding` into the store (running it again on the
+    same output is a no-op), and every epoch of every head afterwards only reads the features: many epochs
+    and hyperparameter settings cost less than one extra forward of the backbone. The heads are scored on the
+    validation set with the ``metrics``, :class:`Spearman` by default.
+
+    Args:
+        train_data (FeatureDataset): the training records
+        valid_data (FeatureDataset, optional): the records the heads are scored on
+        metrics (Sequence[_Metric], optional): metrics of the validation predictions, e.g. ``Spearman()`` and
+            ``MeanSquaredError()``, keyed by their repr in the scores
+        loss: loss function of (prediction, label), default ``F.mse_loss``
+        device (str or torch.device): device of the heads
+
+    Examples:
+        >>> store = Embedding(model, alphabet, repr_layers=[33], pooling=["mean"]).run("./train.fasta", "./emb")
+        >>> train = DownstreamTrain(FeatureDataset(store, "mean_33", labels, indices=train_indices),
+        ...                         FeatureDataset(store, "mean_33", labels, indices=valid_indices),
+        ...                         metrics=[Spearman(), MeanSquaredError()])
+        >>> results = train.search(lambda hidden_dim: RegressionHead(1280, hidden_dim=hidden_dim),
+        ...                        {"hidden_dim": [0, 256], "lr": [1e-3, 1e-4]}, epochs=100)
+        >>> results[0]["params"], results[0]["scores"]
+        ({'hidden_dim': 256, 'lr': 0.001}, {'Spm': 0.71, 'Mse': 0.42})
+    """
+    FIT_ARGS = ("epochs", "lr", "weight_decay", "batch_size", "seed")
+
+    def __init__(self, train_data: FeatureDataset, valid_data: Optional[FeatureDataset] = None,
+                 metrics: Optional[Sequence] = None, loss: Optional[Callable] = None,
+                 device: Union[str, torch.device] = "cpu"):
+        self.train_data = train_data
+        self.valid_data = valid_data
+        self.metrics = list(metrics) if metrics is not None else [Spearman()]
+        self.loss = loss if loss is not None else F.mse_loss
+        self.device = torch.device(device)
+        self.stats = {}
+
+    def fit(self, head: torch.nn.Module, epochs: int = 100, lr: float = 1e-3, weight_decay: float = 0.0,
+            batch_size: int = 256, seed: int = 0) -> Dict[str, Any]:
+        """
+        Train a head with AdamW
+
+        Args:
+            head (nn.Module): maps (features, mask) to predictions, e.g. :class:`RegressionHead`
+            epochs (int): passes over the training records
+            lr (float): learning rate
+            weight_decay (float): weight decay
+            batch_size (int): records per step
+            seed (int): seed of the order of the records
+
+        Returns:
+            {"loss": mean training loss of the last epoch, "scores": validation scores, empty without
+            validation data}
+        """
+        head = head.to(self.device).train()
+        optimizer = torch.optim.AdamW(head.parameters(), lr=lr, weight_decay=weight_decay)
+        generator = torch.Generator().manual_seed(seed)
+        start, loss_sum = time.perf_counter(), 0.0
+        for epoch in range(epochs):
+            loss_sum = 0.0
+            for features, mask, labels in self.train_data.batches(batch_size, shuffle=True, generator=generator):
+                features, labels = features.to(self.device), labels.to(self.device)
+                mask = mask.to(self.device) if mask is not None else None
+                optimizer.zero_grad()
+                loss = self.loss(head(features, mask), labels)
+                loss.backward()
+                optimizer.step()
+                loss_sum += loss.item() * len(labels)
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            "epochs": epochs,
+            "seconds": elapsed,
+            "records_per_second": epochs * len(self.train_data) / elapsed if elapsed > 0 else 0.0,
+        }
+        result = {"loss": loss_sum / max(len(self.train_data), 1), "scores": {}}
+        if self.valid_data is not None:
+            result["scores"] = self.evaluate(head, self.valid_data)
+        return result
+
+    def predict(self, head: torch.nn.Module, data: FeatureDataset, batch_size: int = 1024) -> torch.Tensor:
+        """
+        Predictions of a head on every record of ``data``, in dataset order
+        """
+        head = head.to(self.device).eval()
+        predictions = []
+        with torch.no_grad():
+            for features, mask, _ in data.batches(batch_size):
+                mask = mask.to(self.device) if mask is not None else None
+                predictions.append(head(features.to(self.device), mask).float().cpu())
+        head.train()
+        return torch.cat(predictions)
+
+    def evaluate(self, head: torch.nn.Module, data: FeatureDataset) -> Dict[str, float]:
+        """
+        Scores of a head on ``data``, metric repr => value
+        """
+        predictions = self.predict(head, data).numpy()
+        return {repr(metric): float(metric.compute_once(data.labels.numpy(), predictions))
+                for metric in self.metrics}
+
+    def search(self, build_head: Callable[..., torch.nn.Module], grid: Dict[str, Sequence],
+               select: Optional[str] = None, maximize: bool = True, **fit_kwargs) -> List[Dict[str, Any]]:
+        """
+        Train a head for every combination of the hyperparameters of ``grid``
+
+        Args:
+            build_head (Callable): builds a new head from the grid entries that are not arguments of :meth:`fit`
+            grid (dict): hyperparameter => values; "epochs", "lr", "weight_decay", "batch_size" and "seed" go
+                to :meth:`fit`, the others to ``build_head``
+            select (str, optional): score the results are ranked by, default the first metric
+            maximize (bool): a higher score is better, False for errors like "Mse"
+            fit_kwargs: fixed arguments of :meth:`fit`
+
+        Returns:
+            one {"params", "loss", "scores", "head"} per combination, best first when there is validation data
+        """
+        names = list(grid)
+        results = []
+        for values in itertools.product(*(grid[name] for name in names)):
+            params = dict(zip(names, values))
+            head = build_head(**{k: v for k, v in params.items() if k not in self.FIT_ARGS})
+            result = self.fit(head, **{**fit_kwargs, **{k: v for k, v in params.items() if k in self.FIT_ARGS}})
+            result.update(params=params, head=head)
+            logging.info(f"{params} loss {result['loss']:.4f} scores {result['scores']}")
+            results.append(result)
+        if self.valid_data is not None:
+            key = select if select is not None else repr(self.metrics[0])
+            results.sort(key=lambda r: -np.nan_to_num(r["scores"][key], nan=-np.inf) if maximize
+                         else np.nan_to_num(r["scores"][key], nan=np.inf))
+        return results
@@ -0,0 +1,438 @@
+import os
+import json
+import time
+import bisect
+import logging
+import itertools
+from typing import *
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from openprotein.data.fasta import read_fasta
+from openprotein.data.process import BatchConverter
+from openprotein.data.sampler import TokenBudgetBatchSampler
+
+
+class EmbeddingStore(object):
+    """
+    On-disk store of embeddings, written shard by shard as memory-mapped ``.npy`` files with a json index.
+
+    Layout of the store directory::
+
+        index.json                          fields, shards and the settings the store was written with
+        shard_00000.ids.txt                 names of the records of the shard, one per line
+        shard_00000.<field>.npy             pooled field, one row per record, e.g. ``mean_33`` [n, embed_dim]
+        shard_00000.<field>.npy             per-residue field, the residues of all records [sum(lengths), embed_dim]
+        shard_00000.offsets.npy             row range of every record in the per-residue fields [n + 1]
+
+    A shard is only added to the index once all of its rows are written, so an interrupted run never
+    leaves a half written shard visible to readers.
+
+    Args:
+        path (str): directory of the store, created if it does not exist
+
+    Examples:
+        >>> store = EmbeddingStore("./embeddings")
+        >>> len(store), store.fields
+        (1000, ['mean_33'])
+        >>> store.get("mean_33", 0).shape
+        (1280,)
+    """
+    INDEX = "index.json"
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, self.INDEX)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+        else:
+            self.index = {"fields": {}, "settings": {}, "shards": []}
+        self._arrays = {}
+        self._update_offsets()
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self.index["fields"])
+
+    @property
+    def settings(self) -> dict:
+        return self.index["settings"]
+
+    @property
+    def num_shards(self) -> int:
+        return len(self.index["shards"])
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def setup(self, fields: Dict[str, dict], settings: dict):
+        """
+        Declare the fields and the settings of the store, or check them against an existing store
+
+        Args:
+            fields (dict): field name => {"dim": int, "dtype": str, "per_residue": bool}
+            settings (dict): json serializable settings the content depends on
+
+        Raises:
+            ValueError: the store already holds shards written with other fields or settings
+        """
+        if self.num_shards and (self.index["fields"] != fields or self.index["settings"] != settings):
+            raise ValueError(
+                f"The store {self.path} was written with fields {self.index['fields']} and settings "
+                f"{self.index['settings']}, get {fields} and {settings}"
+            )
+        self.index["fields"] = fields
+        self.index["settings"] = settings
+        self._commit()
+
+    def create_shard(self, ids: Sequence[str], lengths: Optional[Sequence[int]] = None) -> "ShardWriter":
+        """
+        Allocate the files of the next shard
+
+        Args:
+            ids (Sequence[str]): names of the records of the shard
+            lengths (Sequence[int], optional): residues of every record, needed by per-residue fields
+
+        Returns:
+            ShardWriter
+        """
+        return ShardWriter(self, f"shard_{self.num_shards:05d}", ids, lengths)
+
+    def ids(self) -> Iterator[str]:
+        """
+        Names of all the records, in store order
+        """
+        for shard in self.index["shards"]:
+            with open(self._file(shard["name"], "ids.txt"), "r") as f:
+                for line in f:
+                    yield line.rstrip("\n")
+
+    def array(self, field: str, shard: int) -> np.ndarray:
+        """
+        The read-only memory map of one field of one shard
+        """
+        key = (field, shard)
+        if key not in self._arrays:
+            name = self.index["shards"][shard]["name"]
+            self._arrays[key] = np.load(self._file(name, f"{field}.npy"), mmap_mode="r")
+        return self._arrays[key]
+
+    def offsets(self, shard: int) -> np.ndarray:
+        """
+        Row range of every record of one shard in its per-residue fields
+        """
+        return self.array("offsets", shard)
+
+    def get(self, field: str, index: int) -> np.ndarray:
+        """
+        Embedding of one record
+
+        Args:
+            field (str): name of the field, e.g. ``mean_33``
+            index (int): position of the record in the store
+
+        Returns:
+            [dim] for pooled fields, [length, dim] for per-residue fields
+        """
+        if index < 0 or index >= len(self):
+            raise IndexError(f"index {index} out of range for a store of {len(self)} records")
+        shard = bisect.bisect_right(self._starts, index) - 1
+        row = index - self._starts[shard]
+        if self.index["fields"][field]["per_residue"]:
+            offsets = self.offsets(shard)
+            return self.array(field, shard)[offsets[row]:offsets[row + 1]]
+        return self.array(field, shard)[row]
+
+    def _file(self, shard_name: str, suffix: str) -> str:
+        return os.path.join(self.path, f"{shard_name}.{suffix}")
+
+    def _add_shard(self, name: str, size: int):
+        self.index["shards"].append({"name": name, "size": size})
+        self._commit()
+        self._update_offsets()
+
+    def _update_offsets(self):
+        self._starts = [0]
+        for shard in self.index["shards"]:
+            self._starts.append(self._starts[-1] + shard["size"])
+
+    def _commit(self):
+        # write then rename, so the index on disk is always complete
+        index_path = os.path.join(self.path, self.INDEX)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+class ShardWriter(object):
+    """
+    Writes the rows of one shard of an :class:`EmbeddingStore` in any order, see ``EmbeddingStore.create_shard``
+    """
+
+    def __init__(self, store: EmbeddingStore, name: str, ids: Sequence[str], lengths: Optional[Sequence[int]]):
+        self.store = store
+        self.name = name
+        self.size = len(ids)
+        self._arrays = {}
+        self._offsets = None
+
+        with open(store._file(name, "ids.txt"), "w") as f:
+            f.writelines(f"{i}\n" for i in ids)
+
+        fields = store.index["fields"]
+        if any(spec["per_residue"] for spec in fields.values()):
+            if lengths is None:
+                raise ValueError("lengths are needed by per-residue fields")
+            self._offsets = np.zeros(self.size + 1, dtype=np.int64)
+            np.cumsum(lengths, out=self._offsets[1:])
+            np.save(store._file(name, "offsets.npy"), self._offsets)
+        for field, spec in fields.items():
+            rows = int(self._offsets[-1]) if spec["per_residue"] else self.size
+            self._arrays[field] = np.lib.format.open_memmap(
+                store._file(name, f"{field}.npy"), mode="w+", dtype=spec["dtype"], shape=(rows, spec["dim"])
+            )
+
+    def write(self, field: str, row: int, value: np.ndarray):
+        """
+        Write the embedding of the record at position ``row`` of the shard
+        """
+        if self._offsets is not None and self.store.index["fields"][field]["per_residue"]:
+            self._arrays[field][self._offsets[row]:self._offsets[row + 1]] = value
+        else:
+            self._arrays[field][row] = value
+
+    def commit(self):
+        """
+        Flush the shard to disk and make it visible in the index
+        """
+        for array in self._arrays.values():
+            array.flush()
+        self._arrays.clear()
+        self.store._add_shard(self.name, self.size)
+
+
+class Embedding(object):
+    """
+    Batch embedding extraction engine.
+
+    Records are read from a FASTA file or an LMDB dataset chunk by chunk. Identical sequences of a chunk are
+    embedded once, and with a cache only the sequences missing from it are computed. They are sorted by length
+    and cut into token-budget batches, the model runs under ``torch.inference_mode`` and only up to the deepest
+    requested layer, and the pooled embeddings are streamed into an :class:`EmbeddingStore` shard, one shard
+    per chunk. Running again on the same output directory resumes after the last complete shard.
+
+    Args:
+        model (Esm1b): the protein language model
+        alphabet (Alphabet): the alphabet of the model
+        repr_layers (Sequence[int], optional): layers to extract, default the last layer
+        pooling (Sequence[str]): any of "mean" (average over residues), "cls" (the <cls> token)
+            and "per_residue" (every residue, stored ragged)
+        max_tokens (int): padded tokens of one batch
+        chunk_size (int): records per shard, also the granularity of resuming
+        dtype (str): dtype of the stored embeddings, "float32" or "float16"
+        truncation_seq_length (int, optional): longer sequences are truncated,
+            default ``max_positions - 2`` of the model
+        cache (EmbeddingCache, optional): embeddings already computed by this model are read from the cache
+            instead, and new ones are added to it
+
+    Examples:
+        >>> embedding = Embedding(model, alphabet, repr_layers=[33], pooling=["mean", "cls"])
+        >>> store = embedding.run("./uniref50.fasta", "./embeddings")
+        >>> embedding.stats["sequences_per_second"]
+        35.2
+        >>> store.get("mean_33", 0).shape
+        (1280,)
+    """
+    POOLINGS = ("mean", "cls", "per_residue")
+
+    def __init__(self, model, alphabet, repr_layers: Optional[Sequence[int]] = None,
+                 pooling: Sequence[str] = ("mean",), max_tokens: int = 4096, chunk_size: int = 100000,
+                 dtype: str = "float32", truncation_seq_length: Optional[int] = None, cache=None):
+        for p in pooling:
+            if p not in self.POOLINGS:
+                raise ValueError(f"pooling must be one of {self.POOLINGS}, get {p}")
+        self.model = model
+        self.alphabet = alphabet
+        self.repr_layers = list(repr_layers) if repr_layers is not None else [model.args.num_layers]
+        self.pooling = list(pooling)
+        self.max_tokens = max_tokens
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        if truncation_seq_length is None:
+            truncation_seq_length = model.args.max_positions - int(alphabet.prepend_bos) - int(alphabet.append_eos)
+        self.truncation_seq_length = truncation_seq_length
+        self.converter = BatchConverter(alphabet, truncation_seq_length)
+        self.cache = cache
+        self.stats = {}
+
+    @property
+    def fields(self) -> Dict[str, dict]:
+        return {
+            f"{p}_{layer}": {"dim": self.model.args.embed_dim, "dtype": self.dtype, "per_residue": p == "per_residue"}
+            for layer in self.repr_layers for p in self.pooling
+        }
+
+    @property
+    def settings(self) -> dict:
+        return {
+            "repr_layers": self.repr_layers,
+            "pooling": self.pooling,
+            "chunk_size": self.chunk_size,
+            "truncation_seq_length": self.truncation_seq_length,
+        }
+
+    def run(self, source: Union[str, Iterable[Tuple[str, str]]], output: str) -> EmbeddingStore:
+        """
+        Embed every record of the source into the store at ``output``
+
+        Args:
+            source (str or Iterable): a FASTA file, an LMDB dataset directory, or an iterable of (name, sequence)
+            output (str): directory of the :class:`EmbeddingStore`
+
+        Returns:
+            EmbeddingStore
+        """
+        store = EmbeddingStore(output)
+        store.setup(self.fields, self.settings)
+        records = self.read_source(source)
+        done = len(store)
+        if done:
+            logging.info(f"resume {output} after {done} records")
+            records = itertools.islice(records, done, None)
+
+        self.model.eval()
+        num_sequences, num_computed, num_tokens, start = 0, 0, 0, time.perf_counter()
+        hits, lookups = 0, 0
+        progress = tqdm(unit="seq", initial=done)
+        while True:
+            chunk = list(itertools.islice(records, self.chunk_size))
+            if not chunk:
+                break
+            ids, sequences = zip(*chunk)
+            sequences = [self.converter.truncate(s) for s in sequences]
+            lengths = [len(self.converter.encode(s)) for s in sequences]
+            writer = store.create_shard(ids, lengths)
+
+            # identical sequences of the chunk are embedded once
+            rows = {}
+            for row, sequence in enumerate(sequences):
+                rows.setdefault(sequence, []).append(row)
+            unique = list(rows)
+            if self.cache is not None:
+                unique = self._write_cached(writer, rows)
+                lookups += len(rows)
+                hits += len(rows) - len(unique)
+            progress.update(len(sequences) - sum(len(rows[s]) for s in unique))
+
+            unique_lengths = [lengths[rows[s][0]] for s in unique]
+            for batch in TokenBudgetBatchSampler(unique_lengths, self.max_tokens):
+                batch_sequences = [unique[i] for i in batch]
+                self._embed_batch(writer, rows, batch_sequences)
+                num_computed += len(batch)
+                num_tokens += sum(unique_lengths[i] for i in batch)
+                progress.update(sum(len(rows[s]) for s in batch_sequences))
+                progress.set_postfix(seq_per_s=f"{(progress.n - done) / (time.perf_counter() - start):.1f}")
+            writer.commit()
+            num_sequences += len(sequences)
+        progress.close()
+
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            "sequences": num_sequences,
+            "computed": num_computed,
+            "tokens": num_tokens,
+            "seconds": elapsed,
+            "sequences_per_second": num_sequences / elapsed if elapsed > 0 else 0.0,
+        }
+        if self.cache is not None:
+            self.stats["cache_hit_rate"] = hits / lookups if lookups else 0.0
+        logging.info(f"embedded {num_sequences} sequences ({num_computed} computed) in {elapsed:.1f}s, "
+                     f"{self.stats['sequences_per_second']:.1f} seq/s")
+        return store
+
+    @staticmethod
+    def read_source(source: Union[str, Iterable[Tuple[str, str]]]) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate (name, sequence) over a FASTA file, an LMDB dataset directory, or an iterable of records
+        """
+        if not isinstance(source, str):
+            return iter(source)
+        if os.path.isdir(source):
+            from openprotein.data.dataset import PTDataFactory
+            dataset = PTDataFactory.PTDataset(source)
+            return ((str(i), dataset[i]) for i in range(len(dataset)))
+        return read_fasta(source)
+
+    @property
+    def precision(self) -> str:
+        """
+        Precision the model runs at, part of the cache keys
+        """
+        return getattr(self.model, "precision", "fp32")
+
+    def _device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    def _write_cached(self, writer: ShardWriter, rows: Dict[str, List[int]]) -> List[str]:
+        keys = [(layer, p) for layer in self.repr_layers for p in self.pooling]
+        values = self.cache.get_many([(sequence, layer, p) for sequence in rows for layer, p in keys], self.dtype,
+                                     self.precision)
+        misses = []
+        for i, sequence in enumerate(rows):
+            cached = values[i * len(keys):(i + 1) * len(keys)]
+            if any(value is None for value in cached):
+                misses.append(sequence)
+                continue
+            for (layer, p), value in zip(keys, cached):
+                for row in rows[sequence]:
+                    writer.write(f"{p}_{layer}", row, value)
+        return misses
+
+    def _embed_batch(self, writer: ShardWriter, rows: Dict[str, List[int]], sequences: List[str]):
+        tokens = self.converter(sequences).to(self._device())
+        outputs = self.embed_tokens(tokens)
+        for field, values in outputs.items():
+            for sequence, value in zip(sequences, values):
+                for row in rows[sequence]:
+                    writer.write(field, row, value)
+        if self.cache is not None:
+            self.cache.put_many([
+                (sequence, layer, p, outputs[f"{p}_{layer}"][i])
+                for i, sequence in enumerate(sequences) for layer in self.repr_layers for p in self.pooling
+            ], self.precision)
+
+    def embed_tokens(self, tokens: torch.Tensor) -> Dict[str, List[np.ndarray]]:
+        """
+        Run the model on a token batch and pool the representations
+
+        Args:
+            tokens (torch.Tensor): [B, T] tokens from :class:`BatchConverter`
+
+        Returns:
+            field name => B arrays, each [dim] for pooled fields or [length, dim] for per-residue fields
+        """
+        with torch.inference_mode():
+            result = self.model(tokens, repr_layers=self.repr_layers, return_logits=False)
+
+            residue_mask = tokens.ne(self.alphabet.padding_idx)
+            residue_mask &= tokens.ne(self.alphabet.cls_idx) & tokens.ne(self.alphabet.eos_idx)
+            lengths = residue_mask.sum(1)
+            outputs = {}
+            for layer in self.repr_layers:
+                representations = result["representations"][layer].float()
+                for p in self.pooling:
+                    if p == "mean":
+                        pooled = (representations * residue_mask.unsqueeze(-1)).sum(1)
+                        pooled = pooled / lengths.clamp(min=1).unsqueeze(-1)
+                        values = list(pooled.cpu().numpy().astype(self.dtype))
+                    elif p == "cls":
+                        values = list(representations[:, 0].cpu().numpy().astype(self.dtype))
+                    else:
+                        values = [r[m].cpu().numpy().astype(self.dtype)
+                                  for r, m in zip(representations, residue_mask)]
+                    outputs[f"{p}_{layer}"] = values
+        return outputs
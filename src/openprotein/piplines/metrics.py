@@ -614,3 +614,30 @@ def f1(true, pred, *, labels=None, pos_label=1, average="binary", sample_weight=
     """
     return f1_score(true, pred, labels=labels, pos_label=pos_label, average=average, sample_weight=sample_weight,
                     zero_division=zero_division)
+
+
+def contact_precision(true, pred, *, min_separation=6, top=1.0):
+    """
+    Precision of the ``top * L`` most probable contacts of a protein of L residues, among the pairs at least
+    ``min_separation`` residues apart, e.g. the precision at L of the long range contacts with ``min_separation=24``.
+
+    Args:
+        true (array-like): [L, L] true contacts, boolean or 0/1
+        pred (array-like): [L, L] predicted contact probabilities
+        min_separation (int): minimum sequence separation of the scored pairs
+        top (float): scored contacts relative to L, 1.0 for P@L, 0.2 for P@L/5
+
+    Returns:
+        precision (float)
+
+    Examples:
+        >>> contact_precision(true_contacts, model.predict_contacts(tokens)[0, :L, :L], min_separation=24)
+        0.62
+    """
+    true = np.asarray(true).astype(bool)
+    pred = np.asarray(pred, dtype=np.float64)
+    i, j = np.triu_indices(pred.shape[0], min_separation)
+    if len(i) == 0:
+        return 0.0
+    order = np.argsort(-pred[i, j], kind="stable")[:max(1, int(top * pred.shape[0]))]
+    return float(true[i[order], j[order]].mean())
@@ -0,0 +1,273 @@
+import re
+import copy
+import logging
+from typing import *
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from openprotein.layers.parallel import shard_range
+from openprotein.models.esm1b import ProteinBertModel
+from openprotein.models.weights import read_checkpoint, materialize
+
+_LAYER = re.compile(r"^layers\.(\d+)\.(.*)$")
+
+
+class PipelineStage(nn.Module):
+    """
+    One stage of a pipeline-parallel ``ProteinBertModel``: a contiguous range of its layers, with the
+    embeddings on the first stage and the final LayerNorm and ``lm_head`` on the last.
+
+    The model is built on the meta device and only the modules of the stage are materialized, from a
+    memory-mapped checkpoint or by their random initialization, so a stage never holds the whole model.
+    The LM head weight is tied to the token embedding; when they live on different stages,
+    :class:`PipelineTrain` keeps the two copies equal.
+
+    Args:
+        args (argparse.Namespace): arguments of the model
+        alphabet (Alphabet): the alphabet of the model
+        stage (int): index of the stage
+        num_stages (int): number of stages
+        partition (Sequence[int], optional): number of layers of every stage, default an even split
+        checkpoint_path (str, optional): weights of the whole model, see ``--checkpoint_path``
+
+    Examples:
+        >>> stage = PipelineStage(args, alphabet, dist.get_rank(), dist.get_world_size(), partition=[9, 8, 8, 8])
+        >>> stage.layer_range
+        (0, 9)
+    """
+
+    def __init__(self, args, alphabet, stage: int, num_stages: int, partition: Optional[Sequence[int]] = None,
+                 checkpoint_path: Optional[str] = None):
+        super().__init__()
+        if partition is None:
+            partition = [end - start for start, end in
+                         (shard_range(args.num_layers, s, num_stages) for s in range(num_stages))]
+        if len(partition) != num_stages or sum(partition) != args.num_layers:
+            raise ValueError(f"partition {partition} does not split {args.num_layers} layers into {num_stages} stages")
+        self.stage = stage
+        self.num_stages = num_stages
+        self.is_first = stage == 0
+        self.is_last = stage == num_stages - 1
+        start = sum(partition[:stage])
+        self.layer_range = (start, start + partition[stage])
+
+        args = copy.copy(args)
+        args.checkpoint_path = None
+        with torch.device("meta"):
+            model = ProteinBertModel(args, alphabet)
+        model.layers = nn.ModuleList(model.layers[self.layer_range[0]:self.layer_range[1]])
+        del model.contact_head
+        if not self.is_first:
+            del model.embed_tokens, model.embed_positions, model.emb_layer_norm_before
+        if not self.is_last:
+            del model.emb_layer_norm_after, model.lm_head
+        self.model = model
+        if checkpoint_path:
+            self.model.load_state_dict(self._local_state_dict(read_checkpoint(checkpoint_path)), strict=False,
+                                       assign=True)
+        self._materialize()
+
+    @property
+    def layers(self) -> nn.ModuleList:
+        return self.model.layers
+
+    def global_name(self, name: str) -> str:
+        """
+        Name of a parameter of the stage in the whole model, with the global layer index
+        """
+        match = _LAYER.match(name)
+        if match is None:
+            return name
+        return f"layers.{int(match.group(1)) + self.layer_range[0]}.{match.group(2)}"
+
+    def global_state_dict(self) -> Dict[str, torch.Tensor]:
+        """
+        State dict of the stage under the names of the whole model, the union over the stages is a checkpoint
+        of the whole model
+        """
+        return {self.global_name(name): tensor for name, tensor in self.model.state_dict().items()}
+
+    def forward(self, x, padding_mask=None):
+        """
+        Run the layers of the stage
+
+        Args:
+            x (torch.Tensor): tokens (B, T) on the first stage, the (T, B, E) output of the previous stage otherwise
+            padding_mask (torch.Tensor, optional): (B, T) padding of the batch
+
+        Returns:
+            (T, B, E) hidden states, after the final LayerNorm on the last stage
+        """
+        if self.is_first:
+            x = self.model.embed(x).transpose(0, 1)
+        for layer in self.model.layers:
+            x, _ = layer(x, self_attn_padding_mask=padding_mask)
+        if self.is_last:
+            x = self.model.emb_layer_norm_after(x)
+        return x
+
+    def _local_state_dict(self, state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        local = {}
+        names = set(self.model.state_dict())
+        for name, tensor in state_dict.items():
+            match = _LAYER.match(name)
+            if match is not None:
+                index = int(match.group(1)) - self.layer_range[0]
+                name = f"layers.{index}.{match.group(2)}"
+            if name in names:
+                local[name] = tensor
+        return local
+
+    def _materialize(self):
+        materialize(self.model)
+        if self.is_first and self.is_last:
+            self.model.lm_head.weight = self.model.embed_tokens.weight
+
+
+class PipelineTrain(object):
+    """
+    Pipeline-parallel masked language model training over a ``torch.distributed`` process group, one process
+    per :class:`PipelineStage` (rank ``i`` runs stage ``i``), e.g. gloo across CPU machines.
+
+    Every batch is split into ``num_micro_batches`` micro-batches that flow through the stages: activations are
+    sent forward and their gradients backward with point-to-point messages. The "gpipe" schedule runs all the
+    forwards before the backwards and stores the activations of every micro-batch; "1f1b" alternates one
+    forward and one backward once the pipeline is full, so a stage stores at most ``num_stages - stage``
+    micro-batches. The loss is the mean cross entropy over the scored tokens of the whole batch, the same
+    gradients as an unsplit batch.
+
+    Every rank iterates the same batches: tokens and targets are cheap next to the activations, and knowing
+    them gives every stage the padding mask and the shapes of the messages. When the LM head and the
+    embedding live on different stages, their gradients are summed between the first and the last stage
+    before the optimizer step, so the tied weights stay equal.
+
+    Args:
+        stage (PipelineStage): the stage of this rank
+        optimizer: optimizer of ``stage.parameters()``
+        padding_idx (int): padding index of the alphabet, also the ignored target
+        num_micro_batches (int): micro-batches per batch
+        schedule (str): "gpipe" or "1f1b"
+
+    Examples:
+        >>> dist.init_process_group("gloo", rank=rank, world_size=4)
+        >>> stage = PipelineStage(args, alphabet, rank, 4, checkpoint_path="esm1b.pt")
+        >>> train = PipelineTrain(stage, torch.optim.Adam(stage.parameters(), lr=1e-5), alphabet.padding_idx,
+        ...                       num_micro_batches=8)
+        >>> train.fit(dataloader)
+    """
+    SCHEDULES = ("gpipe", "1f1b")
+
+    def __init__(self, stage: PipelineStage, optimizer, padding_idx: int, num_micro_batches: int = 4,
+                 schedule: str = "1f1b"):
+        if schedule not in self.SCHEDULES:
+            raise ValueError(f"schedule must be one of {self.SCHEDULES}, get {schedule}")
+        if dist.get_world_size() != stage.num_stages or dist.get_rank() != stage.stage:
+            raise ValueError("rank i of the process group must run stage i")
+        self.stage = stage
+        self.optimizer = optimizer
+        self.padding_idx = padding_idx
+        self.num_micro_batches = num_micro_batches
+        self.schedule = schedule
+        self._tie_group = None
+        if stage.num_stages > 1:
+            # every rank takes part in the creation of a group
+            self._tie_group = dist.new_group([0, stage.num_stages - 1])
+            self._sync_tied(lambda tensor: dist.broadcast(tensor, 0, group=self._tie_group), grad=False)
+
+    def step(self, masked_tokens: torch.Tensor, target_tokens: torch.Tensor) -> Optional[float]:
+        """
+        One optimizer step on a batch
+
+        Returns:
+            the loss of the batch on the last stage, None on the other stages
+        """
+        stage = self.stage
+        self.stage.train()
+        self.optimizer.zero_grad()
+        micro_tokens = masked_tokens.chunk(self.num_micro_batches)
+        micro_targets = target_tokens.chunk(self.num_micro_batches)
+        num_micro = len(micro_tokens)
+        scored = target_tokens.ne(self.padding_idx).sum().clamp(min=1)
+        inputs, outputs, sends, losses = {}, {}, [], []
+
+        def forward(m):
+            tokens = micro_tokens[m]
+            padding_mask = tokens.eq(self.padding_idx)
+            padding_mask = padding_mask if padding_mask.any() else None
+            if stage.is_first:
+                x = tokens
+            else:
+                x = torch.empty(tokens.size(1), tokens.size(0), stage.model.args.embed_dim)
+                dist.recv(x, stage.stage - 1)
+                x.requires_grad_()
+                inputs[m] = x
+            y = stage(x, padding_mask)
+            if stage.is_last:
+                targets = micro_targets[m]
+                mask = targets.ne(self.padding_idx)
+                logits = stage.model.lm_head(y.transpose(0, 1)[mask])
+                y = F.cross_entropy(logits, targets[mask], reduction="sum") / scored
+                losses.append(y.detach())
+            else:
+                sends.append(dist.isend(y.detach().contiguous(), stage.stage + 1))
+            outputs[m] = y
+
+        def backward(m):
+            y = outputs.pop(m)
+            if stage.is_last:
+                y.backward()
+            else:
+                grad = torch.empty(y.shape, dtype=y.dtype)
+                dist.recv(grad, stage.stage + 1)
+                y.backward(grad)
+            if not stage.is_first:
+                sends.append(dist.isend(inputs.pop(m).grad.contiguous(), stage.stage - 1))
+
+        if self.schedule == "gpipe":
+            for m in range(num_micro):
+                forward(m)
+            for m in range(num_micro):
+                backward(m)
+        else:
+            warmup = min(stage.num_stages - stage.stage - 1, num_micro)
+            for m in range(warmup):
+                forward(m)
+            for m in range(num_micro - warmup):
+                forward(warmup + m)
+                backward(m)
+            for m in range(num_micro - warmup, num_micro):
+                backward(m)
+        for work in sends:
+            work.wait()
+
+        if self._tie_group is not None:
+            self._sync_tied(lambda tensor: dist.all_reduce(tensor, group=self._tie_group), grad=True)
+        self.optimizer.step()
+        return float(sum(losses)) if stage.is_last else None
+
+    def fit(self, dataloader, epochs: int = 1):
+        """
+        Train on batches of (origin_tokens, masked_tokens, target_tokens), the same batches on every rank
+        """
+        for epoch in range(epochs):
+            for origin_tokens, masked_tokens, target_tokens in tqdm(dataloader, disable=not self.stage.is_last):
+                loss = self.step(masked_tokens, target_tokens)
+                if loss is not None:
+                    logging.info(f"epoch {epoch} loss {loss:.4f}")
+
+    def _sync_tied(self, collective: Callable, grad: bool):
+        stage = self.stage
+        if not (stage.is_first or stage.is_last):
+            return
+        weight = stage.model.embed_tokens.weight if stage.is_first else stage.model.lm_head.weight
+        if grad:
+            if weight.grad is None:
+                weight.grad = torch.zeros_like(weight)
+            collective(weight.grad)
+        else:
+            with torch.no_grad():
+                collective(weight.data)
@@ -0,0 +1,169 @@
+import math
+import time
+import random
+import logging
+import itertools
+from typing import *
+
+import torch
+
+from openprotein.data.process import BatchConverter
+from openprotein.data.sampler import TokenBudgetBatchSampler
+from openprotein.piplines.embedding import Embedding
+
+
+class PseudoLikelihood(object):
+    """
+    Batched pseudo-log-likelihood of many sequences.
+
+    The PLL of a sequence is the sum over its positions of ``log p(residue | sequence with the position masked)``.
+    The masked copies of a chunk of sequences are built together, sorted by length and cut into token-budget
+    batches, so copies of different sequences share forwards and padding stays small. The LM head only runs
+    on the masked positions. A sequence is yielded as soon as all of its copies are scored.
+
+    Modes:
+
+    * "exact": one copy per position, L forwards worth of compute per sequence
+    * "disjoint": every copy masks ``k`` positions spread over the sequence (stride ``ceil(L / k)``), so a
+      sequence takes ``ceil(L / k)`` copies; an approximation, the masked positions do not see each other
+    * "subset": only ``num_positions`` random positions are scored, one per copy, and the PLL is extrapolated
+      to the whole sequence as ``L * mean``
+
+    Args:
+        model (Esm1b): the protein language model
+        alphabet (Alphabet): the alphabet of the model
+        mode (str): "exact", "disjoint" or "subset"
+        k (int): masked positions per copy in "disjoint" mode
+        num_positions (int): scored positions per sequence in "subset" mode
+        max_tokens (int): padded tokens of one batch
+        chunk_size (int): sequences whose copies are batched together
+        seed (int): seed of the positions drawn in "subset" mode
+
+    Examples:
+        >>> pll = PseudoLikelihood(model, alphabet, mode="disjoint", k=8, max_tokens=16384)
+        >>> for name, result in pll.run("./designs.fasta"):
+        ...     print(name, result["pll"], result["mean_log_prob"])
+        >>> pll.stats["sequences_per_second"]
+        12.5
+    """
+    MODES = ("exact", "disjoint", "subset")
+
+    def __init__(self, model, alphabet, mode: str = "exact", k: int = 4, num_positions: int = 32,
+                 max_tokens: int = 4096, chunk_size: int = 1000, seed: int = 0):
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {self.MODES}, get {mode}")
+        self.model = model
+        self.alphabet = alphabet
+        self.mode = mode
+        self.k = k
+        self.num_positions = num_positions
+        self.max_tokens = max_tokens
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.converter = BatchConverter(alphabet)
+        self.max_length = model.args.max_positions - int(alphabet.prepend_bos) - int(alphabet.append_eos)
+        self.stats = {}
+
+    def masking_schedule(self, length: int, rng: Optional[random.Random] = None) -> List[List[int]]:
+        """
+        The 0-based positions masked in every copy of a sequence of this length
+        """
+        if self.mode == "exact":
+            return [[i] for i in range(length)]
+        if self.mode == "disjoint":
+            stride = math.ceil(length / self.k)
+            return [list(range(start, length, stride)) for start in range(stride)]
+        rng = rng if rng is not None else random.Random(self.seed)
+        return [[i] for i in sorted(rng.sample(range(length), min(self.num_positions, length)))]
+
+    def run(self, source: Union[str, Iterable[Tuple[str, str]]]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Score every record of the source, ``stats`` is filled once the iterator is exhausted
+
+        Args:
+            source (str or Iterable): a FASTA file, an LMDB dataset directory, or an iterable of (name, sequence)
+
+        Yields:
+            (name, {"pll": float, "mean_log_prob": float, "scored": int, "length": int}) in completion order
+        """
+        records = Embedding.read_source(source)
+        rng = random.Random(self.seed)
+        num_sequences, num_copies, num_forwards, num_tokens = 0, 0, 0, 0
+        start = time.perf_counter()
+        self.model.eval()
+        while True:
+            chunk = list(itertools.islice(records, self.chunk_size))
+            if not chunk:
+                break
+            for name, sequence in chunk:
+                if len(sequence) > self.max_length:
+                    raise ValueError(f"{name} is longer than the {self.max_length} residues the model can score")
+
+            # copies: (sequence index, masked positions)
+            copies = [(i, positions) for i, (_, sequence) in enumerate(chunk)
+                      for positions in self.masking_schedule(len(sequence), rng)]
+            remaining = [0] * len(chunk)
+            for i, _ in copies:
+                remaining[i] += 1
+            totals = [0.0] * len(chunk)
+            scored = [0] * len(chunk)
+
+            lengths = [len(chunk[i][1]) for i, _ in copies]
+            for batch in TokenBudgetBatchSampler(lengths, self.max_tokens):
+                batch_copies = [copies[c] for c in batch]
+                log_probs = self._score_copies([chunk[i][1] for i, _ in batch_copies],
+                                               [positions for _, positions in batch_copies])
+                num_forwards += 1
+                num_tokens += len(batch) * (max(lengths[c] for c in batch) + 2)
+                for (i, positions), values in zip(batch_copies, log_probs):
+                    totals[i] += sum(values)
+                    scored[i] += len(positions)
+                    remaining[i] -= 1
+                    if remaining[i] == 0:
+                        yield chunk[i][0], self._result(totals[i], scored[i], len(chunk[i][1]))
+            # sequences without residues have no copies
+            for i, (name, sequence) in enumerate(chunk):
+                if not sequence:
+                    yield name, self._result(0.0, 0, 0)
+            num_sequences += len(chunk)
+            num_copies += len(copies)
+
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            "sequences": num_sequences,
+            "copies": num_copies,
+            "forwards": num_forwards,
+            "tokens": num_tokens,
+            "seconds": elapsed,
+            "sequences_per_second": num_sequences / elapsed if elapsed > 0 else 0.0,
+        }
+        logging.info(f"scored {num_sequences} sequences with {num_copies} masked copies in {num_forwards} forwards, "
+                     f"{elapsed:.1f}s")
+
+    def score(self, sequences: Sequence[str]) -> List[float]:
+        """
+        PLL of every sequence, in input order
+        """
+        results = dict(self.run((str(i), sequence) for i, sequence in enumerate(sequences)))
+        return [results[str(i)]["pll"] for i in range(len(sequences))]
+
+    def _result(self, total: float, scored: int, length: int) -> Dict[str, Any]:
+        mean = total / scored if scored else 0.0
+        pll = mean * length if self.mode == "subset" else total
+        return {"pll": pll, "mean_log_prob": mean, "scored": scored, "length": length}
+
+    def _score_copies(self, sequences: List[str], positions: List[List[int]]) -> List[List[float]]:
+        tokens = self.converter(sequences).to(next(self.model.parameters()).device)
+        first = int(self.alphabet.prepend_bos)
+        masked = torch.zeros_like(tokens, dtype=torch.bool)
+        for row, copy_positions in enumerate(positions):
+            masked[row, [p + first for p in copy_positions]] = True
+        targets = tokens[masked]
+        tokens = tokens.masked_fill(masked, self.alphabet.mask_idx)
+        with torch.inference_mode():
+            # compact logits of the masked positions, row by row and left to right
+            logits = self.model(tokens, logits_mask=masked)["logits"]
+            values = torch.log_softmax(logits.float(), dim=-1).gather(1, targets.unsqueeze(1)).squeeze(1)
+        values = values.cpu().tolist()
+        sizes = [len(copy_positions) for copy_positions in positions]
+        return [values[end - size:end] for size, end in zip(sizes, itertools.accumulate(sizes))]
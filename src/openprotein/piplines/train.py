@@ -1,15 +1,49 @@
 import torch
 from tqdm import tqdm
 
+from openprotein.utils.precision import autocast
+
 
 class Train(object):
+    """
+    Masked language model training loop
+
+    Args:
+        dataloader: yields (origin_tokens, masked_tokens, target_tokens) batches
+        model (Esm1b): the model to train
+        loss: loss function, e.g. ``F.cross_entropy``
+        optimizer: the optimizer of the model parameters
+        metrics (optional): metrics computed during evaluation
+        precision (str): "fp32", or "bf16" to run the forward and the loss under bf16 autocast,
+            the backward then runs in the dtypes autocast chose for the forward
+        compact_logits (bool): run the LM head and the loss only on the positions where ``target_tokens`` is not
+            ``ignore_index``, the "mean" and "sum" losses and their gradients are unchanged
+        scheduler (optional): learning rate scheduler stepped after every optimizer step, e.g. a warmup
+    """
 
-    def __init__(self, dataloader, model, loss, optimizer, metrics=None):
+    def __init__(self, dataloader, model, loss, optimizer, metrics=None, precision="fp32", compact_logits=False,
+                 scheduler=None):
         self.dl = dataloader
         self.model = model
         self.metrics = metrics
         self.optimizer = optimizer
         self.loss = loss
+        self.precision = precision
+        self.compact_logits = compact_logits
+        self.scheduler = scheduler
+
+    def _loss(self, masked_tokens, target_tokens, reduction, ignore_index):
+        if self.compact_logits:
+            scored = target_tokens.ne(ignore_index)
+            result = self.model(masked_tokens, logits_mask=scored)['logits']
+            return self.loss(result, target_tokens[scored], reduction=reduction)
+        result = self.model(masked_tokens)['logits']
+        return self.loss(
+            result.view(-1, result.size(-1)),
+            target_tokens.view(-1),
+            reduction=reduction,
+            ignore_index=ignore_index
+        )
 
     # def one_step(self, data):
 
@@ -17,26 +51,19 @@ class Train(object):
 
         data = data if data else self.dl
         for origin_tokens, masked_tokens, target_tokens in tqdm(self.dl):
-            result = self.model(masked_tokens)['logits']
-            loss = self.loss(
-                result.view(-1, result.size(-1)),
-                target_tokens.view(-1),
-                reduction=kwargs["reduction"],
-                ignore_index=kwargs["ingore_index"]
-            )
+            self.optimizer.zero_grad()
+            with autocast(self.precision, masked_tokens.device.type):
+                loss = self._loss(masked_tokens, target_tokens, kwargs["reduction"], kwargs["ingore_index"])
             loss.backward()
             self.optimizer.step()
+            if self.scheduler is not None:
+                self.scheduler.step()
             print(loss)
 
     def eval(self, *args, **kwargs):
         self.model.eval()
         with torch.no_grad():
-            for origin_tokens, masked_tokens, target_tokens in tqdm(self.dataloader):
-                result = self.model(masked_tokens)['logits']
-                loss = self.loss(
-                    result.view(-1, result.size(-1)),
-                    target_tokens.view(-1),
-                    reduction=kwargs["reduction"],
-                    ignore_index=kwargs["ingore_index"]
-                )
+            for origin_tokens, masked_tokens, target_tokens in tqdm(self.dl):
+                with autocast(self.precision, masked_tokens.device.type):
+                    loss = self._loss(masked_tokens, target_tokens, kwargs["reduction"], kwargs["ingore_index"])
                 print(loss)
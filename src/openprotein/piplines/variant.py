@@ -0,0 +1,154 @@
+import re
+import time
+import logging
+from typing import *
+
+import torch
+
+from openprotein.data.process import BatchConverter
+from openprotein.data.sampler import TokenBudgetBatchSampler
+
+_MUTATION = re.compile(r"^([A-Z])(-?\d+)([A-Z])$")
+
+
+def parse_mutant(mutant: str, offset: int = 1) -> List[Tuple[str, int, str]]:
+    """
+    Parse a mutant in the "A23G" notation, several mutations are separated by ":"
+
+    Args:
+        mutant (str): e.g. "A23G" or "A23G:L45P"
+        offset (int): index of the first residue in the notation, 1 for 1-based positions
+
+    Returns:
+        list of (wild-type residue, 0-based position, mutant residue)
+    """
+    mutations = []
+    for mutation in mutant.split(":"):
+        match = _MUTATION.match(mutation.strip())
+        if match is None:
+            raise ValueError(f"can not parse the mutation {mutation} of {mutant}")
+        wt, position, mt = match.groups()
+        mutations.append((wt, int(position) - offset, mt))
+    return mutations
+
+
+class VariantScorer(object):
+    """
+    Zero-shot variant effect scores of many mutants of one protein.
+
+    The score of a mutant is the sum over its mutations of ``log p(mutant residue) - log p(wild-type residue)``
+    at the mutated position, with the probabilities taken from
+
+    * "wt-marginals": one forward of the unmasked wild type, every mutant of every site is scored from it
+    * "masked-marginals": one forward per mutated site with that site masked. The masked copies of the
+      wild type are cut into token-budget batches, the LM head only runs on the masked position, and the
+      log-probabilities of a site are shared by all the mutants that touch it
+
+    Args:
+        model (Esm1b): the protein language model
+        alphabet (Alphabet): the alphabet of the model
+        strategy (str): "wt-marginals" or "masked-marginals"
+        max_tokens (int): padded tokens of one batch of masked copies
+        offset (int): index of the first residue in the mutant notation
+
+    Examples:
+        >>> scorer = VariantScorer(model, alphabet, strategy="masked-marginals")
+        >>> scorer.score(wild_type, ["M1A", "K5R:T6S"])
+        [{'mutant': 'M1A', 'score': -1.83}, {'mutant': 'K5R:T6S', 'score': 0.41}]
+        >>> scorer.stats["mutants_per_second"]
+        5120.4
+    """
+    STRATEGIES = ("wt-marginals", "masked-marginals")
+
+    def __init__(self, model, alphabet, strategy: str = "masked-marginals", max_tokens: int = 4096,
+                 offset: int = 1):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"strategy must be one of {self.STRATEGIES}, get {strategy}")
+        self.model = model
+        self.alphabet = alphabet
+        self.strategy = strategy
+        self.max_tokens = max_tokens
+        self.offset = offset
+        self.converter = BatchConverter(alphabet)
+        self.stats = {}
+
+    def score(self, sequence: str, mutants: Sequence[str]) -> List[Dict[str, Any]]:
+        """
+        Score the mutants of a wild-type sequence
+
+        Args:
+            sequence (str): the wild-type sequence
+            mutants (Sequence[str]): mutants in the "A23G:L45P" notation
+
+        Returns:
+            one {"mutant": str, "score": float} per mutant, in input order
+        """
+        start = time.perf_counter()
+        parsed = [self._check(sequence, mutant) for mutant in mutants]
+        sites = sorted({position for mutations in parsed for _, position, _ in mutations})
+
+        self.model.eval()
+        with torch.inference_mode():
+            if self.strategy == "wt-marginals":
+                log_probs, forwards = self._wt_marginals(sequence, sites), 1
+            else:
+                log_probs, forwards = self._masked_marginals(sequence, sites)
+
+        scores = []
+        for mutant, mutations in zip(mutants, parsed):
+            score = sum(
+                log_probs[position][self.alphabet.get_idx(mt)] - log_probs[position][self.alphabet.get_idx(wt)]
+                for wt, position, mt in mutations
+            )
+            scores.append({"mutant": mutant, "score": float(score)})
+
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            "mutants": len(mutants),
+            "sites": len(sites),
+            "forwards": forwards,
+            "seconds": elapsed,
+            "mutants_per_second": len(mutants) / elapsed if elapsed > 0 else 0.0,
+        }
+        logging.info(f"scored {len(mutants)} mutants at {len(sites)} sites with {forwards} forwards "
+                     f"in {elapsed:.2f}s")
+        return scores
+
+    def _check(self, sequence: str, mutant: str) -> List[Tuple[str, int, str]]:
+        mutations = parse_mutant(mutant, self.offset)
+        for wt, position, mt in mutations:
+            if not 0 <= position < len(sequence):
+                raise ValueError(f"position of {mutant} is out of the sequence of length {len(sequence)}")
+            if sequence[position] != wt:
+                raise ValueError(f"wild-type residue of {mutant} is {sequence[position]}, not {wt}")
+            if mt not in self.alphabet.tok_to_idx:
+                raise ValueError(f"residue {mt} of {mutant} is not in the alphabet")
+        return mutations
+
+    def _device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    def _wt_marginals(self, sequence: str, sites: List[int]) -> Dict[int, torch.Tensor]:
+        tokens = self.converter([sequence]).to(self._device())
+        log_probs = torch.log_softmax(self.model(tokens)["logits"][0].float(), dim=-1).cpu()
+        first = int(self.alphabet.prepend_bos)
+        return {site: log_probs[site + first] for site in sites}
+
+    def _masked_marginals(self, sequence: str, sites: List[int]) -> Tuple[Dict[int, torch.Tensor], int]:
+        tokens = self.converter([sequence]).to(self._device())
+        first = int(self.alphabet.prepend_bos)
+        log_probs, forwards = {}, 0
+        # every copy has the length of the wild type, the sampler only splits the sites by the budget
+        batches = TokenBudgetBatchSampler([len(sequence)] * len(sites), self.max_tokens, sort=False)
+        for batch in batches:
+            batch_sites = torch.tensor([sites[i] + first for i in batch], device=tokens.device)
+            copies = tokens.repeat(len(batch), 1)
+            masked = torch.zeros_like(copies, dtype=torch.bool)
+            masked[torch.arange(len(batch), device=tokens.device), batch_sites] = True
+            copies[masked] = self.alphabet.mask_idx
+            # one masked position per copy, the compact logits come back in copy order
+            logits = self.model(copies, logits_mask=masked)["logits"]
+            for i, row in zip(batch, torch.log_softmax(logits.float(), dim=-1).cpu()):
+                log_probs[sites[i]] = row
+            forwards += 1
+        return log_probs, forwards
@@ -0,0 +1,5 @@
+from .batcher import Request, DynamicBatcher
+from .server import InferenceServer, ServingClient
+from .worker import run_batch
+
+__all__ = ["Request", "DynamicBatcher", "InferenceServer", "ServingClient", "run_batch"]
\ No newline at end of file
@@ -0,0 +1,123 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import *
+
+
+class Request(object):
+    """
+    One pending inference request
+
+    Args:
+        kind (str): "embedding", "logits" or "contacts"
+        sequence (str): the protein sequence
+        options (dict): options of the request kind, requests are only batched with requests of the same options
+    """
+    __slots__ = ("kind", "sequence", "options", "future", "submitted", "dispatched")
+
+    def __init__(self, kind: str, sequence: str, options: Optional[dict] = None):
+        self.kind = kind
+        self.sequence = sequence
+        self.options = dict(options or {})
+        self.future = Future()
+        self.submitted = time.perf_counter()
+        self.dispatched = None
+
+    @property
+    def key(self) -> tuple:
+        return (self.kind,) + tuple(sorted(self.options.items()))
+
+
+class DynamicBatcher(object):
+    """
+    Groups pending requests into batches bounded by a token budget and a maximum wait.
+
+    Requests are grouped by kind and options, and taken in arrival order. The cost of a batch is
+    ``batch_size * (longest_length + extra_tokens)`` as in :class:`TokenBudgetBatchSampler`. A group is ready
+    once it holds more than a full batch, or ``max_batch_size`` requests, or its oldest request has waited
+    ``max_wait`` seconds; the ready group with the oldest request goes first.
+
+    Args:
+        max_tokens (int): upper bound of the padded tokens of a batch
+        max_wait (float): seconds a request may wait for the batch to fill
+        max_batch_size (int, optional): upper bound of the requests of a batch
+        extra_tokens (int): tokens added to every sequence, 2 for <cls> and <eos>
+
+    Examples:
+        >>> batcher = DynamicBatcher(max_tokens=4096, max_wait=0.01)
+        >>> batcher.add(Request("embedding", "MKTAYIAK"))
+        >>> batcher.next_batch()
+        None
+        >>> time.sleep(0.01); batcher.next_batch()
+        [<Request>]
+    """
+
+    def __init__(self, max_tokens: int, max_wait: float, max_batch_size: Optional[int] = None,
+                 extra_tokens: int = 2):
+        if max_tokens <= 0:
+            raise ValueError(f"max_tokens must be greater than zero, get {max_tokens}")
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.extra_tokens = extra_tokens
+        self._groups = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(group) for group in self._groups.values())
+
+    def add(self, request: Request):
+        self._groups.setdefault(request.key, []).append(request)
+
+    def cost(self, requests: Sequence[Request]) -> int:
+        """
+        Padded tokens of a batch of these requests
+        """
+        if not requests:
+            return 0
+        return len(requests) * (max(len(r.sequence) for r in requests) + self.extra_tokens)
+
+    def next_deadline(self) -> Optional[float]:
+        """
+        ``time.perf_counter()`` time at which the oldest pending request times out, None if nothing is pending
+        """
+        oldest = [group[0].submitted for group in self._groups.values()]
+        return min(oldest) + self.max_wait if oldest else None
+
+    def next_batch(self, now: Optional[float] = None, force: bool = False) -> Optional[List[Request]]:
+        """
+        Pop the next ready batch
+
+        Args:
+            now (float, optional): ``time.perf_counter()`` time, default the current time
+            force (bool): take a batch even if no group is ready, e.g. while draining
+
+        Returns:
+            the requests of the batch, None if no group is ready
+        """
+        now = time.perf_counter() if now is None else now
+        ready = []
+        for key, group in self._groups.items():
+            batch = self._take(group)
+            if force or len(batch) < len(group) or self._full(batch) or now - group[0].submitted >= self.max_wait:
+                ready.append((group[0].submitted, key, len(batch)))
+        if not ready:
+            return None
+        _, key, size = min(ready)
+        group = self._groups[key]
+        batch, self._groups[key] = group[:size], group[size:]
+        if not self._groups[key]:
+            del self._groups[key]
+        return batch
+
+    def _full(self, batch: List[Request]) -> bool:
+        return self.max_batch_size is not None and len(batch) >= self.max_batch_size
+
+    def _take(self, group: List[Request]) -> List[Request]:
+        # the longest prefix of the group that fits the budget, at least one request
+        size, longest = 0, 0
+        for request in group:
+            new_longest = max(longest, len(request.sequence) + self.extra_tokens)
+            if size and (new_longest * (size + 1) > self.max_tokens or self._full(group[:size])):
+                break
+            size, longest = size + 1, new_longest
+        return group[:size]
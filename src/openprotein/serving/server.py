@@ -0,0 +1,466 @@
+import json
+import time
+import queue
+import socket
+import logging
+import itertools
+import threading
+import socketserver
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+from typing import *
+
+import numpy as np
+
+from openprotein.serving.batcher import Request, DynamicBatcher
+from openprotein.serving.worker import KINDS, worker_loop
+
+
+class InferenceServer(object):
+    """
+    Local inference server with dynamic batching over a pool of worker processes.
+
+    Requests are queued, grouped by kind and options, and cut into batches bounded by ``max_tokens`` and
+    ``max_wait`` (see :class:`DynamicBatcher`). A batch is only formed when a worker is free, so under load
+    the batches grow up to the token budget while the workers are busy. Every worker process builds its own
+    model with ``builder`` and runs with ``threads_per_worker`` torch threads. With ``num_workers=0`` the
+    batches run in a thread of this process instead.
+
+    Every batch is sent to one free worker through its own task queue. The workers are checked every
+    ``check_interval`` seconds: the in-flight batches of a worker that died (killed for memory, crashed) fail,
+    and the worker is restarted in its slot.
+
+    Requests come in through :meth:`submit` (a ``Future``), the blocking helpers :meth:`embed`,
+    :meth:`logits` and :meth:`contacts`, or newline-delimited json over a local socket (:meth:`serve`,
+    :class:`ServingClient`).
+
+    Args:
+        builder (Callable): picklable callable returning (model, alphabet), e.g. a module level function
+            or a ``functools.partial``
+        num_workers (int): worker processes, 0 to run in this process
+        threads_per_worker (int): torch intra-op threads of every worker
+        max_tokens (int): padded tokens of a batch
+        max_wait (float): seconds a request may wait for its batch to fill
+        max_batch_size (int, optional): requests of a batch
+        start_method (str): multiprocessing start method of the workers
+        check_interval (float): seconds between two checks of the workers
+
+    Examples:
+        >>> with InferenceServer(build_esm1b, num_workers=4, threads_per_worker=4, max_tokens=8192) as server:
+        ...     server.embed("MKTAYIAKQRQISFVK", repr_layer=33).shape
+        ...     host, port = server.serve(port=8500)
+        ...     server.metrics()["batch_fill_ratio"]
+        (1280,)
+        0.73
+    """
+
+    def __init__(self, builder: Callable, num_workers: int = 1, threads_per_worker: int = 1, max_tokens: int = 4096,
+                 max_wait: float = 0.005, max_batch_size: Optional[int] = None, start_method: str = "spawn",
+                 check_interval: float = 1.0):
+        self.builder = builder
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.batcher = DynamicBatcher(max_tokens, max_wait, max_batch_size)
+        self.start_method = start_method
+        self.check_interval = check_interval
+        self.max_length = None
+        self._slots = max(num_workers, 1)
+        self._cond = threading.Condition()
+        # batch id => (worker, requests)
+        self._in_flight = {}
+        self._free = deque()
+        self._batch_ids = itertools.count()
+        self._context = None
+        self._workers = []
+        self._task_queues = []
+        self._results = None
+        self._threads = []
+        self._socket_server = None
+        self._closed = False
+        self._started = None
+        self._counters = {"requests": 0, "completed": 0, "failed": 0, "batches": 0, "tokens": 0,
+                          "padded_tokens": 0, "compute_seconds": 0.0, "worker_restarts": 0}
+        self._queue_latencies = deque(maxlen=10000)
+        self._latencies = deque(maxlen=10000)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self, timeout: Optional[float] = None) -> "InferenceServer":
+        """
+        Start the workers and wait until every one of them has built its model
+        """
+        if self.num_workers:
+            self._context = multiprocessing.get_context(self.start_method)
+            self._results = self._context.Queue()
+        else:
+            self._results = queue.Queue()
+        for index in range(self._slots):
+            self._spawn(index)
+
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while len(self._free) < self._slots:
+            try:
+                status, index, info = self._results.get(timeout=self.check_interval)
+            except queue.Empty:
+                dead = [index for index, worker in enumerate(self._workers) if not worker.is_alive()]
+                if dead:
+                    self.close()
+                    raise RuntimeError(f"inference workers {dead} died while building the model")
+                if deadline is not None and time.perf_counter() > deadline:
+                    self.close()
+                    raise TimeoutError(f"the inference workers are not ready after {timeout}s")
+                continue
+            if status != "ready":
+                self.close()
+                raise RuntimeError(f"an inference worker failed to build the model:\n{info}")
+            self.max_length = info["max_length"]
+            self._free.append(index)
+        logging.info(f"started {self._slots} inference workers")
+        self._started = time.perf_counter()
+        for target in [self._dispatch_loop, self._result_loop]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, kind: str, sequence: str, **options) -> Future:
+        """
+        Queue a request
+
+        Args:
+            kind (str): "embedding", "logits" or "contacts"
+            sequence (str): the protein sequence
+            options: ``repr_layer`` and ``pooling`` ("mean", "cls" or "per_residue") of embedding requests
+
+        Returns:
+            Future of a numpy array
+        """
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}, get {kind}")
+        if self._started is None or self._closed:
+            raise RuntimeError("the server is not running")
+        if len(sequence) > self.max_length:
+            raise ValueError(f"sequence of length {len(sequence)} is longer than {self.max_length}")
+        request = Request(kind, sequence, options)
+        with self._cond:
+            self.batcher.add(request)
+            self._counters["requests"] += 1
+            self._cond.notify_all()
+        return request.future
+
+    def embed(self, sequence: str, repr_layer: Optional[int] = None, pooling: str = "mean") -> np.ndarray:
+        options = {"pooling": pooling}
+        if repr_layer is not None:
+            options["repr_layer"] = repr_layer
+        return self.submit("embedding", sequence, **options).result()
+
+    def logits(self, sequence: str) -> np.ndarray:
+        return self.submit("logits", sequence).result()
+
+    def contacts(self, sequence: str) -> np.ndarray:
+        return self.submit("contacts", sequence).result()
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        Counters of the server
+
+        Returns:
+            dict of ``requests``, ``completed``, ``failed``, ``batches``, ``worker_restarts``, ``queue_depth``,
+            ``in_flight``, ``batch_fill_ratio`` (padded tokens of the batches over their budget), ``padding_ratio``
+            (padding over padded tokens), ``queue_latency_p50/p95`` (seconds from submit to dispatch),
+            ``latency_p50/p95`` (seconds from submit to result), ``requests_per_second`` and
+            ``tokens_per_second`` since the start
+        """
+        with self._cond:
+            counters = dict(self._counters)
+            queue_depth = len(self.batcher)
+            in_flight = len(self._in_flight)
+            queue_latencies = sorted(self._queue_latencies)
+            latencies = sorted(self._latencies)
+        elapsed = time.perf_counter() - self._started if self._started is not None else 0.0
+        batches = counters["batches"]
+        padded = counters["padded_tokens"]
+        counters.update({
+            "queue_depth": queue_depth,
+            "in_flight": in_flight,
+            "batch_fill_ratio": padded / (batches * self.batcher.max_tokens) if batches else 0.0,
+            "padding_ratio": 1 - counters["tokens"] / padded if padded else 0.0,
+            "queue_latency_p50": _percentile(queue_latencies, 0.5),
+            "queue_latency_p95": _percentile(queue_latencies, 0.95),
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p95": _percentile(latencies, 0.95),
+            "requests_per_second": counters["completed"] / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_second": counters["tokens"] / elapsed if elapsed > 0 else 0.0,
+        })
+        return counters
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> Tuple[str, int]:
+        """
+        Accept requests over a local TCP socket, in a background thread
+
+        Every line sent is a json request ``{"id": ..., "kind": ..., "sequence": ..., "options": {...}}``, every
+        line received a json response ``{"id": ..., "result": [...]}`` or ``{"id": ..., "error": "..."}``.
+        Requests of a connection can be pipelined, responses come back in completion order.
+
+        Returns:
+            (host, port) the server listens on
+        """
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                lock = threading.Lock()
+                pending = []
+
+                def respond(message):
+                    with lock:
+                        self.wfile.write((json.dumps(message) + "\n").encode())
+                        self.wfile.flush()
+
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    message = None
+                    try:
+                        message = json.loads(line)
+                        future = server.submit(message["kind"], message["sequence"], **message.get("options", {}))
+                    except Exception as e:
+                        respond({"id": None if not isinstance(message, dict) else message.get("id"),
+                                 "error": repr(e)})
+                        continue
+                    future.add_done_callback(lambda f, id=message.get("id"): respond(_response(id, f)))
+                    pending.append(future)
+                # keep the connection until every response is written
+                for future in pending:
+                    future.exception()
+
+        self._socket_server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._socket_server.daemon_threads = True
+        thread = threading.Thread(target=self._socket_server.serve_forever, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self._socket_server.server_address
+
+    def close(self):
+        """
+        Fail the pending requests and stop the socket server and the workers
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            while len(self.batcher):
+                for request in self.batcher.next_batch(force=True):
+                    request.future.set_exception(RuntimeError("the server is closed"))
+            self._cond.notify_all()
+        if self._socket_server is not None:
+            self._socket_server.shutdown()
+            self._socket_server.server_close()
+        for tasks in self._task_queues:
+            tasks.put(None)
+        for worker in self._workers:
+            if worker is not None:
+                worker.join(timeout=10)
+        if self._results is not None:
+            self._results.put(None)
+
+    def _spawn(self, index: int):
+        # a new worker with a new task queue in slot ``index``, free once it reports ready
+        if self.num_workers:
+            tasks = self._context.Queue()
+            worker = self._context.Process(target=worker_loop, daemon=True, args=(
+                self.builder, self.threads_per_worker, tasks, self._results, index))
+        else:
+            tasks = queue.Queue()
+            worker = threading.Thread(target=worker_loop, daemon=True,
+                                      args=(self.builder, None, tasks, self._results, index))
+        worker.start()
+        if index < len(self._workers):
+            self._workers[index], self._task_queues[index] = worker, tasks
+        else:
+            self._workers.append(worker)
+            self._task_queues.append(tasks)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    batch = self.batcher.next_batch() if self._free else None
+                    if batch is not None:
+                        break
+                    deadline = self.batcher.next_deadline()
+                    timeout = None if deadline is None or not self._free else max(deadline - time.perf_counter(), 0)
+                    self._cond.wait(timeout)
+
+                batch_id = next(self._batch_ids)
+                now = time.perf_counter()
+                for request in batch:
+                    request.dispatched = now
+                    self._queue_latencies.append(now - request.submitted)
+                worker = self._free.popleft()
+                tasks = self._task_queues[worker]
+                self._in_flight[batch_id] = (worker, batch)
+                self._counters["batches"] += 1
+                self._counters["tokens"] += sum(len(request.sequence) + self.batcher.extra_tokens for request in batch)
+                self._counters["padded_tokens"] += self.batcher.cost(batch)
+            tasks.put((batch_id, batch[0].kind, batch[0].options, [request.sequence for request in batch]))
+
+    def _result_loop(self):
+        checked = time.perf_counter()
+        while True:
+            try:
+                message = self._results.get(timeout=self.check_interval)
+            except queue.Empty:
+                message = ()
+            if message is None:
+                return
+            if message and message[0] in ("ready", "failed"):
+                self._worker_started(*message)
+            elif message:
+                self._batch_done(*message)
+            if time.perf_counter() - checked >= self.check_interval:
+                self._check_workers()
+                checked = time.perf_counter()
+
+    def _batch_done(self, batch_id: int, outputs: Optional[List[np.ndarray]], seconds: float, error: Optional[str]):
+        with self._cond:
+            worker, batch = self._in_flight.pop(batch_id, (None, None))
+            if batch is None:
+                # already failed, its worker was found dead
+                return
+            self._free.append(worker)
+            self._counters["compute_seconds"] += seconds
+            self._counters["completed" if error is None else "failed"] += len(batch)
+            now = time.perf_counter()
+            for request in batch:
+                self._latencies.append(now - request.submitted)
+            self._cond.notify_all()
+        for i, request in enumerate(batch):
+            if error is None:
+                request.future.set_result(outputs[i])
+            else:
+                request.future.set_exception(RuntimeError(error))
+
+    def _worker_started(self, status: str, index: int, info):
+        # a restarted worker reports ready or failed to build its model
+        with self._cond:
+            if status == "ready":
+                self._free.append(index)
+                self._cond.notify_all()
+                return
+            logging.error(f"inference worker {index} failed to build the model, its slot is left empty:\n{info}")
+            self._workers[index] = None
+            if any(worker is not None for worker in self._workers):
+                return
+            failed = []
+            while len(self.batcher):
+                failed.extend(self.batcher.next_batch(force=True))
+            self._counters["failed"] += len(failed)
+        for request in failed:
+            request.future.set_exception(RuntimeError("no inference worker is left"))
+
+    def _check_workers(self):
+        # fail the in-flight batches of the workers that died and restart them
+        failed = []
+        with self._cond:
+            if self._closed:
+                return
+            for index, worker in enumerate(self._workers):
+                if worker is None or worker.is_alive():
+                    continue
+                logging.error(f"inference worker {index} died with exit code {getattr(worker, 'exitcode', None)}, "
+                              f"restarting it")
+                for batch_id, (owner, batch) in list(self._in_flight.items()):
+                    if owner == index:
+                        del self._in_flight[batch_id]
+                        failed.extend(batch)
+                if index in self._free:
+                    self._free.remove(index)
+                self._counters["worker_restarts"] += 1
+                self._spawn(index)
+            self._counters["failed"] += len(failed)
+            now = time.perf_counter()
+            for request in failed:
+                self._latencies.append(now - request.submitted)
+            self._cond.notify_all()
+        for request in failed:
+            request.future.set_exception(RuntimeError("the inference worker died while running the batch"))
+
+
+class ServingClient(object):
+    """
+    Client of :meth:`InferenceServer.serve`
+
+    Args:
+        host (str): host of the server
+        port (int): port of the server
+
+    Examples:
+        >>> client = ServingClient("127.0.0.1", 8500)
+        >>> client.request("embedding", "MKTAYIAK", repr_layer=33).shape
+        (1280,)
+        >>> client.request_many([("contacts", "MKTAYIAK", {}), ("logits", "MKV", {})])
+    """
+
+    def __init__(self, host: str, port: int):
+        self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile("rwb")
+
+    def request(self, kind: str, sequence: str, **options) -> np.ndarray:
+        return self.request_many([(kind, sequence, options)])[0]
+
+    def request_many(self, requests: Sequence[Tuple[str, str, dict]]) -> List[np.ndarray]:
+        """
+        Pipeline many requests on the connection
+
+        Args:
+            requests (Sequence[Tuple[str, str, dict]]): (kind, sequence, options)
+
+        Returns:
+            the results, in the order of the requests
+
+        Raises:
+            RuntimeError: the error of the first failed request, once every response was read, so the
+                connection stays usable
+        """
+        for i, (kind, sequence, options) in enumerate(requests):
+            message = {"id": i, "kind": kind, "sequence": sequence, "options": options}
+            self._file.write((json.dumps(message) + "\n").encode())
+        self._file.flush()
+        results = [None] * len(requests)
+        errors = {}
+        for _ in requests:
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError("the server closed the connection")
+            response = json.loads(line)
+            if "error" in response:
+                errors[response["id"]] = response["error"]
+            else:
+                results[response["id"]] = np.asarray(response["result"], dtype=np.float32)
+        if errors:
+            first = min(errors)
+            raise RuntimeError(f"request {first} failed: {errors[first]}")
+        return results
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def _response(id, future: Future) -> dict:
+    error = future.exception()
+    if error is not None:
+        return {"id": id, "error": str(error)}
+    return {"id": id, "result": future.result().tolist()}
+
+
+def _percentile(values: Sequence[float], q: float) -> float:
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
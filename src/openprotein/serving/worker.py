@@ -0,0 +1,84 @@
+import time
+import logging
+import traceback
+from typing import *
+
+import numpy as np
+import torch
+
+from openprotein.data.process import BatchConverter
+from openprotein.piplines.embedding import Embedding
+
+KINDS = ("embedding", "logits", "contacts")
+
+
+def run_batch(model, alphabet, kind: str, options: dict, sequences: List[str]) -> List[np.ndarray]:
+    """
+    Run one batch of requests of the same kind and options
+
+    Args:
+        model (Esm1b): the model
+        alphabet (Alphabet): the alphabet of the model
+        kind (str): "embedding" (options ``repr_layer`` and ``pooling``: "mean", "cls" or "per_residue"),
+            "logits" ([length, vocabulary] per sequence) or "contacts" ([length, length] per sequence)
+        options (dict): options of the kind
+        sequences (List[str]): the sequences
+
+    Returns:
+        one array per sequence
+    """
+    tokens = BatchConverter(alphabet)(sequences).to(next(model.parameters()).device)
+    if kind == "embedding":
+        layer = options.get("repr_layer", model.args.num_layers)
+        pooling = options.get("pooling", "mean")
+        embedding = Embedding(model, alphabet, repr_layers=[layer], pooling=[pooling])
+        return embedding.embed_tokens(tokens)[f"{pooling}_{layer}"]
+
+    first = int(alphabet.prepend_bos)
+    with torch.inference_mode():
+        if kind == "logits":
+            logits = model(tokens)["logits"].float().cpu().numpy()
+            return [logits[i, first:first + len(s)] for i, s in enumerate(sequences)]
+        if kind == "contacts":
+            contacts = model(tokens, return_contacts=True, return_logits=False)["contacts"].float().cpu().numpy()
+            return [contacts[i, :len(s), :len(s)] for i, s in enumerate(sequences)]
+    raise ValueError(f"kind must be one of {KINDS}, get {kind}")
+
+
+def worker_loop(builder: Callable, num_threads: Optional[int], tasks, results, worker_id: int = 0):
+    """
+    Body of a worker: build the model, report ready, then run batches until a None task arrives
+
+    Tasks are (batch_id, kind, options, sequences). Results are ("ready", worker_id, info) or
+    ("failed", worker_id, traceback) once the model is built, then (batch_id, outputs, compute_seconds, error)
+    with ``error`` a formatted traceback or None.
+
+    Args:
+        builder (Callable): picklable callable returning (model, alphabet)
+        num_threads (int, optional): torch intra-op threads of the worker, None keeps the default
+        tasks: queue of tasks of this worker
+        results: queue of results, shared by the workers
+        worker_id (int): slot of the worker in the server
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    try:
+        model, alphabet = builder()
+    except Exception:
+        results.put(("failed", worker_id, traceback.format_exc()))
+        return
+    model.eval()
+    max_length = model.args.max_positions - int(alphabet.prepend_bos) - int(alphabet.append_eos)
+    results.put(("ready", worker_id, {"max_length": max_length}))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_id, kind, options, sequences = task
+        start = time.perf_counter()
+        try:
+            outputs = run_batch(model, alphabet, kind, options, sequences)
+            results.put((batch_id, outputs, time.perf_counter() - start, None))
+        except Exception:
+            logging.info(f"batch {batch_id} failed")
+            results.put((batch_id, None, time.perf_counter() - start, traceback.format_exc()))
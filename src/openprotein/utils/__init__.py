@@ -1,5 +1,7 @@
 from .activation import gelu
+from .precision import autocast, is_autocast_enabled
+from .graph import is_static_graph
 
 __all__ = [
-    "gelu",
+    "gelu", "autocast", "is_autocast_enabled", "is_static_graph",
 ]
\ No newline at end of file
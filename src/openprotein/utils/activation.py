@@ -1,11 +1,12 @@
-import math
 import torch
+import torch.nn.functional as F
 
 
 def gelu(x):
-    """Implementation of the gelu activation function.
+    """Implementation of the gelu activation function, the exact erf form computed by the native ``F.gelu``
+    kernel in one pass.
     For information: OpenAI GPT's gelu is slightly different
     (and gives slightly different results):
     0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
     """
-    return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
\ No newline at end of file
+    return F.gelu(x)
\ No newline at end of file
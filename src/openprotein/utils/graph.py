@@ -0,0 +1,12 @@
+import torch
+
+
+def is_static_graph() -> bool:
+    """
+    Whether the forward is being traced, scripted, exported to ONNX or compiled. The recorded graph must not
+    depend on the values of the inputs or on state kept between calls, so the fast paths that do (fused and
+    chunked layers, activation checkpointing, cached rotary tables) are skipped.
+    """
+    compiler = getattr(torch, "compiler", None)
+    compiling = compiler is not None and hasattr(compiler, "is_compiling") and compiler.is_compiling()
+    return compiling or torch.jit.is_scripting() or torch.jit.is_tracing() or torch.onnx.is_in_onnx_export()
@@ -0,0 +1,49 @@
+import contextlib
+from typing import *
+
+import torch
+
+PRECISIONS = {"fp32": None, "float32": None, "bf16": torch.bfloat16, "bfloat16": torch.bfloat16}
+
+
+def autocast(precision: str = "fp32", device_type: str = "cpu"):
+    """
+    Context manager running the enclosed forward in reduced precision.
+
+    Args:
+        precision (str): "fp32" (no autocast) or "bf16"
+        device_type (str): device type of the model, "cpu" or "cuda"
+
+    Returns:
+        a ``torch.autocast`` context, or a no-op context for fp32
+
+    Examples:
+        >>> with autocast("bf16"):
+        >>>     logits = model(tokens)["logits"]
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {list(PRECISIONS)}, get {precision}")
+    dtype = PRECISIONS[precision]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+
+def is_autocast_enabled(device_type: str = "cpu") -> bool:
+    """
+    Whether an autocast region is active for the device type
+    """
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # torch < 2.4 has no device type argument
+        if device_type == "cpu":
+            return torch.is_autocast_cpu_enabled()
+        return torch.is_autocast_enabled()
+
+
+def fp32(device_type: str = "cpu"):
+    """
+    Context manager leaving an autocast region, for numerically sensitive ops
+    """
+    return torch.autocast(device_type=device_type, enabled=False)
@@ -0,0 +1,76 @@
+import unittest
+import os
+
+import torch
+
+from openprotein.layers import MultiheadAttention, PerformerAttention, LocalGlobalAttention
+
+
+class EfficientAttentionTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        torch.manual_seed(0)
+        self.exact = MultiheadAttention(32, 4).eval()
+        self.x = torch.randn(20, 2, 32)
+        self.padding_mask = torch.zeros(2, 20, dtype=torch.bool)
+        self.padding_mask[1, 15:] = True
+
+    def approximate(self, cls, **options):
+        attention = cls(32, 4, **options).eval()
+        attention.load_state_dict(self.exact.state_dict())
+        return attention
+
+    def run_both(self, attention):
+        with torch.no_grad():
+            expected, expected_weights = self.exact(self.x, self.x, self.x, key_padding_mask=self.padding_mask,
+                                                    need_head_weights=True)
+            result, weights = attention(self.x, key_padding_mask=self.padding_mask, need_head_weights=True)
+            without_weights, none = attention(self.x, key_padding_mask=self.padding_mask, need_weights=False)
+        self.assertIsNone(none)
+        self.assertTrue(torch.allclose(result, without_weights, atol=1e-6))
+        return expected, expected_weights, result, weights
+
+    def test_local_within_reach_is_exact(self):
+        # a window covering the whole sequence
+        expected, expected_weights, result, weights = self.run_both(
+            self.approximate(LocalGlobalAttention, window=19, global_tokens=1))
+        self.assertTrue(torch.allclose(expected, result, atol=1e-5))
+        self.assertTrue(torch.allclose(expected_weights, weights, atol=1e-5))
+
+    def test_local_sparsity(self):
+        _, _, result, weights = self.run_both(self.approximate(LocalGlobalAttention, window=3, global_tokens=2))
+        self.assertEqual(weights.shape, (4, 2, 20, 20))
+        self.assertTrue(torch.allclose(weights.sum(-1), torch.ones(4, 2, 20), atol=1e-5))
+        # token 10 reaches 7..13 and the global tokens 0 and 1
+        reached = weights[:, :, 10].abs().sum((0, 1)).nonzero().flatten().tolist()
+        self.assertEqual(reached, [0, 1, 7, 8, 9, 10, 11, 12, 13])
+        self.assertTrue((weights[:, :, 0] > 0).sum(-1).eq(torch.tensor([20, 15])).all())
+        self.assertTrue((weights[..., 15:][:, 1] == 0).all())
+
+    def test_performer(self):
+        errors = []
+        for num_features in [256, 16384]:
+            expected, expected_weights, result, weights = self.run_both(
+                self.approximate(PerformerAttention, num_features=num_features))
+            self.assertTrue(torch.allclose(weights.sum(-1), torch.ones(4, 2, 20), atol=1e-4))
+            self.assertTrue((weights[..., 15:][:, 1] == 0).all())
+            self.assertLess((expected_weights - weights).abs().mean().item(), 0.01)
+            errors.append(((expected - result).norm() / expected.norm()).item())
+        # an unbiased estimate of the softmax kernel, the error shrinks with more features
+        self.assertLess(errors[1], errors[0])
+        # the features are drawn again from the same seed, not stored
+        self.assertNotIn("features", PerformerAttention(32, 4).state_dict())
+        self.assertTrue(torch.equal(PerformerAttention(32, 4).features, PerformerAttention(32, 4).features))
+
+    def test_gradients(self):
+        for cls in [PerformerAttention, LocalGlobalAttention]:
+            attention = self.approximate(cls).train()
+            x = self.x.clone().requires_grad_()
+            attention(x, key_padding_mask=self.padding_mask)[0].sum().backward()
+            self.assertTrue(torch.isfinite(x.grad).all(), cls.__name__)
+            self.assertGreater(attention.q_proj.weight.grad.abs().sum().item(), 0, cls.__name__)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import os
+from unittest import mock
+
+import torch
+
+from openprotein.layers import MultiheadAttention, RotaryEmbedding, TransformerLayer
+from openprotein.layers.embedding import apply_rotary_pos_emb
+
+
+class RotaryTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        torch.manual_seed(0)
+        self.rotary = RotaryEmbedding(8, max_positions=16)
+        self.q = torch.randn(6, 20, 8)
+        self.k = torch.randn(6, 20, 8)
+
+    def reference(self, x):
+        return self.reference_of(self.rotary, x)
+
+    @staticmethod
+    def reference_of(rotary, x):
+        t = torch.arange(x.size(-2)).float()
+        freqs = torch.einsum("i,j->ij", t, rotary.inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        return apply_rotary_pos_emb(x, emb.cos()[None], emb.sin()[None])
+
+    def test_cached_tables(self):
+        with torch.no_grad():
+            q, k = self.rotary(self.q, self.k)
+        self.assertTrue(torch.allclose(q, self.reference(self.q), atol=1e-6))
+        self.assertTrue(torch.allclose(k, self.reference(self.k), atol=1e-6))
+        # grown by doubling past max_positions, then sliced for shorter inputs
+        cos, sin = self.rotary._tables[self.q.device]
+        self.assertEqual(cos.shape, (32, 4))
+        self.rotary(self.q[:, :5], self.k[:, :5])
+        self.assertIs(self.rotary._tables[self.q.device][0], cos)
+        # new frequencies from a checkpoint rebuild the tables
+        with torch.no_grad():
+            self.rotary.inv_freq.mul_(2)
+            q, _ = self.rotary(self.q, self.k)
+        self.assertTrue(torch.allclose(q, self.reference(self.q), atol=1e-5))
+
+    def test_bf16(self):
+        rotary = RotaryEmbedding(8, max_positions=4096)
+        q = torch.randn(2, 4096, 8).bfloat16()
+        with torch.no_grad():
+            result, _ = rotary(q, q)
+        # the tables stay fp32, only the rotated output is cast back
+        self.assertEqual(rotary._tables[q.device][0].dtype, torch.float32)
+        self.assertEqual(result.dtype, torch.bfloat16)
+        # rotated in fp32: only the final rounding to bf16, at most half a bf16 ulp
+        expected = self.reference_of(rotary, q.float())
+        self.assertTrue(torch.allclose(result.float(), expected, rtol=2 ** -8, atol=1e-5))
+
+    def test_max_positions(self):
+        layer = TransformerLayer(32, 64, 4, add_bias_kv=False, use_rotary_embeddings=True, max_positions=2048)
+        self.assertEqual(layer.self_attn.rot_emb.max_positions, 2048)
+
+    def test_gradients(self):
+        q = self.q.clone().requires_grad_()
+        weight = torch.randn(6, 20, 8)
+        (self.rotary(q, self.k)[0] * weight).sum().backward()
+        expected = q.grad
+        q.grad = None
+        (self.reference(q) * weight).sum().backward()
+        self.assertTrue(torch.allclose(q.grad, expected, atol=1e-6))
+
+    def test_sdpa_path(self):
+        layer = TransformerLayer(32, 64, 4, add_bias_kv=False, use_rotary_embeddings=True).eval()
+        x = torch.randn(20, 3, 32)
+        padding_mask = torch.zeros(3, 20, dtype=torch.bool)
+        padding_mask[1, 15:] = True
+        with mock.patch.object(MultiheadAttention, "_rotary_sdpa_forward",
+                               autospec=True, side_effect=MultiheadAttention._rotary_sdpa_forward) as sdpa:
+            with torch.no_grad():
+                result, attn = layer(x, self_attn_padding_mask=padding_mask)
+                expected, weights = layer(x, self_attn_padding_mask=padding_mask, need_head_weights=True)
+        self.assertEqual(sdpa.call_count, 1)
+        self.assertIsNone(attn)
+        self.assertEqual(weights.shape, (4, 3, 20, 20))
+        self.assertTrue(torch.allclose(result[:, [0, 2]], expected[:, [0, 2]], atol=1e-5))
+        self.assertTrue(torch.allclose(result[:15, 1], expected[:15, 1], atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+import argparse
+
+import torch
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b, CompiledEsm1b
+
+
+def inductor_available() -> bool:
+    try:
+        torch.compile(lambda x: x + 1, backend="inductor")(torch.zeros(2))
+        return True
+    except Exception:
+        # no C++ compiler, or a platform torch.compile does not support
+        return False
+
+
+class CompileTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 32, 'logit_bias': True, 'ffn_embed_dim': 64, 'attention_heads': 4,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+
+    def _tokens(self, length):
+        tokens = torch.randint(4, 24, (2, length))
+        tokens[:, 0] = self.alphabet.cls_idx
+        tokens[:, -1] = self.alphabet.eos_idx
+        tokens[1, length // 2:] = self.alphabet.padding_idx
+        tokens[1, length // 2 - 1] = self.alphabet.eos_idx
+        return tokens
+
+    def test_torchscript_buckets(self):
+        compiled = CompiledEsm1b(self.model, buckets=[16, 32], backend="torchscript")
+        for length in [10, 16, 20, 40]:
+            tokens = self._tokens(length)
+            with torch.no_grad():
+                expected = self.model(tokens, repr_layers=[1], return_contacts=True)
+            result = compiled(tokens, repr_layers=[1], return_contacts=True)
+            self.assertTrue(torch.allclose(expected["logits"], result["logits"], atol=1e-5))
+            self.assertTrue(torch.allclose(expected["representations"][1], result["representations"][1], atol=1e-5))
+            self.assertTrue(torch.allclose(expected["contacts"], result["contacts"], atol=1e-5))
+
+        status = compiled.cache_status()
+        self.assertEqual(status["eager_calls"], 1)
+        self.assertEqual(sorted((g["bucket"], g["calls"]) for g in status["graphs"]), [(16, 2), (32, 1)])
+
+    @unittest.skipUnless(inductor_available(), "the inductor backend is not available")
+    def test_inductor(self):
+        compiled = CompiledEsm1b(self.model, buckets=[16, 32])
+        limit = torch._dynamo.config.cache_size_limit
+        for length in [10, 20, 14]:
+            tokens = self._tokens(length)
+            with torch.no_grad():
+                expected = self.model(tokens, repr_layers=[2])
+            result = compiled(tokens, repr_layers=[2])
+            self.assertTrue(torch.allclose(expected["logits"], result["logits"], atol=1e-4))
+            self.assertTrue(torch.allclose(expected["representations"][2], result["representations"][2], atol=1e-4))
+        graphs = compiled.cache_status()["graphs"]
+        self.assertEqual(sorted((g["bucket"], g["calls"]) for g in graphs), [(16, 2), (32, 1)])
+        # the larger cache limits only apply while the model compiles and runs
+        self.assertEqual(torch._dynamo.config.cache_size_limit, limit)
+
+    def test_warmup(self):
+        compiled = CompiledEsm1b(self.model, buckets=[16, 32], backend="torchscript")
+        compiled.warmup(batch_size=2, repr_layers=[2], return_logits=False)
+        self.assertEqual(len(compiled.cache_status()["graphs"]), 2)
+        compiled(self._tokens(12), repr_layers=[2], return_logits=False)
+        self.assertEqual(len(compiled.cache_status()["graphs"]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
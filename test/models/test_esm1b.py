@@ -0,0 +1,216 @@
+import unittest
+import os
+import argparse
+import tempfile
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b
+
+
+class Esm1bTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 4, 'embed_dim': 32, 'logit_bias': True, 'ffn_embed_dim': 64, 'attention_heads': 4,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.args = argparse.Namespace(**args)
+        self.model = Esm1b(self.args, self.alphabet).eval()
+        self.tokens = torch.randint(4, 24, (2, 12))
+        self.tokens[:, 0] = self.alphabet.cls_idx
+        self.tokens[1, 9:] = self.alphabet.padding_idx
+
+    def test_truncated_forward(self):
+        with torch.no_grad():
+            full = self.model(self.tokens, repr_layers=[2, 4])
+            truncated = self.model(self.tokens, repr_layers=[2], return_logits=False)
+        self.assertNotIn("logits", truncated)
+        self.assertEqual(list(truncated["representations"]), [2])
+        self.assertTrue(torch.allclose(full["representations"][2], truncated["representations"][2]))
+
+    def test_last_layer_without_logits(self):
+        with torch.no_grad():
+            full = self.model(self.tokens, repr_layers=[4])
+            result = self.model(self.tokens, repr_layers=[4], return_logits=False)
+        self.assertTrue(torch.allclose(full["representations"][4], result["representations"][4]))
+
+    def test_bf16_precision(self):
+        with torch.no_grad():
+            reference = self.model(self.tokens, return_contacts=True)
+            self.model.precision = "bf16"
+            result = self.model(self.tokens, return_contacts=True)
+        self.assertEqual(result["logits"].dtype, torch.float32)
+        self.assertEqual(result["contacts"].dtype, torch.float32)
+        error = (reference["logits"] - result["logits"]).norm() / reference["logits"].norm()
+        self.assertLess(error.item(), 0.02)
+        self.assertTrue(torch.allclose(reference["contacts"], result["contacts"], atol=0.05))
+
+    def _grads(self, tokens):
+        self.model.zero_grad()
+        self.model(tokens)["logits"].sum().backward()
+        return {name: p.grad.clone() for name, p in self.model.named_parameters() if p.grad is not None}
+
+    def test_activation_checkpointing(self):
+        self.model.train()
+        reference = self._grads(self.tokens)
+        for mode in ["all", "every"]:
+            self.model.activation_checkpointing = mode
+            grads = self._grads(self.tokens)
+            self.assertEqual(reference.keys(), grads.keys())
+            for name in reference:
+                self.assertTrue(torch.allclose(reference[name], grads[name], atol=1e-6), (mode, name))
+        self.assertEqual(self.model.checkpointed_layers(2, 12), [0, 2])
+
+    def test_activation_checkpointing_dropout(self):
+        self.model.train()
+        for layer in self.model.layers:
+            layer.self_attn.dropout = 0.3
+        torch.manual_seed(1)
+        reference = self._grads(self.tokens)
+        torch.manual_seed(2)
+        other = self._grads(self.tokens)
+        # the dropout masks do change the gradients
+        self.assertFalse(torch.allclose(reference["embed_tokens.weight"], other["embed_tokens.weight"], atol=1e-6))
+        for mode in ["all", "every"]:
+            self.model.activation_checkpointing = mode
+            torch.manual_seed(1)
+            grads = self._grads(self.tokens)
+            for name in reference:
+                self.assertTrue(torch.allclose(reference[name], grads[name], atol=1e-6), (mode, name))
+
+    def test_checkpoint_budget(self):
+        self.model.activation_checkpointing = "budget"
+        stored = self.model.layer_activation_bytes(2, 12)
+        self.args.activation_memory_budget = 4 * stored / 2 ** 20
+        self.assertEqual(self.model.checkpointed_layers(2, 12), [])
+        self.args.activation_memory_budget = 3 * stored / 2 ** 20
+        self.assertEqual(len(self.model.checkpointed_layers(2, 12)), 2)
+        self.args.activation_memory_budget = 0
+        self.assertEqual(self.model.checkpointed_layers(2, 12), [0, 1, 2, 3])
+
+    def test_logits_mask(self):
+        self.model.train()
+        targets = torch.full_like(self.tokens, self.alphabet.padding_idx)
+        targets[0, 2] = 5
+        targets[0, 7] = 9
+        targets[1, 4] = 6
+
+        logits = self.model(self.tokens)["logits"]
+        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1),
+                               ignore_index=self.alphabet.padding_idx)
+        reference = {name: grad for name, grad in zip(
+            [name for name, _ in self.model.named_parameters()],
+            torch.autograd.grad(loss, list(self.model.parameters()), allow_unused=True)
+        )}
+
+        scored = targets.ne(self.alphabet.padding_idx)
+        compact = self.model(self.tokens, logits_mask=scored)["logits"]
+        self.assertEqual(compact.shape, (3, logits.size(-1)))
+        compact_loss = F.cross_entropy(compact, targets[scored])
+        self.assertTrue(torch.allclose(loss, compact_loss, atol=1e-6))
+        grads = torch.autograd.grad(compact_loss, list(self.model.parameters()), allow_unused=True)
+        for (name, _), grad in zip(self.model.named_parameters(), grads):
+            if reference[name] is None:
+                self.assertIsNone(grad)
+            else:
+                self.assertTrue(torch.allclose(reference[name], grad, atol=1e-6), name)
+
+    def test_fused_layers(self):
+        layer = self.model.layers[0]
+        fused_forward = mock.patch.object(layer, "_fused_forward", wraps=layer._fused_forward).start()
+        self.addCleanup(mock.patch.stopall)
+        with torch.no_grad():
+            fused = self.model(self.tokens, repr_layers=[2, 4])
+            # the attention weights come from the module-by-module forward
+            with_heads = self.model(self.tokens, return_contacts=True)
+        self.assertEqual(fused_forward.call_count, 1)
+        self.assertEqual(with_heads["attentions"].shape, (2, 4, 4, 12, 12))
+
+        for layer in self.model.layers:
+            layer.fused = False
+        with torch.no_grad():
+            reference = self.model(self.tokens, repr_layers=[2, 4])
+        for layer in [2, 4]:
+            self.assertTrue(torch.allclose(reference["representations"][layer], fused["representations"][layer],
+                                           atol=1e-5))
+        self.assertTrue(torch.allclose(reference["logits"], fused["logits"], atol=1e-5))
+
+        # training takes the module-by-module forward
+        for layer in self.model.layers:
+            layer.fused = True
+        self.model.train()
+        self.model(self.tokens)["logits"].sum().backward()
+        self.assertEqual(fused_forward.call_count, 1)
+        self.assertIsNotNone(self.model.layers[0].fc1.weight.grad)
+
+    def test_packed_qkv_cache(self):
+        layer = self.model.layers[0]
+        x = torch.randn(12, 2, 32)
+        with torch.inference_mode():
+            first = layer(x)[0]
+            packed = layer._packed_qkv_cache[1]
+            layer(x)
+            self.assertIs(layer._packed_qkv_cache[1], packed)
+        # an in-place update of a projection rebuilds it
+        with torch.no_grad():
+            layer.self_attn.k_proj.weight.mul_(2)
+            updated = layer(x)[0]
+        self.assertIsNot(layer._packed_qkv_cache[1], packed)
+        self.assertFalse(torch.allclose(first, updated))
+        layer.fused = False
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(layer(x)[0], updated, atol=1e-5))
+
+        layer.fused, layer.cache_packed_qkv, layer._packed_qkv_cache = True, False, None
+        with torch.inference_mode():
+            self.assertTrue(torch.allclose(layer(x)[0], updated, atol=1e-5))
+        self.assertIsNone(layer._packed_qkv_cache)
+
+    def test_chunked_layers(self):
+        with torch.no_grad():
+            reference = self.model(self.tokens, repr_layers=[4])
+            for layer in self.model.layers:
+                # the last block of keys of the second sequence is all padding
+                layer.chunk_size = 3
+            chunked = self.model(self.tokens, repr_layers=[4])
+            with_heads = self.model(self.tokens, return_contacts=True)
+        self.assertTrue(torch.allclose(reference["representations"][4], chunked["representations"][4], atol=1e-5))
+        self.assertTrue(torch.allclose(reference["logits"], chunked["logits"], atol=1e-5))
+        self.assertEqual(with_heads["attentions"].shape, (2, 4, 4, 12, 12))
+
+    def test_approximate_attention(self):
+        local = Esm1b(argparse.Namespace(**dict(vars(self.args), attention="local", local_window=16)), self.alphabet)
+        local.load_state_dict(self.model.state_dict())
+        with torch.no_grad():
+            expected = self.model(self.tokens, return_contacts=True)
+            result = local.eval()(self.tokens, return_contacts=True)
+        # the window reaches the whole sequence, the attention is exact
+        self.assertTrue(torch.allclose(expected["logits"], result["logits"], atol=1e-5))
+        self.assertTrue(torch.allclose(expected["contacts"], result["contacts"], atol=1e-5))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint.pt")
+            torch.save(self.model.state_dict(), path)
+            performer = Esm1b(argparse.Namespace(**dict(vars(self.args), attention="performer", checkpoint_path=path)),
+                              self.alphabet).eval()
+        self.assertEqual(set(performer.state_dict()), set(self.model.state_dict()))
+        self.assertTrue(torch.equal(performer.layers[0].self_attn.q_proj.weight,
+                                    self.model.layers[0].self_attn.q_proj.weight))
+        self.assertFalse(performer.layers[0].self_attn.features.is_meta)
+        with torch.no_grad():
+            result = performer(self.tokens, repr_layers=[4])
+        self.assertEqual(result["logits"].shape, expected["logits"].shape)
+        self.assertTrue(torch.isfinite(result["representations"][4]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
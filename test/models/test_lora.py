@@ -0,0 +1,87 @@
+import unittest
+import os
+import argparse
+import tempfile
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from openprotein.data import Alphabet
+from openprotein.layers import LoRALinear
+from openprotein.models import Esm1b, inject_lora, lora_state_dict, save_lora, load_lora, merge_lora
+
+
+class LoRATest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.args = argparse.Namespace(**args)
+        self.model = Esm1b(self.args, self.alphabet)
+        self.tokens = torch.randint(4, 24, (2, 10))
+        self.tokens[:, 0] = self.alphabet.cls_idx
+        self.tokens[1, 8:] = self.alphabet.padding_idx
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def logits(self, model):
+        with torch.no_grad():
+            return model.eval()(self.tokens)["logits"]
+
+    def test_adapters(self):
+        expected = self.logits(self.model)
+        base_state_dict = {name: tensor.clone() for name, tensor in self.model.state_dict().items()}
+        inject_lora(self.model, rank=4)
+        self.assertIsInstance(self.model.layers[0].self_attn.q_proj, LoRALinear)
+        self.assertNotIsInstance(self.model.layers[0].fc1, nn.Linear)
+        # the adapters start as a zero update
+        self.assertTrue(torch.allclose(expected, self.logits(self.model), atol=1e-6))
+        trainable = {name for name, p in self.model.named_parameters() if p.requires_grad}
+        self.assertEqual(trainable, set(lora_state_dict(self.model)))
+        self.assertEqual(len(trainable), 2 * 6 * 2)
+
+        self.model.train()
+        optimizer = torch.optim.SGD([p for p in self.model.parameters() if p.requires_grad], lr=0.5)
+        frozen = self.model.embed_tokens.weight.clone()
+        for _ in range(3):
+            optimizer.zero_grad()
+            logits = self.model(self.tokens)["logits"]
+            F.cross_entropy(logits.view(-1, logits.size(-1)), self.tokens.view(-1)).backward()
+            optimizer.step()
+        adapted = self.logits(self.model)
+        self.assertFalse(torch.allclose(expected, adapted, atol=1e-4))
+        self.assertTrue(torch.equal(frozen, self.model.embed_tokens.weight))
+
+        path = os.path.join(self.tmp.name, "task.lora.pt")
+        save_lora(self.model, path)
+        base = Esm1b(self.args, self.alphabet)
+        base.load_state_dict(base_state_dict)
+        loaded = load_lora(base, path)
+        self.assertTrue(torch.allclose(adapted, self.logits(loaded), atol=1e-6))
+
+        merged = merge_lora(loaded)
+        self.assertIs(type(merged.layers[0].self_attn.q_proj), nn.Linear)
+        self.assertEqual(set(merged.state_dict()), set(base_state_dict))
+        self.assertTrue(torch.allclose(adapted, self.logits(merged), atol=1e-5))
+
+    def test_targets(self):
+        inject_lora(self.model, targets=("q_proj", "v_proj"), layers=[1])
+        self.assertIsInstance(self.model.layers[1].self_attn.v_proj, LoRALinear)
+        self.assertIs(type(self.model.layers[0].self_attn.v_proj), nn.Linear)
+        self.assertIs(type(self.model.layers[1].fc1), nn.Linear)
+        with self.assertRaises(ValueError):
+            inject_lora(self.model, targets=("fc3",))
+
+
+if __name__ == "__main__":
+    unittest.main()
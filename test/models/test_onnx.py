@@ -0,0 +1,58 @@
+import unittest
+import os
+import argparse
+import tempfile
+
+import torch
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b, export_onnx, OnnxEsm1b
+
+
+class OnnxTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 32, 'logit_bias': True, 'ffn_embed_dim': 64, 'attention_heads': 4,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _tokens(self, batch_size, length):
+        tokens = torch.randint(4, 24, (batch_size, length))
+        tokens[:, 0] = self.alphabet.cls_idx
+        tokens[:, -1] = self.alphabet.eos_idx
+        if batch_size > 1:
+            tokens[-1, length // 2:] = self.alphabet.padding_idx
+            tokens[-1, length // 2 - 1] = self.alphabet.eos_idx
+        return tokens
+
+    def test_parity(self):
+        try:
+            import onnxruntime
+        except ImportError:
+            self.skipTest("onnxruntime is not installed")
+        path = os.path.join(self.tmp.name, "model.onnx")
+        export_onnx(self.model, path, repr_layers=[1, 2], return_contacts=True)
+        runner = OnnxEsm1b(path)
+        for batch_size, length in [(1, 10), (3, 24), (2, 40)]:
+            tokens = self._tokens(batch_size, length)
+            with torch.no_grad():
+                expected = self.model(tokens, repr_layers=[1], return_contacts=True)
+            result = runner(tokens, repr_layers=[1], return_contacts=True)
+            self.assertTrue(torch.allclose(expected["logits"], result["logits"], atol=1e-4))
+            self.assertTrue(torch.allclose(expected["representations"][1], result["representations"][1], atol=1e-4))
+            self.assertTrue(torch.allclose(expected["contacts"], result["contacts"], atol=1e-4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import os
+import socket
+import argparse
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b, save_flat_weights, load_tensor_parallel, FlatWeightsBuilder
+from openprotein.models.weights import map_flat_weights
+
+PROTEINSEQ_TOKS = {
+    'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+             'X', 'B', 'U', 'Z', 'O', '.', '-']
+}
+ARGS = {'num_layers': 2, 'embed_dim': 24, 'logit_bias': True, 'ffn_embed_dim': 40, 'attention_heads': 3,
+        'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+
+
+def run_rank(rank, world_size, port, directory, tokens):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    alphabet = Alphabet.build_alphabet(PROTEINSEQ_TOKS)
+    model = load_tensor_parallel(argparse.Namespace(**ARGS), alphabet, os.path.join(directory, "weights.bin"))
+    with torch.no_grad():
+        result = model(tokens, repr_layers=[1, 2], return_contacts=True)
+    torch.save(result, os.path.join(directory, f"rank{rank}.pt"))
+    dist.destroy_process_group()
+
+
+class TensorParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(PROTEINSEQ_TOKS)
+        self.model = Esm1b(argparse.Namespace(**ARGS), self.alphabet).eval()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_column_major(self):
+        path = os.path.join(self.tmp.name, "weights.bin")
+        save_flat_weights(self.model, path, column_major=True)
+        state_dict = map_flat_weights(path)
+        for name, tensor in self.model.state_dict().items():
+            self.assertTrue(torch.equal(state_dict[name], tensor), name)
+        # the column shard of a rank is one contiguous range of the file
+        for name in ["layers.0.fc2.weight", "layers.0.self_attn.out_proj.weight"]:
+            self.assertTrue(state_dict[name][:, 10:20].t().is_contiguous(), name)
+        self.assertTrue(state_dict["layers.0.fc1.weight"].is_contiguous())
+
+        model, _ = FlatWeightsBuilder(path, self.alphabet)()
+        tokens = torch.randint(4, 24, (2, 12))
+        self.model.requires_grad_(False)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(self.model(tokens)["logits"], model(tokens)["logits"], atol=1e-5))
+
+    def test_two_ranks(self):
+        # the column-split weights stored transposed, each rank maps only its own shards
+        save_flat_weights(self.model, os.path.join(self.tmp.name, "weights.bin"), column_major=True)
+        tokens = torch.randint(4, 24, (2, 12))
+        tokens[:, 0] = self.alphabet.cls_idx
+        tokens[:, -1] = self.alphabet.eos_idx
+        tokens[1, 8:] = self.alphabet.padding_idx
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        # 3 heads and 40 FFN dims over 2 ranks, the shards are uneven
+        mp.spawn(run_rank, args=(2, port, self.tmp.name, tokens), nprocs=2)
+
+        with torch.no_grad():
+            expected = self.model(tokens, repr_layers=[1, 2], return_contacts=True)
+        for rank in range(2):
+            result = torch.load(os.path.join(self.tmp.name, f"rank{rank}.pt"))
+            for key in ["logits", "attentions", "contacts"]:
+                self.assertTrue(torch.allclose(expected[key], result[key], atol=1e-5), (rank, key))
+            for layer in [1, 2]:
+                self.assertTrue(torch.allclose(expected["representations"][layer],
+                                               result["representations"][layer], atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import os
+import argparse
+
+import torch
+import torch.nn as nn
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b, quantize_dynamic, compare_models
+
+
+class QuantizeTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 64, 'logit_bias': True, 'ffn_embed_dim': 128, 'attention_heads': 4,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        self.tokens = torch.randint(4, 24, (2, 16))
+        self.tokens[:, 0] = self.alphabet.cls_idx
+        self.tokens[1, 12:] = self.alphabet.padding_idx
+
+    def test_quantize_dynamic(self):
+        qmodel = quantize_dynamic(self.model)
+        self.assertIs(type(self.model.layers[0].fc1), nn.Linear)
+        self.assertIsNot(type(qmodel.layers[0].fc1), nn.Linear)
+        self.assertIsNot(type(qmodel.layers[0].self_attn.q_proj), nn.Linear)
+        self.assertIs(type(qmodel.lm_head.dense), nn.Linear)
+        self.assertIs(qmodel.lm_head.weight, qmodel.embed_tokens.weight)
+
+        targets = self.tokens.clone()
+        targets[:, 0] = self.alphabet.padding_idx
+        report = compare_models(self.model, qmodel, self.tokens, targets, self.alphabet.padding_idx)
+        self.assertGreater(report["embedding_cosine"], 0.99)
+
+
+if __name__ == "__main__":
+    unittest.main()
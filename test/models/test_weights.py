@@ -0,0 +1,95 @@
+import unittest
+import os
+import argparse
+import tempfile
+
+import torch
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b, save_flat_weights, FlatWeightsBuilder
+from openprotein.models.weights import materialize
+
+
+class FlatWeightsTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.args = args
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        path = os.path.join(self.tmp.name, "weights.bin")
+        save_flat_weights(self.model, path)
+        model, alphabet = FlatWeightsBuilder(path, self.alphabet)()
+        # F.linear picks its kernel by requires_grad, compare with a frozen model to get the same bits
+        self.model.requires_grad_(False)
+
+        self.assertIs(model.lm_head.weight, model.embed_tokens.weight)
+        storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+        self.assertEqual(len(storages), 1)
+        self.assertFalse(any(p.requires_grad for p in model.parameters()))
+        # the packed q/k/v of the fused layers would be a private copy of the shared weights
+        self.assertFalse(any(layer.cache_packed_qkv for layer in model.layers))
+
+        tokens = torch.randint(4, 24, (2, 10))
+        tokens[:, 0] = self.alphabet.cls_idx
+        tokens[:, -1] = self.alphabet.eos_idx
+        with torch.no_grad():
+            expected = self.model(tokens, return_contacts=True)
+            result = model(tokens, return_contacts=True)
+        self.assertTrue(torch.equal(expected["logits"], result["logits"]))
+        self.assertTrue(torch.equal(expected["contacts"], result["contacts"]))
+
+    def test_checkpoint_path(self):
+        path = os.path.join(self.tmp.name, "checkpoint.pt")
+        state_dict = {f"encoder.sentence_encoder.{name}": tensor for name, tensor in self.model.state_dict().items()
+                      if not name.startswith("contact_head")}
+        # fair-esm checkpoints pickle the arguments of the model next to the weights
+        torch.save({"model": state_dict, "args": argparse.Namespace(**self.args)}, path)
+        model = Esm1b(argparse.Namespace(**dict(self.args, checkpoint_path=path)), self.alphabet).eval()
+
+        self.assertFalse(any(p.is_meta for p in model.parameters()))
+        self.assertIs(model.lm_head.weight, model.embed_tokens.weight)
+        tokens = torch.randint(4, 24, (2, 10))
+        with torch.no_grad():
+            expected = self.model(tokens, repr_layers=[2])
+            result = model(tokens, repr_layers=[2])
+        self.assertTrue(torch.equal(expected["logits"], result["logits"]))
+        self.assertTrue(torch.equal(expected["representations"][2], result["representations"][2]))
+
+    def test_missing_keys(self):
+        path = os.path.join(self.tmp.name, "checkpoint.pt")
+        missing = {"lm_head.bias", "layers.0.fc1.bias"}
+        state_dict = {name: tensor for name, tensor in self.model.state_dict().items() if name not in missing}
+        torch.save(state_dict, path)
+        model = Esm1b(argparse.Namespace(**dict(self.args, checkpoint_path=path)), self.alphabet)
+        # RobertaLMHead has no reset_parameters, its bias is zeroed like in a pipeline stage
+        self.assertTrue(torch.equal(model.lm_head.bias, torch.zeros_like(model.lm_head.bias)))
+        self.assertIs(model.lm_head.weight, model.embed_tokens.weight)
+        # the tensors loaded next to a missing one are kept
+        for name, tensor in model.state_dict().items():
+            if name not in missing and not name.startswith("contact_head"):
+                self.assertTrue(torch.equal(tensor, self.model.state_dict()[name]), name)
+        self.assertFalse(torch.equal(model.layers[0].fc1.bias, torch.zeros_like(model.layers[0].fc1.bias)))
+
+        with torch.device("meta"):
+            module = torch.nn.Module()
+            module.register_buffer("scale", torch.ones(3))
+        with self.assertRaises(RuntimeError):
+            materialize(module)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import os
+import random
+import argparse
+
+import torch
+
+from openprotein.data import Alphabet, BatchConverter
+from openprotein.models import Esm1b, SlidingWindowEsm1b
+
+
+class SlidingWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 32, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        self.windowed = SlidingWindowEsm1b(self.model, self.alphabet, overlap=10, batch_size=3)
+        rng = random.Random(0)
+        self.sequences = ["".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(length)) for length in [70, 12]]
+
+    def run_window(self, sequence):
+        with torch.no_grad():
+            return self.model(BatchConverter(self.alphabet)([sequence]), repr_layers=[2], return_contacts=True)
+
+    def test_windows(self):
+        self.assertEqual(self.windowed.window, 30)
+        self.assertEqual(self.windowed.windows(70), [(0, 30), (20, 50), (40, 70)])
+        self.assertEqual(self.windowed.windows(12), [(0, 12)])
+
+    def test_stitching(self):
+        long, short = self.windowed(self.sequences, repr_layers=[2], return_contacts=True)
+        self.assertEqual(long["representations"][2].shape, (70, 16))
+        self.assertEqual(long["logits"].shape, (70, len(self.alphabet)))
+        self.assertEqual(long["contacts"].shape, (70, 70))
+
+        expected = self.run_window(self.sequences[1])
+        self.assertTrue(torch.allclose(short["representations"][2], expected["representations"][2][0, 1:-1],
+                                       atol=1e-5))
+        self.assertTrue(torch.allclose(short["contacts"], expected["contacts"][0], atol=1e-5))
+
+        first, second = self.run_window(self.sequences[0][:30]), self.run_window(self.sequences[0][20:50])
+        # residues 0-19 are only in the first window
+        self.assertTrue(torch.allclose(long["logits"][:20], first["logits"][0, 1:21], atol=1e-5))
+        # residue 25 is 6th of the second window and 5th from the end of the first, ramps of 11 residues
+        w1, w2 = 5 / 11, 6 / 11
+        average = (w1 * first["representations"][2][0, 26] + w2 * second["representations"][2][0, 6]) / (w1 + w2)
+        self.assertTrue(torch.allclose(long["representations"][2][25], average, atol=1e-5))
+        self.assertTrue(torch.allclose(long["contacts"][:20, :20], first["contacts"][0, :20, :20], atol=1e-5))
+        # residues 0 and 60 never share a window
+        self.assertEqual(long["contacts"][0, 60].item(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+import os
+import random
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from openprotein.data import Alphabet, BatchConverter
+from openprotein.models import Esm1b
+from openprotein.piplines import ContactPrediction
+
+
+class ContactPredictionTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        rng = random.Random(0)
+        self.records = [(f"seq{i}", "".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(rng.randint(5, 40))))
+                        for i in range(12)]
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dense_top(self, sequence, k, min_separation=6):
+        tokens = BatchConverter(self.alphabet)([sequence])
+        with torch.no_grad():
+            contacts = self.model.predict_contacts(tokens)[0]
+        i, j = torch.triu_indices(len(sequence), len(sequence), min_separation)
+        probs, top = contacts[i, j].topk(k)
+        return torch.stack([i[top], j[top]], dim=1).numpy(), probs.numpy()
+
+    def test_matches_dense(self):
+        contacts = ContactPrediction(self.model, self.alphabet, top=0.5, dtype="float32")
+        sequences = [s for _, s in self.records[:4]]
+        for sequence, (pairs, probs) in zip(sequences, contacts.predict(sequences)):
+            k = contacts.num_contacts(len(sequence))
+            self.assertEqual(pairs.shape, (k, 2))
+            expected_pairs, expected_probs = self.dense_top(sequence, k)
+            self.assertTrue(np.allclose(probs, expected_probs, atol=1e-5))
+            self.assertTrue(np.all(pairs[:, 1] - pairs[:, 0] >= 6))
+            self.assertTrue(np.all(probs[:-1] >= probs[1:]))
+            self.assertEqual({tuple(p) for p in pairs}, {tuple(p) for p in expected_pairs})
+
+    def test_blocks(self):
+        sequence = max((s for _, s in self.records), key=len)
+        contacts = ContactPrediction(self.model, self.alphabet)
+        weighted, row_sums = contacts.reduced_attentions(BatchConverter(self.alphabet)([sequence]))[0]
+        expected_pairs, expected_probs = self.dense_top(sequence, 30)
+        for block_size in (1, 3, 7, 256):
+            with torch.no_grad():
+                i, j, probs = self.model.contact_head.top_contacts(weighted, row_sums, 30, 6, block_size=block_size)
+            self.assertTrue(np.allclose(probs.numpy(), expected_probs, atol=1e-5), block_size)
+            self.assertTrue(np.array_equal(torch.stack([i, j], dim=1).numpy(), expected_pairs), block_size)
+
+    def test_num_contacts(self):
+        contacts = ContactPrediction(self.model, self.alphabet, top=1.0, min_separation=6)
+        self.assertEqual(contacts.num_contacts(5), 0)
+        self.assertEqual(contacts.num_contacts(8), 3)
+        self.assertEqual(contacts.num_contacts(40), 40)
+        self.assertEqual(ContactPrediction(self.model, self.alphabet, top_k=7).num_contacts(40), 7)
+        with self.assertRaises(ValueError):
+            ContactPrediction(self.model, self.alphabet, min_separation=0)
+
+    def test_run(self):
+        output = os.path.join(self.tmp.name, "contacts")
+        contacts = ContactPrediction(self.model, self.alphabet, top_k=10, max_tokens=128, chunk_size=5)
+        store = contacts.run(self.records, output)
+        self.assertEqual(len(store), len(self.records))
+        self.assertEqual(list(store.ids()), [name for name, _ in self.records])
+        self.assertEqual(contacts.stats["sequences"], len(self.records))
+        for index, (_, sequence) in enumerate(self.records):
+            pairs, probs = store.get("pairs", index), store.get("probs", index)
+            self.assertEqual(pairs.dtype, np.int32)
+            self.assertEqual(probs.dtype, np.float16)
+            k = contacts.num_contacts(len(sequence))
+            self.assertEqual(pairs.shape, (k, 2))
+            self.assertEqual(probs.shape, (k, 1))
+            if k:
+                _, expected = self.dense_top(sequence, k)
+                self.assertTrue(np.allclose(probs[:, 0], expected, atol=1e-3))
+
+        # nothing left to predict on a second run
+        store = ContactPrediction(self.model, self.alphabet, top_k=10, chunk_size=5).run(self.records, output)
+        self.assertEqual(len(store), len(self.records))
+
+
+if __name__ == "__main__":
+    unittest.main()
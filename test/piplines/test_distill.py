@@ -0,0 +1,120 @@
+import unittest
+import os
+import random
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b
+from openprotein.piplines import (Distillation, TeacherEmbedding, build_student, layer_map, distillation_report,
+                                  contact_precision, mask_sequences)
+
+
+class DistillationTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 4, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.teacher = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        rng = random.Random(0)
+        self.records = [(f"seq{i}", "".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(rng.randint(20, 40))))
+                        for i in range(16)]
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_build_student(self):
+        self.assertEqual(layer_map(33, 6), {1: 5, 2: 11, 3: 16, 4: 22, 5: 27, 6: 33})
+        student = build_student(self.teacher, self.alphabet, num_layers=2)
+        self.assertEqual(student.args.num_layers, 2)
+        self.assertEqual(self.teacher.args.num_layers, 4)
+        self.assertTrue(torch.equal(student.layers[0].fc1.weight, self.teacher.layers[1].fc1.weight))
+        self.assertTrue(torch.equal(student.layers[1].self_attn.q_proj.weight,
+                                    self.teacher.layers[3].self_attn.q_proj.weight))
+        self.assertTrue(torch.equal(student.embed_tokens.weight, self.teacher.embed_tokens.weight))
+        self.assertIs(student.lm_head.weight, student.embed_tokens.weight)
+        teacher_weight = self.teacher.contact_head.regression.weight.view(4, 2)
+        self.assertTrue(torch.allclose(student.contact_head.regression.weight.view(2, 2), teacher_weight[[1, 3]] * 2))
+
+        narrow = build_student(self.teacher, self.alphabet, num_layers=2, embed_dim=8, ffn_embed_dim=16,
+                               init_from_teacher=False)
+        self.assertEqual(narrow.args.embed_dim, 8)
+        with self.assertRaises(ValueError):
+            build_student(self.teacher, self.alphabet, num_layers=2, embed_dim=8)
+
+    def test_teacher_store(self):
+        layers = list(layer_map(4, 2).values())
+        store = TeacherEmbedding(self.teacher, self.alphabet, layers, dtype="float32", chunk_size=5).run(
+            self.records, os.path.join(self.tmp.name, "teacher"))
+        self.assertEqual(sorted(store.fields), ["logits", "masked_tokens", "per_residue_2", "per_residue_4",
+                                                "targets"])
+        # the teacher ran on the masked sequence, with masks that do not depend on the batch
+        distillation = Distillation(self.teacher, build_student(self.teacher, self.alphabet, 2), self.alphabet,
+                                    teacher_store=store)
+        sequence = self.records[7][1]
+        origin, masked, targets = mask_sequences(distillation.converter, [sequence])
+        batch = mask_sequences(distillation.converter, [self.records[0][1], sequence])
+        self.assertTrue(torch.equal(batch[1][1, :masked.size(1)], masked[0]))
+        self.assertTrue(targets.ne(self.alphabet.padding_idx).any())
+        self.assertTrue(np.array_equal(store.get("masked_tokens", 7)[:, 0], masked[0, 1:-1].numpy()))
+        self.assertTrue(np.array_equal(store.get("targets", 7)[:, 0], targets[0, 1:-1].numpy()))
+        with torch.no_grad():
+            result = self.teacher(masked, repr_layers=[2])
+        self.assertTrue(np.allclose(store.get("logits", 7), result["logits"][0, 1:-1].numpy(), atol=1e-5))
+        self.assertTrue(np.allclose(store.get("per_residue_2", 7), result["representations"][2][0, 1:-1].numpy(),
+                                    atol=1e-5))
+
+        # the student trains on the masked inputs of the store
+        sequences = [self.records[3][1], sequence]
+        stored = distillation._stored_masks(sequences, [3, 7])
+        for stored_tokens, tokens in zip(stored, mask_sequences(distillation.converter, sequences)):
+            self.assertTrue(torch.equal(stored_tokens, tokens))
+
+    def test_fit(self):
+        layers = list(layer_map(4, 2).values())
+        store = TeacherEmbedding(self.teacher, self.alphabet, layers).run(
+            self.records, os.path.join(self.tmp.name, "teacher"))
+        for teacher_store in (None, store):
+            np.random.seed(0)
+            student = build_student(self.teacher, self.alphabet, num_layers=2, embed_dim=8, ffn_embed_dim=16,
+                                    init_from_teacher=False)
+            distillation = Distillation(self.teacher, student, self.alphabet, teacher_store=teacher_store, lr=3e-3)
+            self.assertEqual(distillation.layers, {1: 2, 2: 4})
+            history = distillation.fit(self.records, epochs=6, batch_size=4)
+            self.assertEqual(len(history), 6)
+            self.assertLess(history[-1], history[0])
+        with self.assertRaises(ValueError):
+            distillation.fit(self.records[:3])
+
+    def test_report(self):
+        # a student with every layer of the teacher is the teacher
+        student = build_student(self.teacher, self.alphabet, num_layers=4)
+        report = distillation_report(self.teacher, student, self.alphabet, [s for _, s in self.records])
+        self.assertEqual(report["teacher_contact_precision"], 1.0)
+        self.assertEqual(report["contact_retention"], 1.0)
+        self.assertEqual(report["student_mlm_accuracy"], report["teacher_mlm_accuracy"])
+        self.assertGreater(report["speedup"], 0)
+
+    def test_contact_precision(self):
+        true = np.zeros((10, 10), dtype=bool)
+        true[0, 9] = true[1, 8] = True
+        pred = np.zeros((10, 10))
+        pred[0, 9], pred[2, 9], pred[1, 2] = 0.9, 0.8, 0.99
+        # (1, 2) is closer than min_separation, the top 2 of the others are (0, 9) and (2, 9)
+        self.assertEqual(contact_precision(true, pred, min_separation=6, top=0.2), 0.5)
+        self.assertEqual(contact_precision(true, pred, min_separation=6, top=0.1), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import os
+import random
+import argparse
+import tempfile
+
+import torch
+
+from openprotein.data import Alphabet
+from openprotein.layers import RegressionHead
+from openprotein.models import Esm1b
+from openprotein.piplines import Embedding, FeatureDataset, DownstreamTrain, Spearman
+
+
+class DownstreamTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet)
+        rng = random.Random(0)
+        self.records = [(f"seq{i}", "".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(rng.randint(5, 30))))
+                        for i in range(60)]
+        self.tmp = tempfile.TemporaryDirectory()
+        embedding = Embedding(self.model, self.alphabet, pooling=["mean", "per_residue"], chunk_size=25)
+        self.store = embedding.run(self.records, os.path.join(self.tmp.name, "store"))
+        # a property the features determine
+        weight = torch.randn(16)
+        self.labels = [float(torch.from_numpy(self.store.get("mean_2", i).copy()) @ weight)
+                       for i in range(len(self.store))]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_features(self):
+        data = FeatureDataset(self.store, "mean_2", self.labels, indices=range(10, 50))
+        lazy = FeatureDataset(self.store, "mean_2", self.labels, indices=range(10, 50), in_memory=False)
+        self.assertEqual(len(data), 40)
+        for (x, mask, y), (lazy_x, _, lazy_y) in zip(data.batches(16), lazy.batches(16)):
+            self.assertIsNone(mask)
+            self.assertTrue(torch.equal(x, lazy_x))
+            self.assertTrue(torch.equal(y, lazy_y))
+        x, _, y = next(data.batches(16))
+        self.assertTrue(torch.equal(x[3], torch.from_numpy(self.store.get("mean_2", 13).copy())))
+        self.assertEqual(float(y[3]), self.labels[13])
+
+        residues = FeatureDataset(self.store, "per_residue_2", {"seq3": 1.0, "seq40": 2.0})
+        x, mask, y = next(residues.batches(8))
+        lengths = [len(self.records[3][1]), len(self.records[40][1])]
+        self.assertEqual(x.shape, (2, max(lengths), 16))
+        self.assertEqual(mask.sum(1).tolist(), lengths)
+        self.assertTrue(torch.equal(x[1, :lengths[1]], torch.from_numpy(self.store.get("per_residue_2", 40).copy())))
+        self.assertEqual(y.tolist(), [1.0, 2.0])
+
+    def test_search(self):
+        train = DownstreamTrain(FeatureDataset(self.store, "mean_2", self.labels, indices=range(45)),
+                                FeatureDataset(self.store, "mean_2", self.labels, indices=range(45, 60)),
+                                metrics=[Spearman()])
+        results = train.search(lambda hidden_dim: RegressionHead(16, hidden_dim=hidden_dim),
+                               {"hidden_dim": [0, 8], "lr": [1e-4, 3e-2]}, epochs=200, batch_size=16)
+        self.assertEqual(len(results), 4)
+        scores = [result["scores"]["Spm"] for result in results]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertGreater(scores[0], 0.9)
+        self.assertEqual(results[0]["params"]["lr"], 3e-2)
+
+    def test_per_residue_head(self):
+        train = DownstreamTrain(FeatureDataset(self.store, "per_residue_2", self.labels, indices=range(45)),
+                                FeatureDataset(self.store, "per_residue_2", self.labels, indices=range(45, 60)))
+        result = train.fit(RegressionHead(16), epochs=200, lr=3e-2, batch_size=16)
+        # the mean of the residues is the mean field, the property is linear in it
+        self.assertGreater(result["scores"]["Spm"], 0.9)
+
+
+if __name__ == "__main__":
+    unittest.main()
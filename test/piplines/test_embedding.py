@@ -0,0 +1,111 @@
+import unittest
+import os
+import argparse
+import tempfile
+
+import torch
+
+from openprotein.data import Alphabet, BatchConverter
+from openprotein.models import Esm1b
+from openprotein.piplines import Embedding, EmbeddingStore, EmbeddingCache, model_fingerprint
+
+
+class EmbeddingTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet)
+        self.records = [("seq0", "MKTAYIAK"), ("seq1", "MKV"), ("seq2", "GSHMLEDPARK"), ("seq3", "MKTAYIAK")]
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_run(self):
+        fasta = os.path.join(self.tmp.name, "input.fasta")
+        with open(fasta, "w") as f:
+            for name, sequence in self.records:
+                f.write(f">{name} description\n{sequence[:4]}\n{sequence[4:]}\n")
+        embedding = Embedding(self.model, self.alphabet, repr_layers=[1, 2], pooling=["mean", "cls", "per_residue"],
+                              max_tokens=32, chunk_size=3)
+        store = embedding.run(fasta, os.path.join(self.tmp.name, "store"))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.num_shards, 2)
+        self.assertEqual(list(store.ids()), ["seq0", "seq1", "seq2", "seq3"])
+        self.assertEqual(store.get("mean_2", 1).shape, (16,))
+        self.assertEqual(store.get("per_residue_1", 2).shape, (11, 16))
+        self.assertAlmostEqual(float(abs(store.get("mean_2", 0) - store.get("mean_2", 3)).max()), 0, places=5)
+        self.assertAlmostEqual(float(abs(store.get("per_residue_2", 1).mean(0) - store.get("mean_2", 1)).max()), 0,
+                               places=5)
+
+    def test_resume(self):
+        output = os.path.join(self.tmp.name, "store")
+        embedding = Embedding(self.model, self.alphabet, chunk_size=2)
+        embedding.run(self.records[:2], output)
+        store = embedding.run(self.records, output)
+        self.assertEqual(embedding.stats["sequences"], 2)
+        self.assertEqual(len(EmbeddingStore(output)), 4)
+        self.assertEqual(list(store.ids()), ["seq0", "seq1", "seq2", "seq3"])
+
+    def test_cache(self):
+        cache = EmbeddingCache(os.path.join(self.tmp.name, "cache"), model_fingerprint(self.model))
+        embedding = Embedding(self.model, self.alphabet, pooling=["mean", "per_residue"], cache=cache)
+        first = embedding.run(self.records, os.path.join(self.tmp.name, "first"))
+        self.assertEqual(embedding.stats["computed"], 3)
+        self.assertEqual(embedding.stats["cache_hit_rate"], 0.0)
+        second = embedding.run(self.records, os.path.join(self.tmp.name, "second"))
+        self.assertEqual(embedding.stats["computed"], 0)
+        self.assertEqual(embedding.stats["cache_hit_rate"], 1.0)
+        for i in range(4):
+            self.assertTrue((first.get("per_residue_2", i) == second.get("per_residue_2", i)).all())
+
+    def test_cache_precision(self):
+        cache = EmbeddingCache(os.path.join(self.tmp.name, "cache"), model_fingerprint(self.model))
+        half = Embedding(self.model, self.alphabet, cache=cache, dtype="float16")
+        half.run(self.records, os.path.join(self.tmp.name, "half"))
+        self.model.precision = "bf16"
+        Embedding(self.model, self.alphabet, cache=cache).run(self.records, os.path.join(self.tmp.name, "bf16"))
+        # neither the float16 nor the bf16 entries are served to a float32 job
+        self.model.precision = "fp32"
+        embedding = Embedding(self.model, self.alphabet, cache=cache)
+        store = embedding.run(self.records, os.path.join(self.tmp.name, "full"))
+        self.assertEqual(embedding.stats["computed"], 3)
+        self.assertEqual(embedding.stats["cache_hit_rate"], 0.0)
+        self.assertEqual(store.get("mean_2", 0).dtype.name, "float32")
+        self.assertEqual(cache.get("MKV", 2, "mean", "float16").dtype.name, "float16")
+
+    def test_truncation(self):
+        converter = BatchConverter(self.alphabet, truncation_seq_length=4)
+        self.assertEqual(converter.truncate("MKTAYIAK"), "MKTA")
+        self.assertEqual(converter.truncate("M<mask>K<mask>TA"), "M<mask>K<mask>")
+        self.assertEqual(converter.encode(converter.truncate("M<mask>K<mask>TA")),
+                         converter.encode("M<mask>K<mask>TA"))
+
+        # truncated by tokens, the two sequences are the same and keyed once
+        cache = EmbeddingCache(os.path.join(self.tmp.name, "cache"), model_fingerprint(self.model))
+        embedding = Embedding(self.model, self.alphabet, cache=cache, truncation_seq_length=4)
+        records = [("a", "M<mask>K<mask>TA"), ("b", "M<mask>K<mask>GS")]
+        store = embedding.run(records, os.path.join(self.tmp.name, "store"))
+        self.assertEqual(embedding.stats["computed"], 1)
+        self.assertTrue((store.get("mean_2", 0) == store.get("mean_2", 1)).all())
+
+    def test_cache_eviction(self):
+        cache = EmbeddingCache(os.path.join(self.tmp.name, "cache"), "fingerprint", max_bytes=1000)
+        for i in range(10):
+            cache.put(str(i), 2, "mean", torch.ones(64).numpy())
+        self.assertLessEqual(cache.nbytes, 1000)
+        self.assertGreater(cache.evictions, 0)
+        self.assertIsNotNone(cache.get("9", 2, "mean"))
+        self.assertIsNone(cache.get("0", 2, "mean"))
+
+
+if __name__ == "__main__":
+    unittest.main()
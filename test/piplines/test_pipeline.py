@@ -0,0 +1,95 @@
+import unittest
+import os
+import socket
+import argparse
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from openprotein.data import Alphabet
+from openprotein.models import Esm1b
+from openprotein.piplines import PipelineStage, PipelineTrain
+
+PROTEINSEQ_TOKS = {
+    'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+             'X', 'B', 'U', 'Z', 'O', '.', '-']
+}
+ARGS = {'num_layers': 3, 'embed_dim': 24, 'logit_bias': True, 'ffn_embed_dim': 40, 'attention_heads': 3,
+        'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+SCHEDULES = ["gpipe", "1f1b"]
+
+
+def run_rank(rank, world_size, port, directory, masked_tokens, target_tokens):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    alphabet = Alphabet.build_alphabet(PROTEINSEQ_TOKS)
+    for schedule in SCHEDULES:
+        stage = PipelineStage(argparse.Namespace(**ARGS), alphabet, rank, world_size,
+                              checkpoint_path=os.path.join(directory, "model.pt"))
+        train = PipelineTrain(stage, torch.optim.SGD(stage.parameters(), lr=0.1), alphabet.padding_idx,
+                              num_micro_batches=3, schedule=schedule)
+        loss = train.step(masked_tokens, target_tokens)
+        torch.save({"loss": loss, "state_dict": stage.global_state_dict()},
+                   os.path.join(directory, f"{schedule}{rank}.pt"))
+    dist.destroy_process_group()
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(PROTEINSEQ_TOKS)
+        self.model = Esm1b(argparse.Namespace(**ARGS), self.alphabet)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_partition(self):
+        stage = PipelineStage(argparse.Namespace(**ARGS), self.alphabet, 1, 2)
+        self.assertEqual(stage.layer_range, (2, 3))
+        self.assertTrue(hasattr(stage.model, "lm_head"))
+        self.assertFalse(hasattr(stage.model, "embed_tokens"))
+        self.assertIn("layers.2.fc1.weight", stage.global_state_dict())
+        with self.assertRaises(ValueError):
+            PipelineStage(argparse.Namespace(**ARGS), self.alphabet, 0, 2, partition=[1, 1])
+
+    def test_two_stages(self):
+        torch.save(self.model.state_dict(), os.path.join(self.tmp.name, "model.pt"))
+        masked_tokens = torch.randint(4, 24, (5, 12))
+        masked_tokens[:, 0] = self.alphabet.cls_idx
+        masked_tokens[:, -1] = self.alphabet.eos_idx
+        masked_tokens[3, 7:] = self.alphabet.padding_idx
+        target_tokens = torch.full_like(masked_tokens, self.alphabet.padding_idx)
+        target_tokens[:, 2:5] = masked_tokens[:, 2:5]
+        masked_tokens[:, 2:5] = self.alphabet.mask_idx
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        mp.spawn(run_rank, args=(2, port, self.tmp.name, masked_tokens, target_tokens), nprocs=2)
+
+        optimizer = torch.optim.SGD(self.model.parameters(), lr=0.1)
+        logits = self.model(masked_tokens)["logits"]
+        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), target_tokens.view(-1),
+                               ignore_index=self.alphabet.padding_idx)
+        loss.backward()
+        optimizer.step()
+        expected = self.model.state_dict()
+        for schedule in SCHEDULES:
+            first = torch.load(os.path.join(self.tmp.name, f"{schedule}0.pt"))
+            last = torch.load(os.path.join(self.tmp.name, f"{schedule}1.pt"))
+            self.assertIsNone(first["loss"])
+            self.assertAlmostEqual(last["loss"], loss.item(), places=5)
+            state_dict = {**first["state_dict"], **last["state_dict"]}
+            self.assertEqual(set(state_dict), set(expected) - {n for n in expected if n.startswith("contact_head")})
+            for name, tensor in state_dict.items():
+                self.assertTrue(torch.allclose(expected[name], tensor, atol=1e-5), (schedule, name))
+
+
+if __name__ == "__main__":
+    unittest.main()
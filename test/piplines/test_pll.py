@@ -0,0 +1,63 @@
+import unittest
+import os
+import argparse
+
+import torch
+
+from openprotein.data import Alphabet, BatchConverter
+from openprotein.models import Esm1b
+from openprotein.piplines import PseudoLikelihood
+
+
+class PseudoLikelihoodTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        self.sequences = ["MKTAYIAKQRQISFVK", "MKV", "GSHMLEDPARK", "MKTAYIAKQRQISFVA"]
+
+    def _pll(self, sequence, schedule):
+        tokens = BatchConverter(self.alphabet)([sequence])
+        total = 0.0
+        for positions in schedule:
+            masked = tokens.clone()
+            masked[0, [p + 1 for p in positions]] = self.alphabet.mask_idx
+            with torch.no_grad():
+                log_probs = torch.log_softmax(self.model(masked)["logits"][0], dim=-1)
+            total += sum(log_probs[p + 1, tokens[0, p + 1]].item() for p in positions)
+        return total
+
+    def test_exact(self):
+        pll = PseudoLikelihood(self.model, self.alphabet, max_tokens=60, chunk_size=3)
+        scores = pll.score(self.sequences)
+        for sequence, score in zip(self.sequences, scores):
+            self.assertAlmostEqual(score, self._pll(sequence, [[i] for i in range(len(sequence))]), places=4)
+        self.assertEqual(pll.stats["sequences"], 4)
+        self.assertEqual(pll.stats["copies"], sum(len(s) for s in self.sequences))
+
+    def test_disjoint(self):
+        pll = PseudoLikelihood(self.model, self.alphabet, mode="disjoint", k=3, max_tokens=60)
+        self.assertEqual(pll.masking_schedule(7), [[0, 3, 6], [1, 4], [2, 5]])
+        scores = pll.score(self.sequences)
+        for sequence, score in zip(self.sequences, scores):
+            self.assertAlmostEqual(score, self._pll(sequence, pll.masking_schedule(len(sequence))), places=4)
+
+    def test_subset(self):
+        pll = PseudoLikelihood(self.model, self.alphabet, mode="subset", num_positions=5)
+        results = dict(pll.run((str(i), s) for i, s in enumerate(self.sequences)))
+        self.assertEqual(sorted(results), ["0", "1", "2", "3"])
+        self.assertEqual(results["1"]["scored"], 3)
+        self.assertEqual(results["0"]["scored"], 5)
+        self.assertAlmostEqual(results["0"]["pll"], results["0"]["mean_log_prob"] * 16, places=4)
+
+
+if __name__ == "__main__":
+    unittest.main()
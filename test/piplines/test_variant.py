@@ -0,0 +1,77 @@
+import unittest
+import os
+import argparse
+
+import torch
+
+from openprotein.data import Alphabet, BatchConverter
+from openprotein.models import Esm1b
+from openprotein.piplines import VariantScorer, parse_mutant
+
+
+class VariantTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        proteinseq_toks = {
+            'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                     'X', 'B', 'U', 'Z', 'O', '.', '-']
+        }
+        torch.manual_seed(0)
+        self.alphabet = Alphabet.build_alphabet(proteinseq_toks)
+        args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+                'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+        self.model = Esm1b(argparse.Namespace(**args), self.alphabet).eval()
+        self.sequence = "MKTAYIAKQRQISFVK"
+        self.mutants = ["M1A", "K2R", "K2E:T3S", "Y5W:K16L", "M1A:K2R"]
+
+    def _log_probs(self, tokens, position):
+        with torch.no_grad():
+            logits = self.model(tokens)["logits"]
+        return torch.log_softmax(logits[0, position + 1], dim=-1)
+
+    def _expected(self, masked):
+        tokens = BatchConverter(self.alphabet)([self.sequence])
+        expected = []
+        for mutant in self.mutants:
+            score = 0.0
+            for wt, position, mt in parse_mutant(mutant):
+                copy = tokens.clone()
+                if masked:
+                    copy[0, position + 1] = self.alphabet.mask_idx
+                log_probs = self._log_probs(copy, position)
+                score += (log_probs[self.alphabet.get_idx(mt)] - log_probs[self.alphabet.get_idx(wt)]).item()
+            expected.append(score)
+        return expected
+
+    def test_parse_mutant(self):
+        self.assertEqual(parse_mutant("A23G:L45P"), [("A", 22, "G"), ("L", 44, "P")])
+        self.assertEqual(parse_mutant("A23G", offset=0), [("A", 23, "G")])
+        with self.assertRaises(ValueError):
+            parse_mutant("23G")
+
+    def test_wt_marginals(self):
+        scorer = VariantScorer(self.model, self.alphabet, strategy="wt-marginals")
+        scores = scorer.score(self.sequence, self.mutants)
+        self.assertEqual([s["mutant"] for s in scores], self.mutants)
+        for score, expected in zip(scores, self._expected(masked=False)):
+            self.assertAlmostEqual(score["score"], expected, places=4)
+        self.assertEqual(scorer.stats["forwards"], 1)
+
+    def test_masked_marginals(self):
+        scorer = VariantScorer(self.model, self.alphabet, strategy="masked-marginals", max_tokens=40)
+        scores = scorer.score(self.sequence, self.mutants)
+        for score, expected in zip(scores, self._expected(masked=True)):
+            self.assertAlmostEqual(score["score"], expected, places=4)
+        # 5 sites, two masked copies of 18 tokens per batch
+        self.assertEqual(scorer.stats["sites"], 5)
+        self.assertEqual(scorer.stats["forwards"], 3)
+
+    def test_wrong_wild_type(self):
+        scorer = VariantScorer(self.model, self.alphabet)
+        with self.assertRaises(ValueError):
+            scorer.score(self.sequence, ["A1G"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from openprotein.data import Alphabet, BatchConverter
+from openprotein.models import Esm1b
+from openprotein.serving import Request, DynamicBatcher, InferenceServer, ServingClient
+
+
+def build_model():
+    proteinseq_toks = {
+        'toks': ['L', 'A', 'G', 'V', 'S', 'E', 'R', 'T', 'I', 'D', 'P', 'K', 'Q', 'N', 'F', 'Y', 'M', 'H', 'W', 'C',
+                 'X', 'B', 'U', 'Z', 'O', '.', '-']
+    }
+    torch.manual_seed(0)
+    alphabet = Alphabet.build_alphabet(proteinseq_toks)
+    args = {'num_layers': 2, 'embed_dim': 16, 'logit_bias': True, 'ffn_embed_dim': 32, 'attention_heads': 2,
+            'max_positions': 64, 'emb_layer_norm_before': True, 'checkpoint_path': None}
+    return Esm1b(argparse.Namespace(**args), alphabet).eval(), alphabet
+
+
+class SlowEsm1b(Esm1b):
+
+    def forward(self, *args, **kwargs):
+        time.sleep(1)
+        return super().forward(*args, **kwargs)
+
+
+def build_slow_model():
+    model, alphabet = build_model()
+    model.__class__ = SlowEsm1b
+    return model, alphabet
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        self.model, self.alphabet = build_model()
+        self.sequences = ["MKTAYIAKQRQISFVK", "MKV", "GSHMLEDPARK", "MKTAYIAK"]
+
+    def _reference(self, sequence):
+        tokens = BatchConverter(self.alphabet)([sequence])
+        with torch.no_grad():
+            result = self.model(tokens, repr_layers=[2], return_contacts=True)
+        return {
+            "embedding": result["representations"][2][0, 1:-1].mean(0).numpy(),
+            "logits": result["logits"][0, 1:-1].numpy(),
+            "contacts": result["contacts"][0].numpy(),
+        }
+
+    def test_batcher(self):
+        batcher = DynamicBatcher(max_tokens=30, max_wait=10)
+        for sequence in ["A" * 8, "A" * 8, "A" * 8, "A" * 4]:
+            batcher.add(Request("embedding", sequence))
+        batcher.add(Request("logits", "A" * 4))
+        self.assertEqual(len(batcher), 5)
+        # three requests of 10 padded tokens fill the budget, the fourth waits
+        self.assertEqual(len(batcher.next_batch()), 3)
+        self.assertIsNone(batcher.next_batch())
+        batch = batcher.next_batch(now=time.perf_counter() + 10)
+        self.assertEqual([r.kind for r in batch], ["embedding"])
+        self.assertEqual([r.kind for r in batcher.next_batch(force=True)], ["logits"])
+        self.assertIsNone(batcher.next_deadline())
+
+    def test_in_process(self):
+        with InferenceServer(build_model, num_workers=0, max_tokens=64, max_wait=0.05) as server:
+            futures = [server.submit(kind, sequence) for sequence in self.sequences
+                       for kind in ["embedding", "logits", "contacts"]]
+            results = [future.result() for future in futures]
+            metrics = server.metrics()
+        for i, sequence in enumerate(self.sequences):
+            reference = self._reference(sequence)
+            for j, kind in enumerate(["embedding", "logits", "contacts"]):
+                self.assertTrue(np.allclose(results[3 * i + j], reference[kind], atol=1e-5), (sequence, kind))
+        self.assertEqual(metrics["completed"], 12)
+        self.assertLess(metrics["batches"], 12)
+        self.assertGreater(metrics["batch_fill_ratio"], 0)
+
+    def test_socket_worker_process(self):
+        with InferenceServer(build_model, num_workers=1, threads_per_worker=1, max_wait=0.01) as server:
+            host, port = server.serve()
+            client = ServingClient(host, port)
+            results = client.request_many([("embedding", s, {"pooling": "mean"}) for s in self.sequences])
+            with self.assertRaises(RuntimeError):
+                client.request("embedding", "A" * 100)
+            with self.assertRaises(RuntimeError):
+                client.request_many([("embedding", "MKV", {}), ("embedding", "A" * 100, {}), ("logits", "MKV", {})])
+            # the responses of the failed call were all read, the next call gets its own
+            again = client.request_many([("embedding", s, {"pooling": "mean"}) for s in reversed(self.sequences)])
+            client.close()
+        for sequence, result, other in zip(self.sequences, results, reversed(again)):
+            self.assertTrue(np.allclose(result, self._reference(sequence)["embedding"], atol=1e-5))
+            self.assertTrue(np.allclose(other, self._reference(sequence)["embedding"], atol=1e-5))
+
+    def test_worker_died(self):
+        with InferenceServer(build_slow_model, num_workers=1, max_wait=0.01, check_interval=0.1) as server:
+            future = server.submit("embedding", "MKV")
+            while server.metrics()["in_flight"] == 0:
+                time.sleep(0.01)
+            server._workers[0].kill()
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=60)
+            # served by the restarted worker
+            result = server.embed("MKV")
+            metrics = server.metrics()
+        self.assertEqual(metrics["worker_restarts"], 1)
+        self.assertEqual(metrics["failed"], 1)
+        self.assertTrue(np.allclose(result, self._reference("MKV")["embedding"], atol=1e-5))
+
+    def test_close_before_start(self):
+        server = InferenceServer(build_model)
+        server.close()
+        with self.assertRaises(RuntimeError):
+            server.submit("embedding", "MKV")
+
+
+if __name__ == "__main__":
+    unittest.main()